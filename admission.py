@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import math
+import time
+import logging
+import threading
+from PIL import Image
+from PyPDF2 import PdfReader
+from invoice_input import InvoiceInput, open_input, input_name
+
+# 每个文件的固定开销（百万像素），覆盖解析、编码和写出等与像素数无关的部分
+FILE_OVERHEAD_MPIX = 1.0
+
+# 没有已完成任务可供参考时假定的处理速度（百万像素/秒）
+DEFAULT_RATE_MPIX = 20.0
+
+# Retry-After 的范围（秒）
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 120
+
+
+class AdmissionRejected(Exception):
+    """预算已用完，任务未被接受"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def estimate_cost(inputs, dpi):
+    """估算合并 inputs 的开销（百万像素）
+
+    图片按解码后的像素数计算，PDF按第一页（合并时只放置第一页）在 dpi 下渲染的像素数计算。
+    只读取图片头部和PDF的页面尺寸，无法识别的文件只计固定开销
+    """
+    cost = 0.0
+    for source in inputs:
+        cost += FILE_OVERHEAD_MPIX
+        try:
+            if input_name(source).lower().endswith('.pdf'):
+                box = PdfReader(open_input(source)).pages[0].mediabox
+                cost += float(box.width) / 72 * dpi * float(box.height) / 72 * dpi / 1e6
+            else:
+                with Image.open(open_input(source)) as image:
+                    cost += image.width * image.height / 1e6
+        except Exception as e:
+            logging.warning(f"无法估算文件 {input_name(source)} 的开销: {str(e)}")
+        finally:
+            if isinstance(source, InvoiceInput):
+                source.release()
+    return cost
+
+
+class Admission:
+    """已接受任务占用的预算，任务结束后调用 AdmissionController.release 归还"""
+
+    def __init__(self, client, cost):
+        self.client = client
+        self.cost = cost
+        self.started = time.monotonic()
+        self.released = False
+
+
+class AdmissionController:
+    """合并任务的准入控制
+
+    按估算开销（百万像素）记录进行中的任务，总预算和单个客户端的预算都用完时，
+    等待至多 wait 秒，仍然不够则拒绝并给出建议的重试时间。
+    预算按工作进程计算，与每个工作进程独立的CPU进程池对应。
+    单个任务超过预算时，只要当前没有其他进行中的任务（或该客户端没有其他任务）仍然接受，
+    否则这样的任务永远无法执行。
+    """
+
+    def __init__(self, max_cost, client_max_cost, wait=0):
+        self.max_cost = max_cost
+        self.client_max_cost = client_max_cost
+        self.wait = wait
+        self.in_flight = 0.0
+        self._clients = {}
+        self._rate = DEFAULT_RATE_MPIX
+        self._changed = threading.Condition()
+
+    def _shortfall(self, client, cost):
+        """返回还差多少预算才能接受任务，0 表示可以接受"""
+        client_cost = self._clients.get(client, 0.0)
+        shortfall = 0.0
+        if self.in_flight and self.in_flight + cost > self.max_cost:
+            shortfall = self.in_flight + cost - self.max_cost
+        if client_cost and client_cost + cost > self.client_max_cost:
+            shortfall = max(shortfall, client_cost + cost - self.client_max_cost)
+        return shortfall
+
+    def retry_after(self, shortfall):
+        """按最近的处理速度估算释放 shortfall 预算所需的秒数"""
+        seconds = math.ceil(shortfall / self._rate)
+        return max(MIN_RETRY_AFTER, min(MAX_RETRY_AFTER, seconds))
+
+    def admit(self, client, cost):
+        """接受任务并返回 Admission，预算不足时抛出 AdmissionRejected"""
+        deadline = time.monotonic() + self.wait
+        with self._changed:
+            while True:
+                shortfall = self._shortfall(client, cost)
+                if not shortfall:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    retry_after = self.retry_after(shortfall)
+                    logging.warning(f"拒绝客户端 {client} 的任务: 估算开销 {cost:.1f} 百万像素，"
+                                    f"进行中 {self.in_flight:.1f}，{retry_after} 秒后重试")
+                    raise AdmissionRejected('服务器繁忙，请稍后重试', retry_after)
+                self._changed.wait(remaining)
+            self.in_flight += cost
+            self._clients[client] = self._clients.get(client, 0.0) + cost
+        return Admission(client, cost)
+
+    def release(self, admission):
+        """归还任务占用的预算，并用任务耗时更新处理速度的估计，重复调用时忽略"""
+        with self._changed:
+            if admission.released:
+                return
+            admission.released = True
+            self.in_flight -= admission.cost
+            if self.in_flight < 1e-9:
+                self.in_flight = 0.0
+            client_cost = self._clients.pop(admission.client, 0.0) - admission.cost
+            if client_cost > 1e-9:
+                self._clients[admission.client] = client_cost
+            elapsed = time.monotonic() - admission.started
+            if elapsed > 0 and admission.cost > FILE_OVERHEAD_MPIX:
+                # 指数平滑，避免单个任务造成估计大幅波动
+                self._rate = 0.8 * self._rate + 0.2 * (admission.cost / elapsed)
+            self._changed.notify_all()
@@ -1,12 +1,27 @@
 #!/usr/bin/env python3
-from flask import Flask, request, send_file, render_template, jsonify
+from flask import Flask, Request, request, send_file, render_template, jsonify, Response, stream_with_context, g
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
-from werkzeug.utils import secure_filename
-from merge_invoices import InvoiceMerger
+from merge_invoices import (
+    InvoiceMerger, OUTPUT_PROFILES, DEFAULT_OUTPUT_PROFILE, DEFAULT_MAX_PAGE_PIXELS,
+    DEFAULT_MAX_JOB_PIXELS, SLOT_WIDTH, SLOT_HEIGHT, register_fonts, slot_pixel_size
+)
+from invoice_input import InvoiceInput, as_input
+from raster_cache import RasterCache
+from jobs import JobManager, JobCancelled, FINISHED_STATES
+from cpu_pool import CpuPool, default_pool_size
+from admission import AdmissionController, AdmissionRejected, estimate_cost
+from archives import ArchiveError, expand_inputs, is_archive
+from status_store import create_status_store, DEFAULT_STATUS_TTL
+from result_store import ResultStore, DEFAULT_RESULT_TTL
+from upload_sessions import UploadSessionStore, UploadError, DEFAULT_UPLOAD_TTL
+import metrics
 import tempfile
 import logging
-import shutil
+import io
 import uuid
+import json
+import hashlib
 import threading
 import time
 
@@ -17,9 +32,43 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()]  # 使用标准输出而不是文件
 )
 
+class SpooledRequest(Request):
+    """上传文件小于阈值时保存在内存中，超过阈值才写入临时文件"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=app.config['UPLOAD_SPOOL_MAX_BYTES'])
+
 app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 限制上传文件大小为16MB
+app.request_class = SpooledRequest
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_MB', 16)) * 1024 * 1024  # 限制上传请求大小，默认16MB
 app.config['UPLOAD_FOLDER'] = os.getenv('UPLOAD_FOLDER', tempfile.mkdtemp())  # 允许通过环境变量配置上传目录
+app.config['UPLOAD_SPOOL_MAX_BYTES'] = int(os.getenv('UPLOAD_SPOOL_MAX_MB', 8)) * 1024 * 1024  # 上传文件在内存中保存的上限
+app.config['CPU_POOL_SIZE'] = int(os.getenv('CPU_POOL_SIZE', default_pool_size()))  # 渲染和解码使用的进程数，0 表示在任务线程中处理
+app.config['CPU_POOL_QUEUE'] = int(os.getenv('CPU_POOL_QUEUE', app.config['CPU_POOL_SIZE'] * 2))  # 进程池之外最多排队的文件数
+app.config['RASTER_CACHE_MAX_BYTES'] = int(os.getenv('RASTER_CACHE_MAX_MB', 512)) * 1024 * 1024  # PDF渲染缓存容量上限
+app.config['RESULT_TTL'] = int(os.getenv('RESULT_TTL', DEFAULT_RESULT_TTL))  # 合并结果保留时间（秒）
+app.config['RESULT_MAX_BYTES'] = int(os.getenv('RESULT_MAX_MB', 1024)) * 1024 * 1024  # 合并结果总容量上限
+app.config['RESULT_DELETE_ON_DOWNLOAD'] = os.getenv('RESULT_DELETE_ON_DOWNLOAD', '1') == '1'  # 下载后删除结果
+app.config['OUTPUT_PROFILE'] = os.getenv('OUTPUT_PROFILE', DEFAULT_OUTPUT_PROFILE)  # 默认输出质量配置
+app.config['PDF_OPTIMIZE'] = os.getenv('PDF_OPTIMIZE', '1') == '1'  # 保存后合并重复图片并清理未使用的资源
+app.config['MAX_PAGE_PIXELS'] = int(float(os.getenv('MAX_PAGE_MPIX', DEFAULT_MAX_PAGE_PIXELS / 1e6)) * 1e6)  # 单张发票渲染的像素上限
+app.config['MAX_JOB_PIXELS'] = int(float(os.getenv('MAX_JOB_MPIX', DEFAULT_MAX_JOB_PIXELS / 1e6)) * 1e6)  # 每个任务同时解码的像素上限，限制并行提交的文件数
+app.config['ADMISSION_MAX_MPIX'] = float(os.getenv('ADMISSION_MAX_MPIX', 2000))  # 整个服务同时处理的总开销上限（百万像素），按工作进程数平分
+app.config['ADMISSION_CLIENT_MAX_MPIX'] = float(os.getenv('ADMISSION_CLIENT_MAX_MPIX', 800))  # 单个客户端在整个服务中同时处理的开销上限，按工作进程数平分
+app.config['HTTP_WORKERS'] = max(1, int(os.getenv('GUNICORN_WORKERS', 1)))  # 处理请求的工作进程数，由 gunicorn.conf.py 设置
+app.config['ADMISSION_WAIT'] = float(os.getenv('ADMISSION_WAIT', 2))  # 预算不足时最多等待的秒数，超时返回429
+app.config['ARCHIVE_MAX_MEMBERS'] = int(os.getenv('ARCHIVE_MAX_MEMBERS', 500))  # 单个ZIP压缩包中的发票数上限
+app.config['ARCHIVE_MAX_BYTES'] = int(os.getenv('ARCHIVE_MAX_MB', 512)) * 1024 * 1024  # 单个ZIP压缩包解压后的总大小上限
+app.config['UPLOAD_CHUNK_BYTES'] = int(os.getenv('UPLOAD_CHUNK_MB', 4)) * 1024 * 1024  # 分块上传的分块大小，需小于 MAX_UPLOAD_MB
+app.config['UPLOAD_SESSION_MAX_BYTES'] = int(os.getenv('UPLOAD_SESSION_MAX_MB', 1024)) * 1024 * 1024  # 单次分块上传的总大小上限
+app.config['UPLOAD_SESSION_TTL'] = int(os.getenv('UPLOAD_SESSION_TTL', DEFAULT_UPLOAD_TTL))  # 未完成的上传会话保留时间（秒）
+app.config['MERGE_STREAM'] = os.getenv('MERGE_STREAM', '0') == '1'  # /merge 默认逐页发送结果，请求中的 stream 字段可以覆盖
+app.config['SSE_MAX_STREAMS'] = int(os.getenv('SSE_MAX_STREAMS', 4))  # 每个工作进程同时保持的进度推送连接数，每个连接占用一个请求线程，超出时返回503，客户端改为轮询
+app.config['PROXY_FIX_HOPS'] = int(os.getenv('PROXY_FIX_HOPS', 0))  # 前面可信的反向代理层数，按 X-Forwarded-For 识别客户端；默认 0，直接对外服务时客户端可以伪造该请求头
+
+# 部署在反向代理之后时，remote_addr 取 X-Forwarded-For 中由可信代理添加的客户端地址，准入控制按真实客户端计算预算
+if app.config['PROXY_FIX_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_HOPS'], x_proto=app.config['PROXY_FIX_HOPS'])
 
 # 生产环境配置
 if os.environ.get('FLASK_ENV') == 'production':
@@ -32,28 +81,348 @@ if os.environ.get('FLASK_ENV') == 'production':
 # 确保上传目录存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# 用于存储处理进度的字典
-processing_status = {}
+# 任务进度存储，默认使用上传目录下的 SQLite 数据库，由所有工作进程共享
+status_store = create_status_store(
+    os.getenv('STATUS_BACKEND', 'sqlite'),
+    db_path=os.path.join(app.config['UPLOAD_FOLDER'], 'state', 'jobs.db'),
+    ttl=int(os.getenv('JOB_STATUS_TTL', DEFAULT_STATUS_TTL))
+)
+
+# 导入时预先加载字体：启用 gunicorn 的 preload_app 时只在主进程中解析一次
+register_fonts()
+
+# 后台合并任务，与处理请求的线程相互独立
+job_manager = JobManager(max_workers=int(os.getenv('JOB_WORKERS', 2)), store=status_store)
+
+# 所有合并任务共用的CPU进程池，大小固定，与HTTP工作进程和线程数无关
+cpu_pool = CpuPool(app.config['CPU_POOL_SIZE'], app.config['CPU_POOL_QUEUE']) if app.config['CPU_POOL_SIZE'] else None
+
+# 合并任务的准入控制，预算用完时返回429，客户端按 Retry-After 重试。
+# 每个工作进程各自计算预算，按工作进程数平分后所有进程合计不超过配置的上限
+admission = AdmissionController(
+    app.config['ADMISSION_MAX_MPIX'] / app.config['HTTP_WORKERS'],
+    app.config['ADMISSION_CLIENT_MAX_MPIX'] / app.config['HTTP_WORKERS'],
+    wait=app.config['ADMISSION_WAIT']
+)
 
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff'}
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """按路由模板统计请求耗时，避免任务ID等路径参数产生大量标签"""
+    start = g.pop('request_start', None)
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.HTTP_REQUEST_SECONDS.labels(request.method, endpoint, str(response.status_code)).observe(
+            time.perf_counter() - start
+        )
+    return response
+
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return is_archive(filename) or ('.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS)
+
+def expand_uploads(inputs):
+    """把上传的ZIP压缩包替换为其中的发票文件，成员在合并过程中才逐个解压"""
+    return expand_inputs(
+        inputs,
+        extensions=ALLOWED_EXTENSIONS,
+        max_members=app.config['ARCHIVE_MAX_MEMBERS'],
+        max_bytes=app.config['ARCHIVE_MAX_BYTES'],
+    )
+
+def raster_cache_dir():
+    """PDF渲染缓存目录，位于上传目录下，由所有工作进程共享"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'raster_cache')
+
+def get_result_store():
+    """合并结果存储，位于上传目录下，每个任务一个输出文件"""
+    return ResultStore(
+        os.path.join(app.config['UPLOAD_FOLDER'], 'results'),
+        ttl=app.config['RESULT_TTL'],
+        max_bytes=app.config['RESULT_MAX_BYTES'],
+    )
+
+def get_upload_store():
+    """分块上传会话存储，位于上传目录下，分块可以发送到任意工作进程"""
+    return UploadSessionStore(
+        os.path.join(app.config['UPLOAD_FOLDER'], 'uploads'),
+        ttl=app.config['UPLOAD_SESSION_TTL'],
+        chunk_size=min(app.config['UPLOAD_CHUNK_BYTES'], app.config['MAX_CONTENT_LENGTH']),
+        max_bytes=app.config['UPLOAD_SESSION_MAX_BYTES'],
+    )
+
+def send_result(result_store, task_id, download_name):
+    """发送合并结果，按配置在下载时删除
+
+    删除时先打开文件再删除目录项，已打开的文件在发送完成前仍然可读
+    """
+    output = result_store.path_for(task_id)
+    file_size = os.path.getsize(output)
+    if app.config['RESULT_DELETE_ON_DOWNLOAD']:
+        output = open(output, 'rb')
+        result_store.remove(task_id)
+    response = send_file(
+        output,
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=download_name
+    )
+    response.content_length = file_size
+    
+    # 添加缓存控制头
+    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '0'
+    return response
+
+def create_merger(profile=None):
+    """按应用配置创建 InvoiceMerger"""
+    return InvoiceMerger(
+        executor=cpu_pool,
+        cache_dir=raster_cache_dir(),
+        cache_max_bytes=app.config['RASTER_CACHE_MAX_BYTES'],
+        profile=profile or app.config['OUTPUT_PROFILE'],
+        optimize=app.config['PDF_OPTIMIZE'],
+        max_page_pixels=app.config['MAX_PAGE_PIXELS'],
+        max_job_pixels=app.config['MAX_JOB_PIXELS'],
+    )
+
+def admit_job(inputs, profile):
+    """估算任务开销并申请预算，返回 Admission；预算不足时抛出 AdmissionRejected"""
+    cost = estimate_cost(inputs, OUTPUT_PROFILES[profile]['dpi'])
+    return admission.admit(request.remote_addr, cost)
+
+def busy_response(error):
+    """预算不足时的429响应"""
+    metrics.ADMISSION_REJECTED.inc()
+    response = jsonify({'error': str(error), 'retry_after': error.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def requested_stream():
+    """读取请求中的 stream 字段（表单或查询参数），为 1 时逐页发送合并结果"""
+    value = request.values.get('stream')
+    if value is None:
+        return app.config['MERGE_STREAM']
+    return value.lower() in ('1', 'true', 'yes')
+
+def stream_merge_response(merger, files, ticket):
+    """边生成边发送合并结果，不写输出文件
+
+    先生成第一页，出错时仍可返回JSON错误；之后的错误只能中断连接，客户端收到的是不完整的分块响应
+    """
+    chunks = merger.iter_merged_pdf(files)
+    first = next(chunks)
+
+    def generate():
+        try:
+            yield first
+            yield from chunks
+        except Exception as e:
+            logging.error(f"逐页发送合并结果时出错: {str(e)}", exc_info=True)
+            raise
+        finally:
+            admission.release(ticket)
+
+    response = Response(stream_with_context(generate()), mimetype='application/pdf')
+    # 客户端在发送完成前断开时生成器可能从未开始执行，响应关闭时同样归还预算
+    response.call_on_close(lambda: admission.release(ticket))
+    response.headers['Content-Disposition'] = 'attachment; filename=merged_invoices.pdf'
+    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '0'
+    response.headers['X-Accel-Buffering'] = 'no'  # 禁止反向代理缓冲
+    return response
+
+def requested_profile():
+    """读取请求中的输出质量配置（表单字段 profile），未指定时使用默认配置"""
+    return request.form.get('profile') or app.config['OUTPUT_PROFILE']
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/layout')
+def get_layout():
+    """页面布局和各输出质量配置下图片的最大有效尺寸，浏览器端上传前按此缩小图片
+
+    jpeg_quality 为 null 的配置（无损归档）不应重新压缩JPEG
+    """
+    profiles = {}
+    for name, profile in OUTPUT_PROFILES.items():
+        max_width, max_height = slot_pixel_size(name)
+        profiles[name] = {
+            'dpi': profile['dpi'],
+            'jpeg_quality': profile['jpeg_quality'],
+            'max_width_px': max_width,
+            'max_height_px': max_height,
+        }
+    response = jsonify({
+        'slot_width_pt': SLOT_WIDTH,
+        'slot_height_pt': SLOT_HEIGHT,
+        'default_profile': app.config['OUTPUT_PROFILE'],
+        'profiles': profiles,
+    })
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
+
 @app.route('/progress/<task_id>')
 def get_progress(task_id):
     """获取处理进度"""
-    if task_id in processing_status:
-        return jsonify(processing_status[task_id])
+    status = job_manager.get(task_id)
+    if status is not None:
+        return jsonify(status)
     return jsonify({'status': 'unknown'})
 
+# 进度推送：单个连接的最长时间和心跳间隔（秒）。
+# 每个推送连接在保持期间占用一个 gthread 请求线程，因此单个连接只保持很短的时间：
+# 到时后由服务器关闭，浏览器按 retry 指定的间隔携带 Last-Event-ID 自动重连，未变化的状态不会重复发送
+SSE_MAX_DURATION = 20
+SSE_HEARTBEAT_INTERVAL = 15
+SSE_RETRY_MS = 1000
+SSE_BUSY_RETRY_AFTER = 5  # 推送连接已满时建议客户端等待的秒数
+
+# 推送连接在整个持续时间内占用一个请求线程，限制同时保持的连接数，其余线程留给上传和合并
+sse_slots = threading.BoundedSemaphore(max(1, app.config['SSE_MAX_STREAMS']))
+
+def status_events(task_id, last_event_id=None):
+    """生成任务进度的 Server-Sent Events 数据流，任务结束或达到最长时间后关闭
+
+    每条状态以内容摘要作为事件ID，重连时与 Last-Event-ID 相同的状态不再发送
+    """
+    yield f'retry: {SSE_RETRY_MS}\n\n'
+    last_id = last_event_id
+    last_sent = time.time()
+    deadline = time.time() + SSE_MAX_DURATION
+    while time.time() < deadline:
+        status = job_manager.get(task_id)
+        if status is None:
+            yield f"data: {json.dumps({'status': 'unknown'})}\n\n"
+            return
+        payload = json.dumps(status, ensure_ascii=False, sort_keys=True)
+        event_id = hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+        if event_id != last_id:
+            yield f"id: {event_id}\ndata: {payload}\n\n"
+            last_id = event_id
+            last_sent = time.time()
+            if status['status'] in FINISHED_STATES:
+                return
+        elif status['status'] in FINISHED_STATES:
+            # 重连前已收到最终状态
+            return
+        elif time.time() - last_sent > SSE_HEARTBEAT_INTERVAL:
+            yield ': heartbeat\n\n'
+            last_sent = time.time()
+        # 本进程内的更新会立即唤醒，其他进程的更新在超时后读取
+        job_manager.wait_for_update(timeout=1)
+
+@app.route('/progress/<task_id>/stream')
+def stream_progress(task_id):
+    """以 Server-Sent Events 推送处理进度，同时保持的连接数达到上限时返回503，客户端改为轮询 /progress"""
+    if not sse_slots.acquire(blocking=False):
+        response = jsonify({'error': '进度推送连接已满，请轮询任务进度', 'retry_after': SSE_BUSY_RETRY_AFTER})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(SSE_BUSY_RETRY_AFTER)
+        return response
+    slot = [True]
+
+    def release():
+        try:
+            slot.pop()
+        except IndexError:
+            return
+        sse_slots.release()
+
+    last_event_id = request.headers.get('Last-Event-ID')
+
+    def events():
+        try:
+            yield from status_events(task_id, last_event_id)
+        finally:
+            release()
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    # 客户端在数据流开始前断开时生成器可能从未执行，响应关闭时同样归还连接名额
+    response.call_on_close(release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 禁止反向代理缓冲
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """以 Prometheus 文本格式导出运行指标"""
+    payload, content_type = metrics.render()
+    return Response(payload, content_type=content_type)
+
+@app.route('/cache/stats')
+def cache_stats():
+    """获取PDF渲染缓存的命中统计"""
+    if not app.config['RASTER_CACHE_MAX_BYTES']:
+        return jsonify({'enabled': False})
+    stats = RasterCache(raster_cache_dir(), app.config['RASTER_CACHE_MAX_BYTES']).stats()
+    stats['enabled'] = True
+    return jsonify(stats)
+
+def take_upload(file):
+    """接管上传文件的数据流，请求结束后仍可在后台任务中读取"""
+    stream = file.stream
+    file.stream = io.BytesIO()  # 避免请求结束时关闭已接管的数据流
+    return InvoiceInput(os.path.basename(file.filename), stream)
+
+def run_merge_job(task_id, inputs, output_path, profile=None):
+    """在后台线程中合并文件"""
+    try:
+        job_manager.update(task_id, status='merging', progress=40, message='开始合并文件...')
+        merger = create_merger(profile)
+        
+        # 更新处理进度的回调函数，同时检查任务是否已被取消
+        def progress_callback(current, total, filename):
+            job_manager.check_cancelled(task_id)
+            progress = int(40 + (current / total) * 60)  # 文件处理占总进度的60%
+            job_manager.update(
+                task_id,
+                status='processing',
+                progress=progress,
+                current_file=filename,
+                message=f'正在处理 {filename}...'
+            )
+
+        # 确保输出目录存在
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        
+        merger.merge_files(inputs, output_path, progress_callback)
+
+        # 确保文件已成功生成
+        if not os.path.exists(output_path):
+            raise Exception("生成的PDF文件未找到")
+
+        # 更新完成状态，同时记录优化节省的字节数
+        bytes_saved = merger.optimize_stats['bytes_saved'] if merger.optimize_stats else 0
+        job_manager.update(task_id, status='completed', progress=100, message='处理完成！',
+                           bytes_saved=bytes_saved)
+        metrics.JOBS.labels('completed').inc()
+    except JobCancelled:
+        metrics.JOBS.labels('cancelled').inc()
+        raise
+    except Exception:
+        metrics.JOBS.labels('error').inc()
+        raise
+    finally:
+        # 释放上传文件占用的内存或临时文件
+        for invoice in inputs:
+            invoice.close()
+
 @app.route('/upload', methods=['POST'])
 def upload_files():
-    if 'files[]' not in request.files:
+    with metrics.timed('upload_save'):
+        # 解析请求体，上传的文件保存在内存或临时文件中
+        received = request.files
+    if 'files[]' not in received:
         return jsonify({'error': '没有选择文件'}), 400
     
     files = request.files.getlist('files[]')
@@ -63,111 +432,232 @@ def upload_files():
     # 检查所有文件
     for file in files:
         if not allowed_file(file.filename):
-            return jsonify({'error': f'文件 {file.filename} 格式不正确，仅支持 PDF 和常见图片格式'}), 400
+            return jsonify({'error': f'文件 {file.filename} 格式不正确，仅支持 PDF、常见图片格式和ZIP压缩包'}), 400
+
+    profile = requested_profile()
+    if profile not in OUTPUT_PROFILES:
+        return jsonify({'error': f'不支持的输出质量配置: {profile}'}), 400
+
+    # 上传的文件直接交给后台任务，合并在后台执行
+    return start_merge_job([take_upload(file) for file in files], profile)
+
+def start_merge_job(inputs, profile, task_id=None, on_done=None):
+    """展开压缩包、申请预算并提交后台合并任务，返回202响应；on_done 在任务结束或被取消后调用"""
+    try:
+        inputs = expand_uploads(inputs)
+    except ArchiveError as e:
+        for invoice in inputs:
+            invoice.close()
+        return jsonify({'error': str(e)}), 400
+    try:
+        ticket = admit_job(inputs, profile)
+    except AdmissionRejected as e:
+        for invoice in inputs:
+            invoice.close()
+        return busy_response(e)
 
     # 生成任务ID
-    task_id = str(uuid.uuid4())
-    processing_status[task_id] = {
-        'status': 'starting',
-        'progress': 0,
-        'total_files': len(files),
-        'processed_files': 0,
-        'current_file': '',
-        'message': '准备处理文件...'
+    task_id = task_id or str(uuid.uuid4())
+    job_manager.create(
+        task_id,
+        status='starting',
+        total_files=len(inputs),
+        processed_files=0,
+        message='准备处理文件...'
+    )
+    job_manager.update(
+        task_id,
+        progress=40,  # 文件接收占总进度的40%
+        processed_files=len(inputs)
+    )
+    try:
+        result_store = get_result_store()
+        result_store.cleanup()
+        job_manager.update(task_id, status='queued', message='等待处理...')
+        future = job_manager.submit(task_id, run_merge_job, inputs, result_store.path_for(task_id), profile)
+        # 任务结束或被取消后归还预算
+        future.add_done_callback(lambda _: admission.release(ticket))
+        if on_done:
+            future.add_done_callback(lambda _: on_done())
+    except Exception as e:
+        logging.error(f"提交任务时出错: {str(e)}", exc_info=True)
+        admission.release(ticket)
+        for invoice in inputs:
+            invoice.close()
+        job_manager.update(task_id, status='error', message=f'处理出错: {str(e)}')
+        return jsonify({'error': f'处理文件时出错: {str(e)}'}), 500
+
+    return jsonify(job_response(task_id)), 202
+
+def job_response(task_id):
+    """合并任务已提交时的响应内容"""
+    return {
+        'message': '文件已上传，正在处理',
+        'task_id': task_id,
+        'status_url': f'/jobs/{task_id}',
+        'download_url': f'/jobs/{task_id}/result',
+        'cancel_url': f'/jobs/{task_id}/cancel'
     }
 
-    # 保存文件并处理
-    temp_dir = None
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """创建分块上传会话，请求体为 {"files": [{"name": 文件名, "size": 字节数}], "profile": 输出质量配置}"""
+    body = request.get_json(silent=True) or {}
+    files = body.get('files')
+    if not isinstance(files, list) or not files:
+        return jsonify({'error': '没有选择文件'}), 400
+    for file in files:
+        if not isinstance(file, dict) or not allowed_file(str(file.get('name', ''))):
+            return jsonify({'error': f"文件 {file.get('name') if isinstance(file, dict) else file} 格式不正确，"
+                                     f"仅支持 PDF、常见图片格式和ZIP压缩包"}), 400
+    profile = body.get('profile') or app.config['OUTPUT_PROFILE']
+    if profile not in OUTPUT_PROFILES:
+        return jsonify({'error': f'不支持的输出质量配置: {profile}'}), 400
+
+    upload_store = get_upload_store()
+    upload_store.cleanup()
     try:
-        temp_dir = tempfile.mkdtemp()
-        saved_files = []
-        
-        # 保存文件
-        for i, file in enumerate(files):
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(temp_dir, filename)
-            file.save(filepath)
-            saved_files.append(filepath)
-            
-            # 更新保存进度
-            processing_status[task_id].update({
-                'status': 'saving',
-                'progress': int((i + 1) / len(files) * 40),  # 文件保存占总进度的40%
-                'processed_files': i + 1,
-                'current_file': filename,
-                'message': f'正在保存文件 {filename}...'
-            })
-
-        # 合并文件
-        processing_status[task_id].update({
-            'status': 'merging',
-            'progress': 40,
-            'message': '开始合并文件...'
-        })
-
-        merger = InvoiceMerger()
-        output_path = os.path.join(app.config['UPLOAD_FOLDER'], 'merged_invoices.pdf')
-        
-        # 更新处理进度的回调函数
-        def progress_callback(current, total, filename):
-            progress = int(40 + (current / total) * 60)  # 文件处理占总进度的60%
-            processing_status[task_id].update({
-                'status': 'processing',
-                'progress': progress,
-                'current_file': filename,
-                'message': f'正在处理 {filename}...'
-            })
+        session = upload_store.create(files, profile=profile)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    upload_id = session['upload_id']
+    session['status_url'] = f'/uploads/{upload_id}'
+    session['complete_url'] = f'/uploads/{upload_id}/complete'
+    return jsonify(session), 201
 
-        # 确保输出目录存在
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        
-        merger.merge_files(saved_files, output_path, progress_callback)
+@app.route('/uploads/<upload_id>')
+def get_upload(upload_id):
+    """查询上传会话中每个文件已收到的分块，客户端据此只发送缺少的分块"""
+    upload_store = get_upload_store()
+    session = upload_store.load(upload_id)
+    if session is None:
+        return jsonify({'error': '上传会话不存在或已过期'}), 404
+    return jsonify(upload_store.describe(upload_id, session))
 
-        # 确保文件已成功生成
-        if not os.path.exists(output_path):
-            raise Exception("生成的PDF文件未找到")
+@app.route('/uploads/<upload_id>/files/<int:index>/chunks/<int:chunk>', methods=['PUT'])
+def put_upload_chunk(upload_id, index, chunk):
+    """上传一个分块，请求体为分块的原始数据；重复上传同一分块会覆盖之前的内容"""
+    upload_store = get_upload_store()
+    session = upload_store.load(upload_id)
+    if session is None:
+        return jsonify({'error': '上传会话不存在或已过期'}), 404
+    try:
+        with metrics.timed('upload_save'):
+            size = upload_store.write_chunk(upload_id, session, index, chunk, request.stream)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'index': index, 'chunk': chunk, 'size': size})
 
-        # 更新完成状态
-        processing_status[task_id].update({
-            'status': 'completed',
-            'progress': 100,
-            'message': '处理完成！'
-        })
-        
-        return jsonify({
-            'message': '发票合并成功',
-            'download_url': '/download/merged_invoices.pdf',
-            'task_id': task_id
-        })
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    """所有分块到齐后拼接文件并提交合并任务；重复调用时返回已提交的任务"""
+    upload_store = get_upload_store()
+    session = upload_store.load(upload_id)
+    if session is None:
+        return jsonify({'error': '上传会话不存在或已过期'}), 404
+    with upload_store.locked(upload_id):
+        session = upload_store.load(upload_id)
+        if session is None:
+            return jsonify({'error': '上传会话不存在或已过期'}), 404
+        if session.get('task_id'):
+            return jsonify(job_response(session['task_id'])), 202
+        try:
+            assembled = upload_store.assemble(upload_id, session)
+        except UploadError as e:
+            return jsonify({'error': str(e)}), 409
 
-    except Exception as e:
-        logging.error(f"处理文件时出错: {str(e)}", exc_info=True)
-        
-        # 更新错误状态
-        if task_id in processing_status:
-            processing_status[task_id].update({
-                'status': 'error',
-                'message': f'处理出错: {str(e)}'
-            })
-        
-        return jsonify({'error': f'处理文件时出错: {str(e)}'}), 500
-    finally:
-        # 清理临时目录
-        if temp_dir and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+        inputs = [InvoiceInput(name, open(path, 'rb')) for name, path in assembled]
+        task_id = str(uuid.uuid4())
+        # 先记录任务再提交：任务可能在提交返回之前就已结束并删除会话
+        upload_store.mark_submitted(upload_id, session, task_id)
+        response = app.make_response(start_merge_job(inputs, session['profile'], task_id=task_id,
+                                                      on_done=lambda: upload_store.remove(upload_id)))
+        if response.status_code != 202:
+            # 提交失败（例如服务器繁忙）时保留已拼接的文件，客户端可以再次完成上传
+            upload_store.mark_submitted(upload_id, session, None)
+        return response
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    """放弃上传会话并删除已收到的分块"""
+    upload_store = get_upload_store()
+    if upload_store.load(upload_id) is None:
+        return jsonify({'error': '上传会话不存在或已过期'}), 404
+    upload_store.remove(upload_id)
+    return '', 204
+
+@app.route('/jobs/<task_id>')
+def get_job(task_id):
+    """获取任务状态"""
+    status = job_manager.get(task_id)
+    if status is None:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(status)
+
+@app.route('/jobs/<task_id>/result')
+def get_job_result(task_id):
+    """下载任务生成的PDF文件"""
+    status = job_manager.get(task_id)
+    if status is None:
+        return jsonify({'error': '任务不存在'}), 404
+    if status['status'] != 'completed':
+        return jsonify({'error': '任务尚未完成', 'status': status['status']}), 409
+    
+    result_store = get_result_store()
+    if result_store.get(task_id) is None:
+        logging.error(f"合并结果不存在或已过期: {task_id}")
+        return jsonify({'error': '文件已下载或已过期'}), 410
+    return send_result(result_store, task_id, '合并后的发票.pdf')
+
+@app.route('/jobs/<task_id>/cancel', methods=['POST'])
+def cancel_job(task_id):
+    """取消任务"""
+    status = job_manager.get(task_id)
+    if status is None:
+        return jsonify({'error': '任务不存在'}), 404
+    if status['status'] in FINISHED_STATES:
+        return jsonify({'error': '任务已结束', 'status': status['status']}), 409
+    job_manager.cancel(task_id)
+    return jsonify(job_manager.get(task_id))
 
 @app.route('/merge', methods=['POST'])
 def merge():
-    if 'files[]' not in request.files:
+    with metrics.timed('upload_save'):
+        # 解析请求体，上传的文件保存在内存或临时文件中
+        received = request.files
+    if 'files[]' not in received:
         return jsonify({'error': '没有选择文件'}), 400
     
     files = request.files.getlist('files[]')
     if not files or all(not file.filename for file in files):
         return jsonify({'error': '没有选择文件'}), 400
 
+    profile = requested_profile()
+    if profile not in OUTPUT_PROFILES:
+        return jsonify({'error': f'不支持的输出质量配置: {profile}'}), 400
+
+    try:
+        files = expand_uploads([as_input(file) for file in files if file.filename])
+    except ArchiveError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        ticket = admit_job(files, profile)
+    except AdmissionRejected as e:
+        return busy_response(e)
+
+    if requested_stream():
+        try:
+            return stream_merge_response(create_merger(profile), files, ticket)
+        except Exception as e:
+            admission.release(ticket)
+            logging.error(f"处理文件时出错: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+
+    task_id = str(uuid.uuid4())
+    result_store = get_result_store()
     try:
-        merger = InvoiceMerger()
-        output_path = merger.merge_invoices(files)
+        merger = create_merger(profile)
+        output_path = merger.merge_invoices(files, result_store.path_for(task_id))
         
         if not os.path.exists(output_path):
             return jsonify({'error': '生成PDF文件失败'}), 500
@@ -175,28 +665,23 @@ def merge():
         # 获取文件大小
         file_size = os.path.getsize(output_path)
         if file_size == 0:
+            result_store.remove(task_id)
             return jsonify({'error': '生成的PDF文件为空'}), 500
         
         logging.info(f"准备下载文件: {output_path}, 大小: {file_size} 字节")
         
         # 使用 send_file 发送文件，设置合适的 MIME 类型和缓存控制
-        response = send_file(
-            output_path,
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name='merged_invoices.pdf'
-        )
-        
-        # 添加缓存控制头
-        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '0'
-        
+        response = send_result(result_store, task_id, 'merged_invoices.pdf')
+        if merger.optimize_stats:
+            response.headers['X-Bytes-Saved'] = str(merger.optimize_stats['bytes_saved'])
         return response
         
     except Exception as e:
+        result_store.remove(task_id)
         logging.error(f"处理文件时出错: {str(e)}")
         return jsonify({'error': str(e)}), 500
+    finally:
+        admission.release(ticket)
 
 @app.route('/download/<filename>')
 def download_file(filename):
@@ -217,11 +702,17 @@ def download_file(filename):
 
 @app.errorhandler(413)
 def request_entity_too_large(error):
-    return jsonify({'error': '文件太大，请确保单个文件不超过16MB'}), 413
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify({'error': f'文件太大，请确保上传的文件总大小不超过{limit_mb}MB'}), 413
 
 def cleanup_temp_files():
     """清理临时文件"""
     try:
+        # 清理过期的任务状态和合并结果
+        status_store.purge_expired()
+        get_result_store().cleanup()
+        get_upload_store().cleanup()
+        
         # 只清理超过1小时的文件
         current_time = time.time()
         if os.path.exists(app.config['UPLOAD_FOLDER']):
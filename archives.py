@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import io
+import os
+import shutil
+import logging
+import tempfile
+import zipfile
+from invoice_input import InvoiceInput, input_name, open_input
+
+# 压缩包中可以合并的发票格式，其他文件（例如邮件客户端导出的说明文件）忽略
+INVOICE_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'tif'}
+
+# 单个压缩包的成员数和解压后总大小的默认上限，防止压缩炸弹
+DEFAULT_MAX_MEMBERS = 500
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# 解压后的成员小于该大小时保存在内存中，超过才写入临时文件
+MEMBER_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+
+class ArchiveError(ValueError):
+    """压缩包无法读取或超出限制"""
+
+
+def is_archive(filename):
+    return filename.lower().endswith('.zip')
+
+
+def member_filename(info):
+    """成员的文件名，去掉目录部分
+
+    没有设置UTF-8标志的文件名按 cp437 解码，国内邮件客户端和系统导出的压缩包实际多为GBK编码
+    """
+    name = info.filename
+    if not info.flag_bits & 0x800:
+        try:
+            name = name.encode('cp437').decode('gbk')
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+    return os.path.basename(name.rstrip('/'))
+
+
+class ArchiveMember(InvoiceInput):
+    """压缩包中的一个发票文件
+
+    第一次读取时才解压，release 后释放解压出的数据，需要时重新解压；
+    合并流程逐个处理文件，同一时间只有正在处理的少量成员处于解压状态。
+    """
+
+    def __init__(self, archive, info, source=None):
+        self.archive = archive
+        self.info = info
+        self.source = source  # 压缩包本身（路径或 InvoiceInput），关闭时一并关闭
+        self.filename = member_filename(info)
+        self._stream = None
+
+    @property
+    def stream(self):
+        if self._stream is None:
+            self._stream = tempfile.SpooledTemporaryFile(max_size=MEMBER_SPOOL_MAX_BYTES)
+            with self.archive.open(self.info) as member:
+                shutil.copyfileobj(member, self._stream)
+        return self._stream
+
+    def release(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def close(self):
+        self.release()
+        self.archive.close()
+        if isinstance(self.source, InvoiceInput):
+            self.source.close()
+
+    def __reduce__(self):
+        # 跨进程传递时只发送解压后的内容，子进程中是普通的 InvoiceInput；本进程中的数据随即释放
+        data = self.read()
+        self.release()
+        return InvoiceInput, (self.filename, io.BytesIO(data))
+
+
+def expand_archive(source, extensions=INVOICE_EXTENSIONS, max_members=DEFAULT_MAX_MEMBERS,
+                   max_bytes=DEFAULT_MAX_BYTES):
+    """列出压缩包 source（文件路径或 InvoiceInput）中的发票文件，返回 ArchiveMember 列表
+
+    只读取压缩包的目录，不解压任何成员。成员数或解压后的总大小超出上限时抛出 ArchiveError；
+    解压时 zipfile 最多读出目录中记录的大小，并校验CRC，目录中的大小不会被绕过
+    """
+    name = input_name(source)
+    try:
+        archive = zipfile.ZipFile(open_input(source))
+    except (zipfile.BadZipFile, OSError) as e:
+        raise ArchiveError(f"无法读取压缩包 {name}: {str(e)}")
+
+    members = []
+    total_bytes = 0
+    for info in archive.infolist():
+        filename = member_filename(info)
+        if info.is_dir() or not filename or filename.startswith('.') or '__MACOSX' in info.filename:
+            continue
+        if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in extensions:
+            logging.info(f"跳过压缩包 {name} 中不支持的文件: {info.filename}")
+            continue
+        if info.flag_bits & 0x1:
+            archive.close()
+            raise ArchiveError(f"压缩包 {name} 中的文件 {filename} 已加密")
+        members.append(ArchiveMember(archive, info, source))
+        total_bytes += info.file_size
+        if len(members) > max_members:
+            archive.close()
+            raise ArchiveError(f"压缩包 {name} 中的发票超过 {max_members} 个")
+        if total_bytes > max_bytes:
+            archive.close()
+            raise ArchiveError(f"压缩包 {name} 解压后超过 {max_bytes // (1024 * 1024)}MB")
+    if not members:
+        archive.close()
+        raise ArchiveError(f"压缩包 {name} 中没有可合并的发票")
+    logging.info(f"压缩包 {name}: {len(members)} 个发票，解压后共 {total_bytes} 字节")
+    return members
+
+
+def expand_inputs(inputs, **limits):
+    """把输入中的压缩包替换为其中的发票文件，保持原有顺序"""
+    expanded = []
+    for source in inputs:
+        if is_archive(input_name(source)):
+            expanded.extend(expand_archive(source, **limits))
+        else:
+            expanded.append(source)
+    return expanded
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""批量合并发票，适用于月末归档等一次处理上万张发票的场景
+
+    python batch.py --dir 发票/2024-06 -o 归档/2024-06.pdf -j 8 --max-pages 500
+    python batch.py --manifest 清单.txt -o 归档/2024-06.pdf --max-mb 50
+
+处理分为两个阶段：
+1. 准备：并行读取每张发票，PDF渲染、图片缩小和编码的结果保存到工作目录，每完成一张写入一条检查点记录；
+2. 生成：按页数或估算大小把准备好的发票分成若干份，并行生成输出PDF，每完成一份写入一条检查点记录。
+
+中断后使用相同的参数重新运行，已准备好的发票和已生成的输出文件直接跳过，不会重新渲染；
+上次失败的文件会重新尝试。运行结束后在工作目录中写入 report.json，记录各阶段耗时、每份输出和失败的文件。
+"""
+import os
+import io
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import statistics
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from merge_invoices import (
+    InvoiceMerger, VectorPage, PDF_MODES, OUTPUT_PROFILES, DEFAULT_OUTPUT_PROFILE, DEFAULT_RASTER_DPI,
+    SLOT_WIDTH, SLOT_HEIGHT
+)
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff')
+CHECKPOINT_FILE = 'checkpoint.jsonl'
+REPORT_FILE = 'report.json'
+ARTIFACT_DIR = 'prepared'
+
+# 默认每份输出PDF的最大页数：生成一份输出时所有页面都保留在内存中直到写出，不分割时内存占用随批次大小无限增长
+DEFAULT_MAX_PAGES = 500
+
+# 按大小分割时每张发票在输出PDF中的额外开销（页面对象、内容流等）的估计值（字节）
+INVOICE_OVERHEAD_BYTES = 2048
+
+# 报告中列出的最慢文件数
+SLOWEST_COUNT = 10
+
+
+def read_manifest(path):
+    """读取清单文件：每行一个文件路径，忽略空行和 # 开头的注释，相对路径相对于清单文件所在目录"""
+    base = os.path.dirname(os.path.abspath(path))
+    files = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                files.append(os.path.normpath(os.path.join(base, line)))
+    return files
+
+
+def walk_directory(root, exclude=()):
+    """按路径排序递归列出目录下支持的发票文件，跳过 exclude 中的目录（例如工作目录）"""
+    exclude = {os.path.abspath(path) for path in exclude}
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(name for name in dirnames if os.path.abspath(os.path.join(dirpath, name)) not in exclude)
+        for name in sorted(filenames):
+            if name.lower().endswith(SUPPORTED_EXTENSIONS):
+                files.append(os.path.join(dirpath, name))
+    return files
+
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(value, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def merger_options(merger):
+    """影响准备结果的合并参数，参数变化后已有的准备结果失效"""
+    return {'pdf_mode': merger.pdf_mode, 'raster_dpi': merger.raster_dpi, 'profile': merger.profile,
+            'max_page_pixels': merger.max_page_pixels}
+
+
+def file_key(path, options):
+    """发票的检查点键：路径、大小、修改时间和合并参数，文件被修改后重新准备"""
+    stat = os.stat(path)
+    return _digest([os.path.abspath(path), stat.st_size, stat.st_mtime_ns, options])
+
+
+class Checkpoint:
+    """追加写入的检查点文件（JSON Lines），每行一条已完成的发票或输出记录
+
+    每条记录写入后立即刷新，进程被中断时最多丢失正在写入的一行，读取时忽略不完整的行
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.parts = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record.get('type') == 'file':
+                        self.files[record['key']] = record
+                    elif record.get('type') == 'part':
+                        self.parts[record['key']] = record
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def is_prepared(self, key):
+        record = self.files.get(key)
+        return (record is not None and record['status'] == 'ok'
+                and (record['artifact'] is None or os.path.exists(record['artifact'])))
+
+    def is_built(self, key, output):
+        record = self.parts.get(key)
+        return (record is not None and record['status'] == 'ok' and record['output'] == output
+                and os.path.exists(output) and os.path.getsize(output) == record['bytes'])
+
+    def record(self, record):
+        target = self.files if record['type'] == 'file' else self.parts
+        target[record['key']] = record
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# 工作进程中使用的合并器，由 _init_worker 设置
+_merger = None
+
+
+def _init_worker(merger):
+    global _merger
+    _merger = merger
+
+
+def _save_atomic(path, write):
+    temp_path = f'{path}.tmp'
+    write(temp_path)
+    os.replace(temp_path, path)
+
+
+def prepare_invoice(key, path, artifact_dir):
+    """准备单张发票，返回检查点记录
+
+    矢量PDF不需要预处理，生成阶段直接嵌入原文件；PDF渲染结果和图片按输出质量配置缩小、编码后
+    保存到 artifact_dir（照片为JPEG，线条图为PNG），生成阶段不再重新渲染
+    """
+    start = time.perf_counter()
+    record = {'type': 'file', 'key': key, 'path': path}
+    try:
+        item = _merger.load_file(path)
+        if item is None:
+            raise ValueError('无法读取文件')
+        if isinstance(item, VectorPage):
+            record.update(kind='vector', artifact=None, bytes=os.path.getsize(path))
+        else:
+            width, height = _merger.calculate_image_size(item, SLOT_WIDTH, SLOT_HEIGHT)
+            encoded = _merger.encode_image(item, width, height)
+            if isinstance(encoded, io.BytesIO):
+                artifact = os.path.join(artifact_dir, f'{key}.jpg')
+
+                def write(temp_path):
+                    with open(temp_path, 'wb') as f:
+                        f.write(encoded.getvalue())
+            else:
+                artifact = os.path.join(artifact_dir, f'{key}.png')
+
+                def write(temp_path):
+                    encoded.save(temp_path, 'PNG')
+            _save_atomic(artifact, write)
+            item.close()
+            kind = 'raster' if path.lower().endswith('.pdf') else 'image'
+            record.update(kind=kind, artifact=artifact, bytes=os.path.getsize(artifact))
+        record['status'] = 'ok'
+    except Exception as e:
+        logging.error(f"准备发票 {path} 时出错: {str(e)}")
+        record.update(status='failed', error=str(e))
+    record['seconds'] = round(time.perf_counter() - start, 4)
+    return record
+
+
+def build_part(key, sources, output):
+    """生成一份输出PDF，返回检查点记录；先写入临时文件，完成后再改名，中断时不会留下不完整的输出"""
+    start = time.perf_counter()
+    record = {'type': 'part', 'key': key, 'output': output, 'invoices': len(sources),
+              'pages': (len(sources) + 1) // 2}
+    try:
+        temp_output = f'{output}.tmp'
+        _merger.merge_files(sources, temp_output)
+        os.replace(temp_output, output)
+        record.update(status='ok', bytes=os.path.getsize(output))
+    except Exception as e:
+        logging.error(f"生成 {output} 时出错: {str(e)}")
+        record.update(status='failed', error=str(e))
+    record['seconds'] = round(time.perf_counter() - start, 4)
+    return record
+
+
+def _run_all(func, tasks, workers):
+    """执行 func(*task)，按完成顺序产出结果；workers 大于1时在进程池中并行，同时提交的任务不超过 workers 的四倍"""
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield func(*task)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(_merger,)) as executor:
+        pending = set()
+        tasks = iter(tasks)
+        while True:
+            for task in tasks:
+                pending.add(executor.submit(func, *task))
+                if len(pending) >= workers * 4:
+                    break
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def plan_parts(records, max_pages=None, max_bytes=None):
+    """按页数和估算大小把发票依次分成若干份，每页两张发票；单张发票超过大小上限时单独成为一份"""
+    per_part = max_pages * 2 if max_pages else None
+    parts = []
+    current, current_bytes = [], 0
+    for record in records:
+        size = record['bytes'] + INVOICE_OVERHEAD_BYTES
+        if current and ((per_part and len(current) >= per_part)
+                        or (max_bytes and current_bytes + size > max_bytes)):
+            parts.append(current)
+            current, current_bytes = [], 0
+        current.append(record)
+        current_bytes += size
+    if current:
+        parts.append(current)
+    return parts
+
+
+def part_outputs(output, count):
+    """输出文件路径：只有一份时为 output，分成多份时为 output 加序号，例如 2024-06_0001.pdf"""
+    if count <= 1:
+        return [output]
+    stem, ext = os.path.splitext(output)
+    return [f'{stem}_{index + 1:04d}{ext or ".pdf"}' for index in range(count)]
+
+
+def _summarize_seconds(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'total': round(sum(values), 3),
+        'mean': round(statistics.mean(values), 4),
+        'p50': round(values[len(values) // 2], 4),
+        'p95': round(values[min(len(values) - 1, int(len(values) * 0.95))], 4),
+        'max': round(values[-1], 4),
+    }
+
+
+def run_batch(input_files, output, merger, work_dir=None, workers=1, max_pages=DEFAULT_MAX_PAGES,
+              max_bytes=None, progress_callback=None):
+    """批量合并 input_files，返回运行报告（同时写入工作目录下的 report.json）
+
+    progress_callback(stage, current, total) 在每张发票准备完成和每份输出生成后调用
+    """
+    global _merger
+    _merger = merger
+    output = os.path.abspath(output)
+    work_dir = os.path.abspath(work_dir or os.path.splitext(output)[0] + '_batch')
+    artifact_dir = os.path.join(work_dir, ARTIFACT_DIR)
+    os.makedirs(artifact_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    started = time.perf_counter()
+    timings = {}
+    report = {'inputs': len(input_files), 'work_dir': work_dir, 'completed': False}
+    checkpoint = Checkpoint(os.path.join(work_dir, CHECKPOINT_FILE))
+    try:
+        # 计算每个文件的检查点键，无法访问的文件直接记为失败
+        options = merger_options(merger)
+        keys = []
+        failures = []
+        for path in input_files:
+            try:
+                keys.append(file_key(path, options))
+            except OSError as e:
+                keys.append(None)
+                failures.append({'path': path, 'error': str(e)})
+        tasks = {}
+        for key, path in zip(keys, input_files):
+            if key is not None and key not in tasks and not checkpoint.is_prepared(key):
+                tasks[key] = (key, path, artifact_dir)
+        report['resumed'] = len({key for key in keys if key is not None}) - len(tasks)
+        timings['scan'] = time.perf_counter() - started
+
+        stage_start = time.perf_counter()
+        prepared = []
+        for index, record in enumerate(_run_all(prepare_invoice, list(tasks.values()), workers)):
+            checkpoint.record(record)
+            prepared.append(record)
+            if progress_callback:
+                progress_callback('prepare', index + 1, len(tasks))
+        timings['prepare'] = time.perf_counter() - stage_start
+
+        records = []
+        for key, path in zip(keys, input_files):
+            if key is None:
+                continue
+            record = checkpoint.files.get(key)
+            if record is not None and record['status'] == 'ok':
+                records.append(record)
+            else:
+                failures.append({'path': path, 'error': record['error'] if record else '未处理'})
+
+        stage_start = time.perf_counter()
+        parts = plan_parts(records, max_pages, max_bytes)
+        outputs = part_outputs(output, len(parts))
+        part_tasks = []
+        part_keys = []
+        for part, part_output in zip(parts, outputs):
+            key = _digest([[record['key'] for record in part], part_output])
+            part_keys.append(key)
+            if not checkpoint.is_built(key, part_output):
+                sources = [record['artifact'] or record['path'] for record in part]
+                part_tasks.append((key, sources, part_output))
+        for index, record in enumerate(_run_all(build_part, part_tasks, workers)):
+            checkpoint.record(record)
+            if progress_callback:
+                progress_callback('assemble', index + 1, len(part_tasks))
+        timings['assemble'] = time.perf_counter() - stage_start
+
+        part_records = [checkpoint.parts[key] for key in part_keys]
+        report.update({
+            'succeeded': len(records),
+            'failed': len(failures),
+            'kinds': {kind: sum(1 for record in records if record['kind'] == kind)
+                      for kind in ('vector', 'raster', 'image')},
+            'outputs': [{name: record.get(name) for name in
+                         ('output', 'invoices', 'pages', 'bytes', 'seconds', 'status', 'error')}
+                        for record in part_records],
+            'failures': failures,
+            'prepare_seconds': _summarize_seconds([record['seconds'] for record in prepared]),
+            'slowest': [{'path': record['path'], 'seconds': record['seconds']} for record in
+                        sorted(prepared, key=lambda record: record['seconds'], reverse=True)[:SLOWEST_COUNT]],
+            'completed': all(record['status'] == 'ok' for record in part_records),
+        })
+        return report
+    finally:
+        checkpoint.close()
+        timings['total'] = time.perf_counter() - started
+        report['timings'] = {name: round(seconds, 3) for name, seconds in timings.items()}
+        with open(os.path.join(work_dir, REPORT_FILE), 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量合并发票：支持清单文件、目录遍历、断点续跑和输出分割')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--manifest', help='清单文件，每行一个文件路径')
+    source.add_argument('--dir', help='递归处理目录下所有的PDF和图片文件')
+    parser.add_argument('-o', '--output', required=True, help='输出PDF文件路径，分割时在文件名后加序号')
+    parser.add_argument('--work-dir', help='保存检查点、准备结果和报告的目录（默认为输出文件名加 _batch）')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='并行处理的进程数（默认为CPU核数）')
+    parser.add_argument('--max-pages', type=int, default=DEFAULT_MAX_PAGES,
+                        help=f'每份输出PDF的最大页数（默认 {DEFAULT_MAX_PAGES}，0 表示不按页数分割，内存占用随批次增长）')
+    parser.add_argument('--max-mb', type=float, help='每份输出PDF的估算大小上限（MB）')
+    parser.add_argument('--pdf-mode', choices=PDF_MODES, default='vector',
+                        help='PDF处理模式：vector 直接嵌入矢量页面（默认），raster 转换为图片')
+    parser.add_argument('--dpi', type=int, default=DEFAULT_RASTER_DPI,
+                        help='位图模式下发票在输出页面上的分辨率（不超过输出质量配置的分辨率）')
+    parser.add_argument('--profile', choices=sorted(OUTPUT_PROFILES), default=DEFAULT_OUTPUT_PROFILE,
+                        help=f'输出质量配置（默认 {DEFAULT_OUTPUT_PROFILE}）')
+    parser.add_argument('--no-optimize', dest='optimize', action='store_false',
+                        help='不对输出PDF做去重和资源清理等后处理')
+    parser.add_argument('-v', '--verbose', action='store_true', help='输出每个文件的处理日志')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    def progress_callback(stage, current, total):
+        label = '准备发票' if stage == 'prepare' else '生成PDF'
+        print(f"\r{label}：{current}/{total}", end='' if current < total else '\n')
+
+    try:
+        if args.manifest:
+            input_files = read_manifest(args.manifest)
+        else:
+            exclude = [args.work_dir or os.path.splitext(os.path.abspath(args.output))[0] + '_batch']
+            input_files = walk_directory(args.dir, exclude)
+        if not input_files:
+            raise ValueError('没有找到需要处理的文件')
+        print(f"共 {len(input_files)} 个文件")
+
+        # 准备结果已保存在工作目录中，不再使用渲染缓存
+        merger = InvoiceMerger(pdf_mode=args.pdf_mode, raster_dpi=args.dpi, cache_max_bytes=0,
+                               profile=args.profile, optimize=args.optimize)
+        report = run_batch(input_files, args.output, merger, work_dir=args.work_dir, workers=args.workers,
+                           max_pages=args.max_pages or None,
+                           max_bytes=int(args.max_mb * 1024 * 1024) if args.max_mb else None,
+                           progress_callback=progress_callback)
+    except Exception as e:
+        print(f"错误：{str(e)}")
+        sys.exit(1)
+
+    print(f"成功 {report['succeeded']} 个（其中 {report['resumed']} 个沿用上次的结果），失败 {report['failed']} 个")
+    for output in report['outputs']:
+        if output['status'] == 'ok':
+            print(f"  {output['output']}：{output['pages']} 页，{output['bytes'] / 1024 / 1024:.1f}MB")
+        else:
+            print(f"  {output['output']}：生成失败 - {output['error']}")
+    timings = report['timings']
+    print(f"耗时：准备 {timings['prepare']:.1f}s，生成 {timings['assemble']:.1f}s，共 {timings['total']:.1f}s")
+    print(f"报告：{os.path.join(report['work_dir'], REPORT_FILE)}")
+    # 部分文件失败时返回2，便于脚本判断
+    if report['failed'] or not report['completed']:
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
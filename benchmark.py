@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""发票合并性能基准测试
+
+生成确定性的测试语料（矢量PDF、多页PDF、大尺寸JPEG扫描件、带透明通道的PNG、TIFF），
+分阶段统计 merge_files、merge_invoices 和 /upload 接口的耗时和峰值内存，
+结果写入JSON文件，便于在不同提交之间比较。
+
+    python benchmark.py -o results.json
+    python benchmark.py -o new.json --compare old.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import platform
+import argparse
+import resource
+import statistics
+import subprocess
+import tempfile
+import multiprocessing
+from PIL import Image, ImageDraw, ImageFilter, features
+from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import A5, landscape
+
+# 语料格式版本，生成方式改变时递增，避免复用旧语料
+CORPUS_VERSION = 1
+DEFAULT_SEED = 20240101
+DEFAULT_COUNT = 4
+
+# 语料类型及文件扩展名
+CORPUS_KINDS = {
+    'vector': '.pdf',
+    'multipage': '.pdf',
+    'jpeg_scan': '.jpg',
+    'png_alpha': '.png',
+    'tiff': '.tiff',
+}
+
+# 以下方法的耗时计入对应阶段，其余时间计为版面绘制和写入（layout_write）。
+# 图片在读取后立即编码（load_encoded），encode_image 嵌套在读取中，其耗时只计入 encode
+MERGER_STAGES = {
+    'load_file': 'load',
+    'encode_image': 'encode',
+    '_stamped_writer': 'stamp',
+    '_optimize_page': 'optimize',
+}
+
+
+def _noise(rng, size, sigma):
+    """由种子确定的灰度噪声图"""
+    noise = Image.frombytes('L', size, rng.randbytes(size[0] * size[1]))
+    return noise.filter(ImageFilter.GaussianBlur(sigma))
+
+
+def _draw_invoice_text(draw, rng, width, height, scale, fill):
+    """绘制发票样式的文字和表格线"""
+    step = int(28 * scale)
+    for row in range(int(height * 0.1), int(height * 0.9), step):
+        amount = rng.randint(1, 99999) / 100
+        draw.text((int(width * 0.08), row), f'ITEM-{rng.randint(1000, 9999)}  QTY {rng.randint(1, 9)}  {amount:.2f}',
+                  fill=fill)
+        draw.line((int(width * 0.06), row + step - 4, int(width * 0.94), row + step - 4), fill=fill, width=1)
+
+
+def make_vector_pdf(path, rng, pages=1):
+    """reportlab 生成的矢量发票"""
+    c = canvas.Canvas(path, pagesize=landscape(A5), invariant=1)
+    width, height = landscape(A5)
+    for page in range(pages):
+        c.setFont('Helvetica-Bold', 16)
+        c.drawString(40, height - 50, f'INVOICE No. {rng.randint(10000000, 99999999)} ({page + 1}/{pages})')
+        c.setFont('Helvetica', 9)
+        for row in range(12):
+            y = height - 90 - row * 22
+            c.line(40, y - 6, width - 40, y - 6)
+            c.drawString(45, y, f'Item {row + 1}')
+            c.drawRightString(width - 45, y, f'{rng.randint(1, 99999) / 100:.2f}')
+        c.setStrokeColorRGB(0.8, 0, 0)
+        c.circle(width - 110, 80, 45)
+        c.setStrokeColorRGB(0, 0, 0)
+        c.showPage()
+    c.save()
+
+
+def make_jpeg_scan(path, rng, scale):
+    """A4 300DPI 的手机拍摄/扫描件：纸张渐变、噪声和深色文字"""
+    size = (int(2480 * scale), int(3508 * scale))
+    paper = Image.linear_gradient('L').resize(size).point(lambda v: 200 + v // 5)
+    image = Image.merge('RGB', (paper, paper, paper.point(lambda v: v - 15)))
+    image = Image.blend(image, _noise(rng, size, 1.5).convert('RGB'), 0.15)
+    _draw_invoice_text(ImageDraw.Draw(image), rng, size[0], size[1], scale * 3, (40, 40, 60))
+    image.save(path, 'JPEG', quality=92)
+
+
+def make_png_alpha(path, rng, scale):
+    """带透明通道的印章图片"""
+    side = int(1200 * scale)
+    image = Image.new('RGBA', (side, side), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    margin = side // 20
+    draw.ellipse((margin, margin, side - margin, side - margin), outline=(200, 20, 20, 230), width=max(2, side // 40))
+    draw.text((side // 3, side // 2), f'SEAL {rng.randint(100, 999)}', fill=(200, 20, 20, 255))
+    image.save(path, 'PNG')
+
+
+def make_tiff(path, rng, scale):
+    """灰度线条图扫描件"""
+    size = (int(2480 * scale), int(3508 * scale))
+    image = Image.new('L', size, 255)
+    _draw_invoice_text(ImageDraw.Draw(image), rng, size[0], size[1], scale * 3, 0)
+    compression = 'tiff_deflate' if features.check('libtiff') else None
+    image.save(path, 'TIFF', compression=compression)
+
+
+def build_corpus(corpus_dir, seed=DEFAULT_SEED, count=DEFAULT_COUNT, scale=1.0):
+    """生成确定性的测试语料，已存在时直接复用，返回 {类型: [文件路径]}"""
+    corpus_dir = os.path.join(corpus_dir, f'v{CORPUS_VERSION}_s{seed}_n{count}_x{scale}')
+    os.makedirs(corpus_dir, exist_ok=True)
+    corpus = {}
+    for kind, ext in CORPUS_KINDS.items():
+        corpus[kind] = []
+        for i in range(count):
+            path = os.path.join(corpus_dir, f'{kind}_{i}{ext}')
+            corpus[kind].append(path)
+            if os.path.exists(path):
+                continue
+            rng = random.Random(f'{seed}-{kind}-{i}')
+            temp_path = f'{path}.tmp{ext}'
+            if kind == 'vector':
+                make_vector_pdf(temp_path, rng)
+            elif kind == 'multipage':
+                make_vector_pdf(temp_path, rng, pages=3)
+            elif kind == 'jpeg_scan':
+                make_jpeg_scan(temp_path, rng, scale)
+            elif kind == 'png_alpha':
+                make_png_alpha(temp_path, rng, scale)
+            else:
+                make_tiff(temp_path, rng, scale)
+            os.replace(temp_path, path)
+    corpus['mixed'] = [path for i in range(count) for kind in CORPUS_KINDS for path in corpus[kind][i:i + 1]]
+    return corpus
+
+
+def instrument(merger, stages):
+    """包装 merger 的各阶段方法，把耗时累加到 stages
+
+    包装后的实例不能再传给子进程，因此分阶段计时只适用于 workers=1。
+    阶段方法相互嵌套时只计各自除去内层阶段之后的耗时，同一段时间不会重复计入
+    """
+    nested = []  # 正在执行的各阶段中内层阶段的累计耗时
+
+    for method, stage in MERGER_STAGES.items():
+        func = getattr(merger, method)
+
+        def timed(*args, _func=func, _stage=stage, **kwargs):
+            start = time.perf_counter()
+            nested.append(0.0)
+            try:
+                return _func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                stages[_stage] = stages.get(_stage, 0.0) + elapsed - nested.pop()
+                if nested:
+                    nested[-1] += elapsed
+
+        setattr(merger, method, timed)
+    return merger
+
+
+def _finish_stages(stages, total):
+    if stages:
+        stages['layout_write'] = max(0.0, total - sum(stages.values()))
+    stages['total'] = total
+    return stages
+
+
+def run_merge_files(files, options, work_dir):
+    from merge_invoices import InvoiceMerger
+    stages = {}
+    merger = InvoiceMerger(**options)
+    if merger.workers == 1:
+        instrument(merger, stages)
+    output = os.path.join(work_dir, 'merge_files.pdf')
+    start = time.perf_counter()
+    merger.merge_files(files, output)
+    return _finish_stages(stages, time.perf_counter() - start), os.path.getsize(output)
+
+
+def run_merge_invoices(files, options, work_dir):
+    from werkzeug.datastructures import FileStorage
+    from merge_invoices import InvoiceMerger
+    stages = {}
+    merger = InvoiceMerger(**options)
+    if merger.workers == 1:
+        instrument(merger, stages)
+    uploads = [FileStorage(open(path, 'rb'), filename=os.path.basename(path)) for path in files]
+    output = os.path.join(work_dir, 'merge_invoices.pdf')
+    try:
+        start = time.perf_counter()
+        merger.merge_invoices(uploads, output)
+        total = time.perf_counter() - start
+    finally:
+        for upload in uploads:
+            upload.close()
+    return _finish_stages(stages, total), os.path.getsize(output)
+
+
+def run_upload(files, options, work_dir):
+    """通过 Flask 测试客户端调用 /upload，等待后台任务完成后下载结果"""
+    workers = options.get('workers', 1)
+    # 单进程时在任务线程中处理，便于分阶段计时；否则使用指定大小的CPU进程池
+    os.environ['CPU_POOL_SIZE'] = str(workers if workers > 1 else 0)
+    import app as app_module
+    stages = {}
+    create_merger = app_module.create_merger
+
+    def instrumented_merger(*args, **kwargs):
+        merger = create_merger(*args, **kwargs)
+        return instrument(merger, stages) if merger.executor is None else merger
+
+    app_module.create_merger = instrumented_merger
+    app_module.app.config['OUTPUT_PROFILE'] = options.get('profile', app_module.DEFAULT_OUTPUT_PROFILE)
+    client = app_module.app.test_client()
+
+    data = {'files[]': [(open(path, 'rb'), os.path.basename(path)) for path in files]}
+    start = time.perf_counter()
+    response = client.post('/upload', data=data, content_type='multipart/form-data')
+    upload_done = time.perf_counter()
+    if response.status_code != 202:
+        raise RuntimeError(f"/upload 返回 {response.status_code}: {response.get_data(as_text=True)}")
+    task_id = response.get_json()['task_id']
+
+    while True:
+        status = client.get(f'/jobs/{task_id}').get_json()
+        if status['status'] in app_module.FINISHED_STATES:
+            break
+        time.sleep(0.005)
+    job_done = time.perf_counter()
+    if status['status'] != 'completed':
+        raise RuntimeError(f"任务未完成: {status}")
+
+    result = client.get(f'/jobs/{task_id}/result')
+    size = len(result.get_data())
+    result.close()
+    end = time.perf_counter()
+
+    stages['upload_request'] = upload_done - start
+    stages['job'] = job_done - upload_done
+    stages['download'] = end - job_done
+    stages['total'] = end - start
+    return stages, size
+
+
+TARGETS = {
+    'merge_files': run_merge_files,
+    'merge_invoices': run_merge_invoices,
+    'upload': run_upload,
+}
+
+
+def _run_case(queue, target, files, options):
+    """在独立进程中运行一个用例，使峰值内存只反映该用例"""
+    try:
+        work_dir = tempfile.mkdtemp(prefix='bench_')
+        os.environ['UPLOAD_FOLDER'] = work_dir
+        logging.disable(logging.INFO)
+        # 由 spawn 启动的进程默认也用 spawn 创建子进程，改回与生产环境一致的 fork
+        multiprocessing.set_start_method('fork', force=True)
+        stages, output_bytes = TARGETS[target](files, options, work_dir)
+        # ru_maxrss 在 Linux 上以KB为单位；子进程（并行渲染进程池）的峰值单独统计
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        queue.put({
+            'stages': stages,
+            'output_bytes': output_bytes,
+            'peak_rss_bytes': usage.ru_maxrss * 1024,
+            'children_peak_rss_bytes': children.ru_maxrss * 1024,
+        })
+    except Exception as e:
+        queue.put({'error': f'{type(e).__name__}: {e}'})
+
+
+def run_case(target, files, options, repeat):
+    """重复运行用例，各阶段取中位数，峰值内存取最大值"""
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    for _ in range(repeat):
+        queue = context.Queue()
+        process = context.Process(target=_run_case, args=(queue, target, files, options))
+        process.start()
+        result = queue.get()
+        process.join()
+        if 'error' in result:
+            return result
+        runs.append(result)
+
+    stage_names = sorted({name for run in runs for name in run['stages']})
+    return {
+        'stages': {name: statistics.median(run['stages'].get(name, 0.0) for run in runs) for name in stage_names},
+        'output_bytes': runs[-1]['output_bytes'],
+        'peak_rss_bytes': max(run['peak_rss_bytes'] for run in runs),
+        'children_peak_rss_bytes': max(run['children_peak_rss_bytes'] for run in runs),
+        'runs': [run['stages']['total'] for run in runs],
+    }
+
+
+def plan_cases(corpus, workers):
+    """生成用例列表：(名称, 目标, 语料类型, 参数)"""
+    cases = [(f'merge_files/{kind}', 'merge_files', kind, {}) for kind in corpus]
+    if workers > 1:
+        cases.append((f'merge_files/mixed/j{workers}', 'merge_files', 'mixed', {'workers': workers}))
+    cases.append(('merge_invoices/mixed', 'merge_invoices', 'mixed', {}))
+    cases.append(('upload/mixed', 'upload', 'mixed', {}))
+    return cases
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """打印与基准结果相比的耗时和峰值内存变化"""
+    previous = {case['name']: case for case in baseline['cases']}
+    print(f"\n与 {baseline['meta'].get('revision') or '基准'} 比较：")
+    for case in results['cases']:
+        old = previous.get(case['name'])
+        if not old or 'error' in case or 'error' in old:
+            continue
+        ratio = case['stages']['total'] / old['stages']['total'] if old['stages']['total'] else float('nan')
+        rss = case['peak_rss_bytes'] / old['peak_rss_bytes'] if old['peak_rss_bytes'] else float('nan')
+        print(f"  {case['name']:<32} 耗时 x{ratio:.2f}  峰值内存 x{rss:.2f}  "
+              f"输出 {old['output_bytes']} -> {case['output_bytes']} 字节")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='发票合并性能基准测试')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='结果JSON文件路径')
+    parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'invoice_bench_corpus'),
+                        help='测试语料目录，已生成的语料会被复用')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='语料随机种子')
+    parser.add_argument('--count', type=int, default=DEFAULT_COUNT, help='每种类型生成的文件数')
+    parser.add_argument('--scale', type=float, default=1.0, help='位图尺寸缩放比例，1.0 为 A4 300DPI')
+    parser.add_argument('--repeat', type=int, default=3, help='每个用例重复运行的次数')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='额外运行一次并行合并用例时的进程数，1 表示不运行')
+    parser.add_argument('--profile', help='输出质量配置，默认使用 InvoiceMerger 的默认值')
+    parser.add_argument('--case', action='append', help='只运行名称包含该字符串的用例，可重复指定')
+    parser.add_argument('--compare', help='与之前的结果JSON比较')
+    args = parser.parse_args()
+
+    print('生成测试语料...')
+    corpus = build_corpus(args.corpus_dir, args.seed, args.count, args.scale)
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'seed': args.seed,
+            'count': args.count,
+            'scale': args.scale,
+            'repeat': args.repeat,
+            'corpus_bytes': {kind: sum(os.path.getsize(path) for path in paths) for kind, paths in corpus.items()},
+        },
+        'cases': [],
+    }
+
+    for name, target, kind, options in plan_cases(corpus, args.workers):
+        if args.case and not any(pattern in name for pattern in args.case):
+            continue
+        if args.profile:
+            options = dict(options, profile=args.profile)
+        result = run_case(target, corpus[kind], options, args.repeat)
+        result.update({'name': name, 'target': target, 'corpus': kind, 'files': len(corpus[kind]),
+                       'options': options})
+        results['cases'].append(result)
+        if 'error' in result:
+            print(f"  {name:<32} 出错: {result['error']}")
+        else:
+            stages = '  '.join(f'{stage}={seconds:.3f}s' for stage, seconds in result['stages'].items()
+                               if stage != 'total')
+            print(f"  {name:<32} {result['stages']['total']:.3f}s  "
+                  f"峰值内存 {result['peak_rss_bytes'] / 1024 / 1024:.0f}MB  {stages}")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"结果已写入: {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
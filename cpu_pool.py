@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+def default_pool_size():
+    """默认进程数等于CPU核数"""
+    return os.cpu_count() or 1
+
+
+class CpuPool:
+    """进程内共享的固定大小CPU进程池
+
+    PDF渲染、图片解码等CPU密集的工作提交到这里执行，处理HTTP请求的线程只负责接收上传和发送结果，
+    合并再繁忙也不会占满请求线程。所有任务共用同一个进程池，进程总数固定为 size，不随并发任务数增长。
+
+    同时提交的工作（执行中和排队中）不超过 size + queue_depth，超出时 submit 阻塞，直到有工作完成。
+    进程池在第一次提交时才创建，gunicorn 的 preload_app 在主进程中导入应用时不会启动子进程，
+    fork 出的每个工作进程各自创建自己的进程池。
+    子进程通过 forkserver 启动：gthread 工作进程是多线程的，直接 fork 会把其他线程持有的锁
+    （日志、内存分配器等）带入子进程，子进程可能永远等不到这些锁被释放。
+    """
+
+    def __init__(self, size=None, queue_depth=None):
+        self.size = size if size is not None else default_pool_size()
+        if self.size < 1:
+            raise ValueError(f"无效的进程池大小: {self.size}")
+        self.queue_depth = queue_depth if queue_depth is not None else self.size * 2
+        if self.queue_depth < 0:
+            raise ValueError(f"无效的队列深度: {self.queue_depth}")
+        self._slots = threading.BoundedSemaphore(self.size + self.queue_depth)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.size, mp_context=multiprocessing.get_context('forkserver'))
+                self._pid = os.getpid()
+                logging.info(f"CPU进程池已启动: {self.size} 个进程，队列深度 {self.queue_depth}")
+            return self._executor
+
+    def _reset(self, executor):
+        """子进程异常退出（例如内存不足被杀死）后丢弃损坏的进程池，下次提交时重新创建"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, func, *args):
+        """提交工作，返回 Future；队列已满时阻塞等待"""
+        self._slots.acquire()
+        try:
+            executor = self._get_executor()
+            try:
+                future = executor.submit(func, *args)
+            except BrokenProcessPool:
+                logging.warning("CPU进程池已损坏，重新创建")
+                self._reset(executor)
+                executor = self._get_executor()
+                future = executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+
+        def on_done(done):
+            self._slots.release()
+            if not done.cancelled() and isinstance(done.exception(), BrokenProcessPool):
+                self._reset(executor)
+
+        future.add_done_callback(on_done)
+        return future
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
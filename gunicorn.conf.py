@@ -1,10 +1,22 @@
+import os
+import shutil
+import tempfile
 import multiprocessing
 
-# 工作进程数
-workers = multiprocessing.cpu_count() * 2 + 1
+# HTTP工作进程数：只负责接收上传、查询进度和发送结果，少量进程即可
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+# 应用按工作进程数平分准入预算
+os.environ['GUNICORN_WORKERS'] = str(workers)
 
-# 工作模式
-worker_class = 'sync'
+# 渲染和解码在每个工作进程的CPU进程池中执行，默认按工作进程数平分CPU核，避免超额占用
+os.environ.setdefault('CPU_POOL_SIZE', str(max(1, multiprocessing.cpu_count() // workers)))
+
+# 工作模式：使用线程处理请求，进度推送（SSE）的长连接只占用一个线程而不是整个工作进程
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+
+# 在主进程中预先加载应用（包括字体），工作进程 fork 后共享这部分内存
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
 
 # 超时设置
 timeout = 300  # 5分钟
@@ -22,3 +34,18 @@ bind = '0.0.0.0:8080'
 limit_request_line = 0
 limit_request_field_size = 0
 limit_request_fields = 0
+
+# 运行指标：所有工作进程把指标写入同一目录，由 /metrics 汇总。
+# preload_app 时应用（以及 metrics 模块）在任何服务器钩子之前就已导入，目录必须在这里创建；
+# 配置文件在重新加载（HUP）时会再次执行，只在第一次执行时清空上次运行遗留的指标文件
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'invoice_metrics'))
+if os.environ.get('INVOICE_METRICS_DIR_READY') != os.environ['PROMETHEUS_MULTIPROC_DIR']:
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+    os.environ['INVOICE_METRICS_DIR_READY'] = os.environ['PROMETHEUS_MULTIPROC_DIR']
+
+
+def child_exit(server, worker):
+    """工作进程退出后清理其实时指标"""
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import io
+import os
+
+
+class InvoiceInput:
+    """以文件流形式提供的发票（例如上传的文件），无需先保存到磁盘
+
+    stream 可以是内存缓冲区或 SpooledTemporaryFile：小文件完全保存在内存中，
+    大文件才会写入临时文件。跨进程传递时以字节内容序列化。
+    """
+
+    def __init__(self, filename, stream):
+        self.filename = filename
+        self.stream = stream
+
+    def open(self):
+        """返回定位到开头的文件流"""
+        self.stream.seek(0)
+        return self.stream
+
+    def read(self):
+        return self.open().read()
+
+    def close(self):
+        self.stream.close()
+
+    def release(self):
+        """释放可以重新生成的数据（例如从压缩包解压出的内容），上传的文件流没有可释放的数据"""
+
+    def __getstate__(self):
+        return {'filename': self.filename, 'data': self.read()}
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self.stream = io.BytesIO(state['data'])
+
+    def __repr__(self):
+        return f"InvoiceInput({self.filename!r})"
+
+
+def as_input(file):
+    """上传的文件（FileStorage）转换为 InvoiceInput，已经是 InvoiceInput 的保持不变"""
+    if isinstance(file, InvoiceInput):
+        return file
+    return InvoiceInput(os.path.basename(file.filename), file.stream)
+
+
+def input_name(source):
+    """发票文件名，source 为文件路径或 InvoiceInput"""
+    if isinstance(source, InvoiceInput):
+        return source.filename
+    return os.path.basename(source)
+
+
+def open_input(source):
+    """返回可供 PIL、PyPDF2 和 reportlab 读取的对象：文件路径或定位到开头的文件流"""
+    if isinstance(source, InvoiceInput):
+        return source.open()
+    return source
+
+
+def input_size(source):
+    """输入文件的字节数"""
+    if isinstance(source, InvoiceInput):
+        stream = source.open()
+        stream.seek(0, os.SEEK_END)
+        return stream.tell()
+    return os.path.getsize(source)
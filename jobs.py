@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from status_store import MemoryStatusStore
+
+# 任务的终止状态
+FINISHED_STATES = ('completed', 'error', 'cancelled')
+
+
+class JobCancelled(Exception):
+    """任务已被取消"""
+
+
+class JobManager:
+    """后台合并任务管理
+
+    合并任务在独立的线程池中执行，请求线程提交任务后立即返回，
+    之后通过任务ID查询进度、下载结果或取消任务。任务状态保存在 store 中，
+    使用共享存储时可以从任意工作进程查询或取消任务。
+    """
+
+    def __init__(self, max_workers=2, store=None):
+        self.store = store if store is not None else MemoryStatusStore()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='merge-job')
+        self._futures = {}
+        self._cancel_events = {}
+        self._lock = threading.Lock()
+        # 状态变化通知，供进度推送等待本进程内的更新
+        self._changed = threading.Condition()
+
+    def create(self, task_id, **fields):
+        """登记新任务"""
+        status = {
+            'status': 'queued',
+            'progress': 0,
+            'current_file': '',
+            'message': '等待处理...',
+        }
+        status.update(fields)
+        self.store.set(task_id, status)
+        self._notify()
+
+    def get(self, task_id):
+        """获取任务状态，任务不存在时返回None"""
+        return self.store.get(task_id)
+
+    def update(self, task_id, **fields):
+        """更新任务状态"""
+        self.store.update(task_id, **fields)
+        self._notify()
+
+    def _notify(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    def wait_for_update(self, timeout):
+        """等待本进程内的任务状态更新，最多等待 timeout 秒
+
+        其他工作进程中的更新不会触发通知，调用方需要在超时后重新读取状态
+        """
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def submit(self, task_id, func, *args):
+        """提交任务，在后台线程中执行 func(task_id, *args)，返回任务的 Future
+
+        任务执行结束或在开始前被取消时 Future 都会完成
+        """
+        event = threading.Event()
+        with self._lock:
+            self._cancel_events[task_id] = event
+            future = self._futures[task_id] = self._executor.submit(self._run, task_id, func, *args)
+        return future
+
+    def _run(self, task_id, func, *args):
+        try:
+            self.check_cancelled(task_id)
+            func(task_id, *args)
+        except JobCancelled:
+            logging.info(f"任务已取消: {task_id}")
+            self.update(task_id, status='cancelled', message='任务已取消')
+        except Exception as e:
+            logging.error(f"任务 {task_id} 处理出错: {str(e)}", exc_info=True)
+            self.update(task_id, status='error', message=f'处理出错: {str(e)}')
+        finally:
+            with self._lock:
+                self._futures.pop(task_id, None)
+                self._cancel_events.pop(task_id, None)
+
+    def check_cancelled(self, task_id):
+        """任务已被取消时抛出 JobCancelled，供进度回调调用
+
+        取消请求可能来自其他工作进程，因此同时检查存储中的取消标记
+        """
+        event = self._cancel_events.get(task_id)
+        if event is not None and event.is_set():
+            raise JobCancelled(task_id)
+        status = self.store.get(task_id)
+        if status is not None and status.get('cancel_requested'):
+            if event is not None:
+                event.set()
+            raise JobCancelled(task_id)
+
+    def cancel(self, task_id):
+        """取消任务，返回是否成功发出取消请求"""
+        status = self.store.get(task_id)
+        if status is None or status['status'] in FINISHED_STATES:
+            return False
+        self.update(task_id, cancel_requested=True, message='正在取消...')
+
+        with self._lock:
+            event = self._cancel_events.get(task_id)
+            future = self._futures.get(task_id)
+        if event is not None:
+            event.set()
+        if future is not None and future.cancel():
+            # 任务尚未开始执行，直接标记为已取消
+            with self._lock:
+                self._futures.pop(task_id, None)
+                self._cancel_events.pop(task_id, None)
+            self.update(task_id, status='cancelled', message='任务已取消')
+        return True
@@ -2,16 +2,37 @@
 import os
 import sys
 from PIL import Image
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, convert_from_bytes, pdfinfo_from_path
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
+import io
 import tempfile
 import logging
 import argparse
-import shutil
+import re
+import math
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from reportlab.lib.utils import ImageReader
+from reportlab import rl_config
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
+from PyPDF2 import PdfReader, PdfWriter
+from raster_cache import RasterCache, DEFAULT_CACHE_MAX_BYTES
+from pdf_optimizer import PdfOptimizer
+from pdf_incremental import IncrementalUpdate
+from pdf_stream import PdfStreamWriter
+from invoice_input import InvoiceInput, as_input, input_name, open_input, input_size
+from archives import expand_inputs
+import metrics
+from PyPDF2.generic import (
+    ArrayObject, ContentStream, DecodedStreamObject, DictionaryObject, FloatObject, IndirectObject, NameObject,
+    NumberObject, StreamObject
+)
+
+# 图片数据直接以二进制流写入PDF，不再做会使体积增加约25%的ASCII85编码
+rl_config.useA85 = 0
 
 # 设置日志记录
 logging.basicConfig(
@@ -19,45 +40,315 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-class InvoiceMerger:
-    def __init__(self):
-        self.temp_dir = os.getenv('UPLOAD_FOLDER', tempfile.mkdtemp())
-        os.makedirs(self.temp_dir, exist_ok=True)
-        os.chmod(self.temp_dir, 0o777)  # 确保目录有正确的权限
-        
-        # 注册中文字体
+# PDF处理模式：vector 直接嵌入矢量页面，raster 转换为位图
+PDF_MODES = ('vector', 'raster')
+
+# 页面布局：每页上下放置两张发票
+PAGE_MARGIN = 20  # 页边距
+IMAGE_SPACING = 20  # 图片间距
+SLOT_WIDTH = A4[0] - 2 * PAGE_MARGIN  # 每张发票的最大宽度
+SLOT_HEIGHT = (A4[1] - 2 * PAGE_MARGIN - IMAGE_SPACING) / 2  # 每张发票的最大高度
+
+# 注释标志：隐藏（Hidden）和不显示（NoView）的注释不嵌入输出
+ANNOT_FLAG_HIDDEN = 2
+ANNOT_FLAG_NO_VIEW = 32
+
+# 位图模式下发票在输出页面上的有效分辨率（像素/英寸）
+DEFAULT_RASTER_DPI = 300
+MIN_RENDER_DPI = 72
+MAX_RENDER_DPI = 600
+
+# 像素预算：单张发票渲染或解码后的像素数上限（RGB每像素3字节，5000万像素约150MB），
+# 以及一个合并任务中同时解码的所有发票的像素数上限（按单张上限计算，用于限制并行提交的文件数）
+DEFAULT_MAX_PAGE_PIXELS = 50_000_000
+DEFAULT_MAX_JOB_PIXELS = 200_000_000
+
+# 输出质量配置：dpi 为图片在输出页面上的最高有效分辨率，
+# jpeg_quality 为照片类图片的JPEG质量，None 表示所有图片都使用无损的Flate编码
+OUTPUT_PROFILES = {
+    'screen': {'dpi': 100, 'jpeg_quality': 60},
+    'print': {'dpi': 200, 'jpeg_quality': 85},
+    'archive': {'dpi': 300, 'jpeg_quality': None},
+}
+DEFAULT_OUTPUT_PROFILE = 'print'
+
+
+def slot_pixel_size(profile):
+    """发票位置在输出质量配置的有效分辨率下的像素尺寸 (宽, 高)
+
+    超过该尺寸的图片在 encode_image 中会被缩小；按该尺寸等比缩小后的JPEG不会再被缩小和重新压缩，
+    浏览器端上传前据此预先缩小图片
+    """
+    dpi = OUTPUT_PROFILES[profile]['dpi']
+    return math.floor(SLOT_WIDTH * dpi / 72), math.floor(SLOT_HEIGHT * dpi / 72)
+
+# 线条图（文字、表格等）的像素集中在少数几种颜色上：
+# 量化后出现最多的 LINE_ART_COLORS 种颜色覆盖的像素比例不低于该值时视为线条图
+LINE_ART_COLORS = 8
+LINE_ART_COVERAGE = 0.8
+
+
+def is_photographic(image):
+    """粗略判断图片是否为照片等连续色调图像
+
+    取最多128x128的采样点，颜色量化到每通道32级后统计颜色分布
+    """
+    sample = image.resize((min(image.width, 128), min(image.height, 128)), Image.NEAREST)
+    sample = sample.convert('RGB').point(lambda v: v & 0xF8)
+    counts = sorted((count for count, _ in sample.getcolors(sample.width * sample.height)), reverse=True)
+    return sum(counts[:LINE_ART_COLORS]) < LINE_ART_COVERAGE * sample.width * sample.height
+
+
+# 文件名标签使用的中文字体，使用第一个存在的字体
+FONT_PATHS = [
+    '/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc',  # WenQuanYi Zen Hei
+    '/usr/share/fonts/truetype/wqy/wqy-microhei.ttc',  # WenQuanYi Micro Hei
+]
+
+_font_lock = threading.Lock()
+_fonts_registered = False
+_label_font = None
+
+
+def current_umask():
+    """进程当前的 umask
+
+    优先从 /proc 读取：通过 os.umask 读取需要临时修改 umask，会影响其他线程同时创建的文件
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError):
+        pass
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+def register_fonts():
+    """注册文件名标签使用的中文字体，返回字体名称，没有可用字体时返回None
+
+    字体文件在每个进程中只解析一次。在 gunicorn 主进程中预先调用（preload_app）时，
+    fork 出的工作进程以写时复制的方式共享已解析的字体数据。
+    reportlab 只把标签中实际用到的字形作为子集嵌入输出PDF。
+    """
+    global _fonts_registered, _label_font
+    with _font_lock:
+        if _fonts_registered:
+            return _label_font
+        _fonts_registered = True
         try:
-            font_paths = [
-                '/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc',  # WenQuanYi Zen Hei
-                '/usr/share/fonts/truetype/wqy/wqy-microhei.ttc',  # WenQuanYi Micro Hei
-            ]
-            
-            for font_path in font_paths:
+            for font_path in FONT_PATHS:
                 if os.path.exists(font_path):
                     font_name = os.path.splitext(os.path.basename(font_path))[0]
                     pdfmetrics.registerFont(TTFont(font_name, font_path))
+                    _label_font = font_name
                     logging.info(f"成功注册字体: {font_name}")
                     break
             else:
                 logging.warning("未找到可用的中文字体")
         except Exception as e:
             logging.error(f"注册字体时出错: {str(e)}")
+        return _label_font
+
+
+class VectorPage:
+    """PDF发票页面（矢量模式），size 为旋转后的显示尺寸（单位：点）
+
+    只保存页面几何信息，可以在进程间传递；嵌入时再通过 read_page 重新读取页面
+    """
+
+    def __init__(self, path, page):
+        self.path = path
+        box = page.cropbox
+        self.box = [float(v) for v in (box.left, box.bottom, box.right, box.top)]
+        self.rotate = int(page.get('/Rotate', 0) or 0) % 360
+        width = self.box[2] - self.box[0]
+        height = self.box[3] - self.box[1]
+        if self.rotate in (90, 270):
+            width, height = height, width
+        self.size = (width, height)
+
+    def read_page(self):
+        """重新读取源PDF的第一页"""
+        return PdfReader(open_input(self.path)).pages[0]
+
+    def placement_matrix(self, x, y, scale):
+        """计算将页面放置到 (x, y) 并按 scale 缩放的变换矩阵"""
+        llx, lly, urx, ury = self.box
+        w0, h0 = urx - llx, ury - lly
+        # 旋转矩阵 [a b c d e f]，作用于以左下角为原点的页面坐标
+        a, b, c, d, e, f = {
+            0: (1, 0, 0, 1, 0, 0),
+            90: (0, -1, 1, 0, 0, w0),
+            180: (-1, 0, 0, -1, w0, h0),
+            270: (0, 1, -1, 0, h0, 0),
+        }[self.rotate]
+        return (
+            scale * a, scale * b, scale * c, scale * d,
+            scale * (e - a * llx - c * lly) + x,
+            scale * (f - b * llx - d * lly) + y,
+        )
+
+
+class EncodedImage:
+    """已按放置尺寸编码的发票图片
+
+    data 为 encode_image 的结果（JPEG数据或缩小后的PIL Image），size 为原图的像素尺寸，
+    placement 为编码时的放置尺寸（点）。PIL Image 在进程间传递后会丢失原始格式和文件，
+    JPEG原样嵌入和解码时缩小都依赖它们，因此在读取文件的任务中（包括进程池中）直接完成编码
+    """
+
+    def __init__(self, data, size, placement):
+        self.data = data
+        self.size = size
+        self.placement = placement
+
+    def close(self):
+        if isinstance(self.data, Image.Image):
+            self.data.close()
+
+
+class InvoiceMerger:
+    def __init__(self, pdf_mode='vector', raster_dpi=DEFAULT_RASTER_DPI, workers=1,
+                 cache_dir=None, cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+                 profile=DEFAULT_OUTPUT_PROFILE, optimize=True, executor=None,
+                 max_page_pixels=DEFAULT_MAX_PAGE_PIXELS, max_job_pixels=DEFAULT_MAX_JOB_PIXELS):
+        if pdf_mode not in PDF_MODES:
+            raise ValueError(f"不支持的PDF处理模式: {pdf_mode}")
+        if raster_dpi <= 0:
+            raise ValueError(f"无效的输出分辨率: {raster_dpi}")
+        if workers < 1:
+            raise ValueError(f"无效的并行进程数: {workers}")
+        if profile not in OUTPUT_PROFILES:
+            raise ValueError(f"不支持的输出质量配置: {profile}")
+        if max_page_pixels <= 0 or max_job_pixels <= 0:
+            raise ValueError(f"无效的像素预算: {max_page_pixels}, {max_job_pixels}")
+        self.pdf_mode = pdf_mode
+        self.profile = profile
+        # 渲染分辨率不超过输出配置的有效分辨率，超出部分最终也会被缩小
+        self.raster_dpi = min(raster_dpi, OUTPUT_PROFILES[profile]['dpi'])
+        self.workers = workers  # 大于1时使用进程池并行渲染PDF和解码图片
+        self.executor = executor  # 共享的CPU进程池（CpuPool），指定时忽略 workers
+        self.max_page_pixels = max_page_pixels
+        self.max_job_pixels = max_job_pixels
+        self.optimize = optimize  # 保存后合并重复的图片并删除未使用的资源
+        self.optimize_stats = None  # 最近一次合并的优化统计
+        self.temp_dir = os.getenv('UPLOAD_FOLDER', tempfile.mkdtemp())
+        os.makedirs(self.temp_dir, exist_ok=True)
+        os.chmod(self.temp_dir, 0o777)  # 确保目录有正确的权限
+        
+        # PDF渲染结果缓存，cache_max_bytes 为0时禁用
+        self.raster_cache = None
+        if cache_max_bytes > 0:
+            self.raster_cache = RasterCache(cache_dir or os.path.join(self.temp_dir, 'raster_cache'),
+                                            cache_max_bytes)
+        
+        # 中文字体在进程内只注册一次
+        self.label_font = register_fonts()
 
-    def convert_pdf_to_image(self, pdf_path):
-        """将PDF转换为图片"""
+    def __getstate__(self):
+        # 提交到进程池时复制合并器，进程池本身不能也不需要传给子进程
+        state = self.__dict__.copy()
+        state['executor'] = None
+        return state
+
+    def page_pixel_budget(self):
+        """单张发票渲染或解码的像素上限，与并行进程数无关"""
+        return min(self.max_page_pixels, self.max_job_pixels)
+
+    def submit_window(self, size):
+        """并行处理时同时提交的文件数
+
+        最多为进程数的两倍；同时解码的发票按单张上限计算不超过任务预算，至少提交一个
+        """
+        return max(1, min(size * 2, self.max_job_pixels // self.page_pixel_budget()))
+
+    def pdf_page_size(self, pdf_path):
+        """读取PDF第一页旋转后的显示尺寸（单位：点）"""
+        if isinstance(pdf_path, InvoiceInput):
+            # 文件流没有路径可供 pdfinfo 使用，直接读取页面尺寸
+            return VectorPage(pdf_path, PdfReader(pdf_path.open()).pages[0]).size
+        info = pdfinfo_from_path(pdf_path)
+        match = re.match(r'([\d.]+) x ([\d.]+)', info.get('Page size', ''))
+        if not match:
+            raise ValueError(f"无法解析页面尺寸: {info.get('Page size')}")
+        width, height = float(match.group(1)), float(match.group(2))
+        if int(float(info.get('Page rot', 0) or 0)) % 180 == 90:
+            width, height = height, width
+        return width, height
+
+    def get_render_dpi(self, pdf_path, max_width=SLOT_WIDTH, max_height=SLOT_HEIGHT):
+        """根据发票在页面上的放置尺寸计算渲染PDF第一页所需的DPI，无法获取页面尺寸时返回None
+
+        页面缩放到 max_width x max_height（单位：点）后，输出分辨率为 raster_dpi；
+        渲染结果超过像素预算时降低DPI，预算优先于最低DPI
+        """
+        try:
+            width, height = self.pdf_page_size(pdf_path)
+        except Exception as e:
+            logging.warning(f"无法获取PDF页面尺寸 {pdf_path}: {str(e)}")
+            return None
+
+        scale = min(max_width / width, max_height / height)
+        dpi = int(round(self.raster_dpi * scale))
+        dpi = max(MIN_RENDER_DPI, min(MAX_RENDER_DPI, dpi))
+
+        budget = self.page_pixel_budget()
+        pixels = (width * dpi / 72) * (height * dpi / 72)
+        if pixels > budget:
+            budget_dpi = max(1, int(72 * math.sqrt(budget / (width * height))))
+            logging.warning(f"PDF页面 ({width}, {height}) 在 {dpi} DPI 下为 {int(pixels)} 像素，"
+                            f"超过预算 {budget}，降低到 {budget_dpi} DPI: {pdf_path}")
+            metrics.BUDGET_DOWNGRADES.labels('pdf').inc()
+            dpi = budget_dpi
+        logging.info(f"PDF页面大小: ({width}, {height}), 渲染DPI: {dpi}")
+        return dpi
+
+    def fallback_render_size(self, max_width=SLOT_WIDTH, max_height=SLOT_HEIGHT):
+        """页面尺寸未知时渲染结果最长边的像素数
+
+        按放置位置的最长边在 raster_dpi 下的像素数计算，且最长边的平方不超过像素预算
+        """
+        side = int(max(max_width, max_height) * self.raster_dpi / 72)
+        return max(1, min(side, int(math.sqrt(self.page_pixel_budget()))))
+
+    def convert_pdf_to_image(self, pdf_path, max_width=SLOT_WIDTH, max_height=SLOT_HEIGHT):
+        """将PDF第一页按放置尺寸所需的分辨率转换为图片，返回PIL Image对象
+
+        渲染结果直接在内存中交给PDF生成，不再经过临时PNG文件；
+        启用缓存时只在写入缓存时编码一次
+        """
         try:
             logging.info(f"开始转换PDF文件: {pdf_path}")
-            # 使用更高的DPI来确保图片清晰度
-            images = convert_from_path(pdf_path, dpi=600)
+            dpi = self.get_render_dpi(pdf_path, max_width, max_height)
+            if dpi:
+                render_options = {'dpi': dpi}
+            else:
+                # 无法预先检查页面尺寸时直接限定渲染尺寸（pdftoppm -scale-to），保证不超过像素预算
+                render_options = {'size': self.fallback_render_size(max_width, max_height)}
+                logging.info(f"按最长边 {render_options['size']} 像素渲染: {pdf_path}")
+            cache_key = None
+            if self.raster_cache:
+                cache_key = self.raster_cache.make_key(pdf_path, page=1, mode='RGB', **render_options)
+                cached_path = self.raster_cache.get(cache_key)
+                metrics.RASTER_CACHE.labels('hit' if cached_path else 'miss').inc()
+                if cached_path:
+                    return Image.open(cached_path)
+            # 只渲染实际放置的第一页
+            with metrics.timed('pdf_render'):
+                if isinstance(pdf_path, InvoiceInput):
+                    images = convert_from_bytes(pdf_path.read(), first_page=1, last_page=1, **render_options)
+                else:
+                    images = convert_from_path(pdf_path, first_page=1, last_page=1, **render_options)
             logging.info(f"PDF转换完成，获得 {len(images)} 页")
             if images:
-                # 只取第一页
                 image = images[0]
-                # 保存为临时文件，使用高质量设置
-                temp_image_path = os.path.join(self.temp_dir, f"{os.path.basename(pdf_path)}.png")
-                image.save(temp_image_path, 'PNG', optimize=False, quality=100)
-                logging.info(f"临时图片已保存到: {temp_image_path}")
-                return temp_image_path
+                if self.raster_cache:
+                    self.raster_cache.put(cache_key, image)
+                return image
             else:
                 logging.error(f"PDF文件 {pdf_path} 转换后没有图片")
         except Exception as e:
@@ -65,17 +356,343 @@ class InvoiceMerger:
             raise
         return None
 
+    def load_pdf_page(self, pdf_path):
+        """以矢量方式读取PDF第一页，文件损坏或加密时返回None（回退到位图模式）"""
+        try:
+            reader = PdfReader(open_input(pdf_path))
+            if reader.is_encrypted:
+                logging.warning(f"PDF文件已加密，回退到位图模式: {pdf_path}")
+                return None
+            if len(reader.pages) == 0:
+                logging.warning(f"PDF文件没有页面，回退到位图模式: {pdf_path}")
+                return None
+            vector_page = VectorPage(pdf_path, reader.pages[0])
+            # 提前读取内容流，确保文件可以正常解析
+            self._page_content_data(reader.pages[0])
+            if vector_page.size[0] <= 0 or vector_page.size[1] <= 0:
+                logging.warning(f"PDF页面尺寸无效，回退到位图模式: {pdf_path}")
+                return None
+            logging.info(f"矢量读取PDF文件: {pdf_path}, 页面大小: {vector_page.size}")
+            return vector_page
+        except Exception as e:
+            logging.warning(f"无法以矢量方式读取PDF文件，回退到位图模式 {pdf_path}: {str(e)}")
+            return None
+
+    def load_pdf(self, pdf_path, max_width=SLOT_WIDTH, max_height=SLOT_HEIGHT):
+        """读取PDF发票：矢量模式下返回VectorPage，否则返回转换后的PIL Image对象"""
+        if self.pdf_mode == 'vector':
+            with metrics.timed('pdf_parse'):
+                vector_page = self.load_pdf_page(pdf_path)
+            if vector_page is not None:
+                metrics.INVOICES.labels('vector').inc()
+                return vector_page
+        metrics.INVOICES.labels('raster').inc()
+        return self.convert_pdf_to_image(pdf_path, max_width, max_height)
+
+    @staticmethod
+    def _page_content_data(page):
+        """获取页面解码后的内容流数据"""
+        contents = page.get('/Contents')
+        if contents is None:
+            return b''
+        contents = contents.get_object()
+        if isinstance(contents, ArrayObject):
+            return b'\n'.join(stream.get_object().get_data() for stream in contents)
+        return contents.get_data()
+
+    @staticmethod
+    def _annotation_appearances(page):
+        """返回页面上需要显示的注释（文本框、签章、印章等）的正常外观流及其放置矩阵 [(外观流, 矩阵)]
+
+        按PDF规范将外观流的 /BBox 经其 /Matrix 变换后映射到注释的 /Rect；
+        隐藏的注释和没有外观流的注释（例如弹出窗口）在阅读器中也不显示，直接跳过
+        """
+        appearances = []
+        for annot in page.get('/Annots') or []:
+            annot = annot.get_object()
+            if int(annot.get('/F', 0)) & (ANNOT_FLAG_HIDDEN | ANNOT_FLAG_NO_VIEW) or '/Rect' not in annot:
+                continue
+            appearance = annot.get('/AP')
+            normal = appearance.get_object().get('/N') if appearance is not None else None
+            if normal is not None and not isinstance(normal.get_object(), StreamObject):
+                # 有多种状态（例如复选框）时按 /AS 选择当前状态的外观
+                state = annot.get('/AS')
+                normal = normal.get_object().get(state) if state is not None else None
+            if normal is None or not isinstance(normal.get_object(), StreamObject):
+                continue
+            stream = normal.get_object()
+            x0, y0, x1, y1 = [float(v) for v in stream.get('/BBox', (0, 0, 0, 0))]
+            m = [float(v) for v in stream.get('/Matrix', (1, 0, 0, 1, 0, 0))]
+            corners = [(x * m[0] + y * m[2] + m[4], x * m[1] + y * m[3] + m[5])
+                       for x in (x0, x1) for y in (y0, y1)]
+            bx0, bx1 = min(x for x, _ in corners), max(x for x, _ in corners)
+            by0, by1 = min(y for _, y in corners), max(y for _, y in corners)
+            rect = [float(v) for v in annot['/Rect']]
+            rx0, rx1 = sorted(rect[0::2])
+            ry0, ry1 = sorted(rect[1::2])
+            if bx1 <= bx0 or by1 <= by0:
+                continue
+            sx, sy = (rx1 - rx0) / (bx1 - bx0), (ry1 - ry0) / (by1 - by0)
+            appearances.append((normal, (sx, 0, 0, sy, rx0 - bx0 * sx, ry0 - by0 * sy)))
+        return appearances
+
+    def _page_to_form_xobject(self, writer, vector_page):
+        """将源PDF页面转换为表单XObject并加入到输出文档
+
+        页面上注释的外观流作为嵌套的表单XObject绘制在页面内容之上，嵌入后注释仍然可见
+        """
+        page = vector_page.read_page()
+        data = self._page_content_data(page)
+        resources = page.get('/Resources')
+        resources = resources.get_object().clone(writer) if resources is not None else None
+        appearances = self._annotation_appearances(page)
+        if appearances:
+            # 注释放在新的资源字典中，不修改可能与其他页面共用的源资源
+            resources = DictionaryObject(resources or {})
+            xobjects = resources.get('/XObject')
+            xobjects = DictionaryObject(xobjects.get_object() if xobjects is not None else {})
+            ops = [b'q', data, b'Q']
+            for index, (normal, matrix) in enumerate(appearances):
+                name = NameObject(f'/Annot{index}')
+                if isinstance(normal, IndirectObject):
+                    xobjects[name] = normal.clone(writer)
+                else:
+                    xobjects[name] = writer._add_object(normal.clone(writer))
+                ops.append(f"q {' '.join(f'{v:.4f}' for v in matrix)} cm {name} Do Q".encode('ascii'))
+            resources[NameObject('/XObject')] = xobjects
+            data = b'\n'.join(ops)
+            logging.info(f"已展平 {len(appearances)} 个注释: {vector_page.path}")
+        stream = DecodedStreamObject()
+        stream.set_data(data)
+        form = stream.flate_encode()
+        form.update({
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Form'),
+            NameObject('/BBox'): ArrayObject([FloatObject(v) for v in vector_page.box]),
+        })
+        if resources is not None:
+            form[NameObject('/Resources')] = resources
+        return writer._add_object(form)
+
+    def _stamped_writer(self, reader, placements):
+        """复制 reader 中的页面并叠加矢量页面，返回 PdfWriter"""
+        writer = PdfWriter()
+        pages = [writer.add_page(page) for page in reader.pages]
+
+        for index, (page_number, vector_page, x, y, scale) in enumerate(placements):
+            page = pages[page_number]
+            name = NameObject(f'/Invoice{index}')
+            form_ref = self._page_to_form_xobject(writer, vector_page)
+
+            resources = page.setdefault(NameObject('/Resources'), DictionaryObject()).get_object()
+            xobjects = resources.setdefault(NameObject('/XObject'), DictionaryObject()).get_object()
+            xobjects[name] = form_ref
+
+            matrix = ' '.join(f'{v:.4f}' for v in vector_page.placement_matrix(x, y, scale))
+            ops = DecodedStreamObject()
+            ops.set_data(f'Q q {matrix} cm {name} Do Q'.encode('ascii'))
+            save = DecodedStreamObject()
+            save.set_data(b'q')
+
+            contents = page.get('/Contents')
+            streams = ArrayObject([writer._add_object(save)])
+            if contents is not None:
+                contents_obj = contents.get_object()
+                if isinstance(contents_obj, ArrayObject):
+                    streams.extend(contents_obj)
+                else:
+                    streams.append(contents)
+            streams.append(writer._add_object(ops))
+            page[NameObject('/Contents')] = streams
+        return writer
+
+    def load_file(self, file_path):
+        """读取单个发票文件（路径或 InvoiceInput），返回VectorPage或PIL Image对象，文件不存在时返回None"""
+        logging.info(f"处理文件: {file_path}")
+        if not isinstance(file_path, InvoiceInput) and not os.path.exists(file_path):
+            logging.error(f"文件不存在: {file_path}")
+            return None
+
+        metrics.INPUT_BYTES.inc(input_size(file_path))
+        if input_name(file_path).lower().endswith('.pdf'):
+            # 矢量模式下直接嵌入PDF页面，否则将PDF转换为图片
+            return self.load_pdf(file_path)
+        # 直接处理图片文件
+        metrics.INVOICES.labels('image').inc()
+        return self.process_image(file_path)
+
+    def load_encoded(self, file_path, fill_slot=False):
+        """读取单个发票文件并按默认放置位置编码图片，返回VectorPage或EncodedImage
+
+        fill_slot 为 True 时按 merge_invoices 的布局（等比缩放至填满一个位置）编码，否则按 merge_files 的布局。
+        文件不存在或无法处理时记录错误并返回None，只跳过该文件，不影响同一任务中的其他发票
+        """
+        try:
+            item = self.load_file(file_path)
+            if item is None or isinstance(item, VectorPage):
+                return item
+            if fill_slot:
+                width, height, _ = self.labeled_size(item.size)
+            else:
+                width, height = self.calculate_image_size(item, SLOT_WIDTH, SLOT_HEIGHT)
+            encoded = EncodedImage(self.encode_image(item, width, height), item.size, (width, height))
+            if encoded.data is not item:
+                item.close()
+            return encoded
+        except Exception as e:
+            logging.error(f"跳过无法处理的文件 {input_name(file_path)}: {str(e)}")
+            return None
+
+    def prepare_file(self, filepath):
+        """为 merge_invoices 准备单个文件，返回 (文件名, 发票) 元组，出错时返回None
+
+        发票为VectorPage或按 merge_invoices 布局编码好的 EncodedImage，解码、缩放和编码都在调用方（进程池）中完成
+        """
+        item = self.load_encoded(filepath, fill_slot=True)
+        return (input_name(filepath), item) if item else None
+
+    @staticmethod
+    def labeled_size(size):
+        """merge_invoices 布局中发票的放置尺寸，返回 (宽, 高, 缩放比例)，等比缩放至填满一个位置"""
+        width, height = size
+        scale = min(SLOT_WIDTH / width, SLOT_HEIGHT / height)
+        return width * scale, height * scale, scale
+
+    def _imap_files(self, func, file_paths, progress_callback=None):
+        """对每个文件调用 func，按输入顺序逐个产出结果
+
+        workers 大于1时在有界进程池中并行执行，同时提交的文件数不超过 workers 的两倍且受任务像素预算限制，
+        以保证内存占用与批次大小无关；指定了共享进程池 executor 时提交到该进程池
+        """
+        total = len(file_paths)
+        if self.executor is not None and total > 1:
+            yield from self._imap_shared(func, file_paths, progress_callback)
+            return
+        if self.workers <= 1 or total <= 1:
+            for index, file_path in enumerate(file_paths):
+                if progress_callback:
+                    progress_callback(index, total, input_name(file_path))
+                yield func(file_path)
+            return
+
+        window = self.submit_window(self.workers)
+        executor = ProcessPoolExecutor(max_workers=min(self.workers, total))
+        try:
+            futures = deque()
+            completed = 0
+            for index, file_path in enumerate(file_paths):
+                futures.append((file_path, executor.submit(func, file_path)))
+                # 提交完最后一个文件后取出所有剩余结果
+                while futures and (len(futures) >= window or index == total - 1):
+                    done_path, future = futures.popleft()
+                    result = future.result()
+                    completed += 1
+                    if progress_callback:
+                        progress_callback(completed, total, input_name(done_path))
+                    yield result
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _imap_shared(self, func, file_paths, progress_callback=None):
+        """在共享进程池中执行，同时提交的文件数由 submit_window 决定，进程池不随任务结束而关闭"""
+        total = len(file_paths)
+        window = self.submit_window(self.executor.size)
+        futures = deque()
+        try:
+            completed = 0
+            for index, file_path in enumerate(file_paths):
+                futures.append((file_path, self.executor.submit(func, file_path)))
+                while futures and (len(futures) >= window or index == total - 1):
+                    done_path, future = futures.popleft()
+                    result = future.result()
+                    completed += 1
+                    if progress_callback:
+                        progress_callback(completed, total, input_name(done_path))
+                    yield result
+        finally:
+            # 任务出错或被取消时撤回尚未开始的工作
+            for _, future in futures:
+                future.cancel()
+
     def process_image(self, image_path):
         """处理图片，返回PIL Image对象"""
         try:
             logging.info(f"开始处理图片: {image_path}")
-            image = Image.open(image_path)
+            image = Image.open(open_input(image_path))
             logging.info(f"图片大小: {image.size}, 模式: {image.mode}")
-            return image
+            return self._fit_pixel_budget(image, image_path)
         except Exception as e:
             logging.error(f"处理图片时出错 {image_path}: {str(e)}", exc_info=True)
             raise
 
+    def _fit_pixel_budget(self, image, image_path):
+        """解码前按文件头中的尺寸检查图片像素数，超过预算时在解码时缩小，返回处理后的图片
+
+        只有JPEG可以在解码时按比例缩小（最多1/8）；其他格式必须完整解码，
+        超过预算或缩小到1/8后仍超过预算时不解码，抛出 ValueError，该文件被跳过
+        """
+        budget = self.page_pixel_budget()
+        pixels = image.width * image.height
+        if pixels <= budget:
+            return image
+        if image.format == 'JPEG':
+            # draft 按 1/2、1/4、1/8 缩小且结果不小于请求尺寸，请求预算对应尺寸的一半以保证不超过预算
+            factor = 2 * math.sqrt(pixels / budget)
+            image.draft(image.mode, (max(1, int(image.width / factor)), max(1, int(image.height / factor))))
+            if image.width * image.height <= budget:
+                logging.warning(f"图片 {image_path} 为 {pixels} 像素，超过预算 {budget}，解码时缩小到 {image.size}")
+                metrics.BUDGET_DOWNGRADES.labels('image').inc()
+                return image
+
+        image.close()
+        raise ValueError(f"图片为 {pixels} 像素，超过预算 {budget}，且无法在解码时缩小到预算以内")
+
+    def image_reader(self, image, width, height):
+        """按输出质量配置编码放置尺寸为 width x height（点）的图片，返回 ImageReader
+
+        已编码的图片放置尺寸不变时直接使用，否则（例如追加时较小的空位）按新的尺寸重新编码
+        """
+        if isinstance(image, EncodedImage):
+            if image.placement == (width, height):
+                return ImageReader(image.data)
+            data = image.data
+            image = Image.open(data) if isinstance(data, io.BytesIO) else data
+        return ImageReader(self.encode_image(image, width, height))
+
+    def encode_image(self, image, width, height):
+        """按输出质量配置编码放置尺寸为 width x height（点）的图片
+
+        图片先缩小到配置的有效分辨率，照片使用JPEG（DCT）编码，返回JPEG数据（BytesIO）；
+        线条图返回缩小后的PIL Image，由reportlab使用无损的Flate编码；
+        无需缩小的JPEG原图直接返回原始数据，避免重复压缩
+        """
+        profile = OUTPUT_PROFILES[self.profile]
+        target = (max(1, round(width * profile['dpi'] / 72)), max(1, round(height * profile['dpi'] / 72)))
+        source_jpeg = image.format == 'JPEG' and getattr(image, 'fp', None) is not None
+        downsample = image.width > target[0] or image.height > target[1]
+        if source_jpeg and not downsample:
+            image.fp.seek(0)
+            return io.BytesIO(image.fp.read())
+
+        with metrics.timed('image_decode'):
+            if downsample and image.format == 'JPEG':
+                image.draft(image.mode, target)  # JPEG解码时直接按1/2、1/4或1/8缩小
+            image.load()
+
+        with metrics.timed('image_encode'):
+            if downsample:
+                logging.info(f"图片缩小: {image.size} -> {target}")
+                image = image.resize(target, Image.LANCZOS, reducing_gap=3.0)
+            has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+            if profile['jpeg_quality'] and not has_alpha and (source_jpeg or is_photographic(image)):
+                if image.mode not in ('RGB', 'L', 'CMYK'):
+                    image = image.convert('RGB')
+                buffer = io.BytesIO()
+                image.save(buffer, 'JPEG', quality=profile['jpeg_quality'], optimize=True)
+                buffer.seek(0)
+                return buffer
+            return image
+
     def calculate_image_size(self, image, max_width, max_height):
         """计算图片在页面上的大小，保持原始比例"""
         width, height = image.size
@@ -92,196 +709,412 @@ class InvoiceMerger:
         logging.info(f"原始大小: {image.size}, 调整后大小: ({width}, {height})")
         return width, height
 
-    def merge_invoices(self, files):
-        """合并发票文件"""
-        processed_files = []
-        
-        # 创建一个临时目录来存储上传的文件
-        temp_dir = tempfile.mkdtemp()
-        
+    def merge_invoices(self, files, output_path=None):
+        """合并发票文件，未指定 output_path 时在临时目录下生成唯一的输出文件
+
+        上传的文件直接从请求的文件流读取，不再保存到临时目录；
+        按 iter_merged_pdf 逐页生成并写入输出文件，内存占用与文件数无关
+        """
         try:
-            # 保存上传的文件
-            for file in files:
-                if file.filename:
-                    filepath = os.path.join(temp_dir, secure_filename(file.filename))
-                    file.save(filepath)
-                    processed_files.append(filepath)
-            
-            # 处理所有文件
-            image_files = []
-            for filepath in processed_files:
-                try:
-                    if filepath.lower().endswith('.pdf'):
-                        logging.info(f"处理文件: {filepath}")
-                        # 将 PDF 转换为图片
-                        img_path = self.convert_pdf_to_image(filepath)
-                        if img_path:
-                            image_files.append(img_path)
-                    elif any(filepath.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg']):
-                        logging.info(f"开始处理图片: {filepath}")
-                        img = Image.open(filepath)
-                        logging.info(f"图片大小: {img.size}, 模式: {img.mode}")
-                        image_files.append(filepath)
-                except Exception as e:
-                    logging.error(f"处理文件 {filepath} 时出错: {str(e)}")
-                    continue
-            
-            logging.info(f"共处理了 {len(processed_files)} 个文件")
-            
-            if not image_files:
-                raise ValueError("没有可处理的文件")
-            
+            chunks = self.iter_merged_pdf(files)
+            # 没有可处理的文件时在创建输出文件之前抛出 ValueError
+            first = next(chunks)
+
             # 创建输出目录
             os.makedirs(self.temp_dir, exist_ok=True)
-            output_path = os.path.join(self.temp_dir, 'merged_invoices.pdf')
-            
-            # 创建新的 PDF 文档
-            c = canvas.Canvas(output_path, pagesize=A4)
-            c.setPageCompression(1)  # 启用压缩以减小文件大小
-            
-            # 设置默认字体为中文字体
-            if 'wqy-zenhei' in pdfmetrics.getRegisteredFontNames():
-                c.setFont('wqy-zenhei', 10)
-            
-            page_width, page_height = A4
-            logging.info(f"PDF页面大小: {A4}")
-            
-            # 计算每页可以放置的图片数量和大小
-            margin = 20  # 页面边距
-            image_width = page_width - 2 * margin
-            max_image_height = (page_height - 3 * margin) / 2  # 每页放2张图片
-            
-            # 处理每个图片
-            for i, img_path in enumerate(image_files):
-                if i > 0 and i % 2 == 0:
-                    c.showPage()  # 创建新页面
-                    if 'wqy-zenhei' in pdfmetrics.getRegisteredFontNames():
-                        c.setFont('wqy-zenhei', 10)
-                
-                img = Image.open(img_path)
-                width, height = img.size
-                
-                # 计算缩放比例
-                scale = min(image_width / width, max_image_height / height)
-                new_width = width * scale
-                new_height = height * scale
-                
-                logging.info(f"原始大小: {(width, height)}, 调整后大小: {(new_width, new_height)}")
-                
-                # 计算图片在页面上的位置
-                x = margin
-                y = page_height - margin - new_height if i % 2 == 0 else page_height - 2 * margin - 2 * new_height
-                
-                # 将图片绘制到 PDF
-                c.drawImage(img_path, x, y, width=new_width, height=new_height, preserveAspectRatio=True)
-                
-                # 在图片下方添加文件名
-                filename = os.path.basename(img_path)
-                c.drawString(x, y - 15, filename[:50])  # 限制文件名长度
-            
-            # 保存最后一页
-            c.save()
-            
+            if output_path is None:
+                fd, output_path = tempfile.mkstemp(prefix='merged_', suffix='.pdf', dir=self.temp_dir)
+                os.close(fd)
+                # mkstemp 创建的文件权限为 0600，改为按 umask 创建普通文件时的权限
+                os.chmod(output_path, 0o666 & ~current_umask())
+            else:
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+            try:
+                with open(output_path, 'wb') as output:
+                    output.write(first)
+                    for chunk in chunks:
+                        output.write(chunk)
+            except Exception:
+                # 不留下不完整的文件
+                os.remove(output_path)
+                raise
+
             logging.info(f"PDF文件已保存到: {output_path}")
             return output_path
-            
+
         except Exception as e:
             logging.error(f"合并文件时出错: {str(e)}")
             raise
-        finally:
-            # 清理临时文件
-            try:
-                shutil.rmtree(temp_dir)
-            except Exception as e:
-                logging.error(f"清理临时文件时出错: {str(e)}")
 
-    def merge_files(self, input_files, output_file, progress_callback=None):
+    def _draw_labeled_invoice(self, c, slot, filename, img_path, vector_placements):
+        """按 merge_invoices 的布局在第 slot（0 为上方，1 为下方）个位置绘制发票（VectorPage或EncodedImage），并在下方标注文件名"""
+        page_height = A4[1]
+        margin = PAGE_MARGIN  # 页面边距
+
+        # 计算缩放后的大小
+        new_width, new_height, scale = self.labeled_size(img_path.size)
+        logging.info(f"原始大小: {img_path.size}, 调整后大小: {(new_width, new_height)}")
+        
+        # 计算图片在页面上的位置
+        x = margin
+        y = page_height - margin - new_height if slot == 0 else page_height - 2 * margin - 2 * new_height
+        
+        if isinstance(img_path, VectorPage):
+            vector_placements.append((c.getPageNumber() - 1, img_path, x, y, scale))
+        else:
+            # 图片已在进程池中按放置尺寸编码，直接绘制到 PDF
+            reader = self.image_reader(img_path, new_width, new_height)
+            with metrics.timed('layout'):
+                c.drawImage(reader, x, y, width=new_width, height=new_height, preserveAspectRatio=True)
+        
+        # 在图片下方添加文件名
+        c.drawString(x, y - 15, filename[:50])  # 限制文件名长度
+
+    def iter_merged_pdf(self, files):
+        """按 merge_invoices 的布局逐页生成合并后的PDF，产出可以直接发送的数据块
+
+        不写输出文件：每页单独生成后立即转为输出数据，页面树和交叉引用表在最后产出。
+        第一个数据块在第一页生成后产出，没有可处理的文件时在产出任何数据之前抛出 ValueError。
+        启用优化时按页裁剪未使用的资源，重复的图片和字体在生成过程中合并
+        图片由 prepare_file 解码并按放置尺寸编码（workers 大于1或使用共享进程池时在子进程中完成），请求线程只负责排版和写出
+        """
+        processed_files = [as_input(file) for file in files if file.filename]
+        items = (item for item in self._imap_files(self.prepare_file, processed_files) if item)
+        stream = PdfStreamWriter()
+        optimizer = PdfOptimizer() if self.optimize else None
+        while True:
+            pair = [item for item in (next(items, None), next(items, None)) if item]
+            if not pair:
+                break
+
+            def draw(c, vector_placements):
+                for slot, (filename, img_path) in enumerate(pair):
+                    self._draw_labeled_invoice(c, slot, filename, img_path, vector_placements)
+            stream.add_page(self._single_page(draw, optimizer))
+            for _, item in pair:
+                # 释放当前页图片占用的内存
+                if isinstance(item, EncodedImage):
+                    item.close()
+            yield stream.read()
+            if len(pair) < 2:
+                break
+
+        if not stream.page_count:
+            raise ValueError("没有可处理的文件")
+        yield stream.close()
+        self.optimize_stats = self._stream_stats(stream, optimizer)
+        metrics.PAGES.inc(stream.page_count)
+        metrics.OUTPUT_BYTES.inc(stream.bytes_written)
+        logging.info(f"已逐页输出 {stream.page_count} 页，共 {stream.bytes_written} 字节")
+
+    def iter_invoice_pairs(self, input_files, progress_callback=None, first_page_size=2):
+        """按输入顺序逐对产出已处理的发票，供逐页生成PDF使用
+
+        图片在读取时即按默认放置位置编码为 EncodedImage，同一时间只有当前页和正在并行处理的少量文件驻留在内存中；
+        first_page_size 为第一页放置的发票数（追加时已有PDF最后一页只剩一个空位）
+        """
+        pair = []
+        page_size = first_page_size
+        for item in self._imap_files(self.load_encoded, input_files, progress_callback):
+            if not item:
+                continue
+            pair.append(item)
+            if len(pair) == page_size:
+                yield pair
+                pair = []
+                page_size = 2
+        if pair:
+            yield pair
+
+    def _single_page(self, draw, optimizer=None):
+        """在单页画布上绘制一页并嵌入矢量页面，返回该页（PyPDF2页面对象）
+
+        draw(c, vector_placements) 负责绘制，矢量页面的放置位置记录在 vector_placements 中；
+        指定 optimizer 时按页裁剪未使用的资源。每页单独生成，内存占用与总页数无关
+        """
+        with metrics.timed('pdf_write'):
+            buffer = io.BytesIO()
+            c = canvas.Canvas(buffer, pagesize=A4)
+            c.setPageCompression(1)  # 压缩页面内容流，图片按输出质量配置单独编码
+            if self.label_font:
+                c.setFont(self.label_font, 10)
+            vector_placements = []
+            draw(c, vector_placements)
+            c.showPage()  # 只放置矢量页面时画布上没有内容，也要生成这一页
+            c.save()
+            reader = PdfReader(buffer)
+        if vector_placements:
+            with metrics.timed('vector_stamp'):
+                reader = self._stamped_writer(reader, vector_placements)
+        page = reader.pages[0]
+        if optimizer is not None:
+            self._optimize_page(optimizer, page)
+        return page
+
+    @staticmethod
+    def _optimize_page(optimizer, page):
+        """按页合并重复的图片并裁剪未使用的资源"""
+        with metrics.timed('optimize'):
+            optimizer.optimize_page(page)
+
+    @staticmethod
+    def _stream_stats(stream, optimizer):
+        """逐页写出时的优化统计，未启用优化时返回None"""
+        if optimizer is None:
+            return None
+        return {
+            'bytes_before': stream.bytes_written + stream.bytes_deduplicated,
+            'bytes_after': stream.bytes_written,
+            'bytes_saved': stream.bytes_deduplicated,
+            'xobjects_deduplicated': optimizer.xobjects_deduplicated + stream.streams_deduplicated,
+            'resources_removed': optimizer.resources_removed,
+        }
+
+    def _draw_stacked(self, c, images, vector_placements, y_position, slot_height):
+        """按 merge_files 的布局从 y_position 开始自上而下绘制一页中的发票，每张水平居中"""
+        page_width = A4[0]
+        for image in images:
+            if isinstance(image, VectorPage):
+                # 矢量页面按比例缩放至填满可用区域
+                scale = min(SLOT_WIDTH / image.size[0], slot_height / image.size[1])
+                width, height = image.size[0] * scale, image.size[1] * scale
+                x_position = (page_width - width) / 2  # 水平居中
+                vector_placements.append((0, image, x_position, y_position - height, scale))
+            else:
+                # 计算图片在页面上的大小
+                width, height = self.calculate_image_size(image, SLOT_WIDTH, slot_height)
+                x_position = (page_width - width) / 2  # 水平居中
+
+                # 按输出质量配置编码后在PDF中绘制图片
+                reader = self.image_reader(image, width, height)
+                with metrics.timed('layout'):
+                    c.drawImage(reader, x_position, y_position - height, width, height)
+            y_position -= (height + IMAGE_SPACING)  # 移动到下一个位置
+
+    def merge_files(self, input_files, output_file, progress_callback=None, first_slot_top=None):
+        """合并发票，每页上下放置两张
+
+        每页单独生成、嵌入矢量页面并优化后立即写入输出文件，不保留已写出的页面，
+        内存占用与总页数无关；内容相同的图片和表单在写出时只保留一份。
+        先写入同目录下的临时文件，完成后替换 output_file，出错时不留下不完整的文件。
+        指定 first_slot_top 时第一页只在该高度以下放置一张发票，用于填补已有PDF最后一页的空位
+        """
+        output_dir = os.path.dirname(os.path.abspath(output_file))
+        os.makedirs(output_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix='merge_', suffix='.pdf', dir=output_dir)
         try:
-            # 创建一个列表存储所有处理后的图片
-            processed_images = []
+            optimizer = PdfOptimizer() if self.optimize else None
+            stream = PdfStreamWriter()
             total_files = len(input_files)
-            
-            # 处理所有文件
-            for index, file_path in enumerate(input_files):
-                logging.info(f"处理文件: {file_path}")
-                if not os.path.exists(file_path):
-                    logging.error(f"文件不存在: {file_path}")
-                    continue
-                
-                filename = os.path.basename(file_path)
-                if progress_callback:
-                    progress_callback(index, total_files, filename)
-                    
-                if file_path.lower().endswith('.pdf'):
-                    # 将PDF转换为图片
-                    image_path = self.convert_pdf_to_image(file_path)
-                    if image_path:
-                        processed_images.append(self.process_image(image_path))
-                else:
-                    # 直接处理图片文件
-                    processed_images.append(self.process_image(file_path))
-            
-            if not processed_images:
-                raise Exception("没有可处理的图片")
-                
-            logging.info(f"共处理了 {len(processed_images)} 个文件")
-            
-            # 创建新的PDF文件，使用更高的质量设置
-            output_dir = os.path.dirname(output_file)
-            os.makedirs(output_dir, exist_ok=True)
-            
-            c = canvas.Canvas(output_file, pagesize=A4)
-            c.setPageCompression(0)  # 禁用压缩以保持质量
-            
-            # 设置默认字体为中文字体
-            if 'wqy-zenhei' in pdfmetrics.getRegisteredFontNames():
-                c.setFont('wqy-zenhei', 10)
-            
-            page_width, page_height = A4
-            logging.info(f"PDF页面大小: {A4}")
-
-            # 每页只放2张图片，上下排列
-            margin = 20  # 页边距
-            spacing = 20  # 图片间距
-            max_image_height = (page_height - 2 * margin - spacing) / 2  # 每张图片的最大高度
-            max_image_width = page_width - 2 * margin  # 图片的最大宽度
-
-            # 分批处理图片，每页2张
-            for i in range(0, len(processed_images), 2):
-                y_position = page_height - margin
-                
-                # 处理当前页的图片（最多2张）
-                current_images = processed_images[i:i+2]
-                for image in current_images:
-                    # 计算图片在页面上的大小
-                    width, height = self.calculate_image_size(image, max_image_width, max_image_height)
-                    x_position = (page_width - width) / 2  # 水平居中
-                    
-                    # 在PDF中绘制图片
-                    c.drawImage(ImageReader(image), x_position, y_position - height, width, height)
-                    y_position -= (height + spacing)  # 移动到下一个位置
-                    
-                    if progress_callback:
-                        current_progress = i + current_images.index(image) + 1
-                        progress_callback(current_progress, len(processed_images), "正在生成PDF...")
-                
-                c.showPage()  # 创建新页面
-            
-            c.save()
-            logging.info(f"PDF文件已保存到: {output_file}")
-            
-            # 确保文件存在并且可读
-            if not os.path.exists(output_file):
-                raise Exception(f"PDF文件未能成功保存到: {output_file}")
-            
+            processed_count = 0
+
+            with os.fdopen(fd, 'wb') as output:
+                # 逐页处理图片，每页2张，写出后立即释放图片内存
+                first_page_size = 1 if first_slot_top is not None else 2
+                for current_images in self.iter_invoice_pairs(input_files, progress_callback, first_page_size):
+                    y_position = A4[1] - PAGE_MARGIN
+                    slot_height = SLOT_HEIGHT
+                    if first_slot_top is not None:
+                        y_position = first_slot_top
+                        slot_height = min(SLOT_HEIGHT, first_slot_top - PAGE_MARGIN)
+                        first_slot_top = None
+
+                    page = self._single_page(
+                        lambda c, placements: self._draw_stacked(c, current_images, placements,
+                                                                 y_position, slot_height),
+                        optimizer)
+                    stream.add_page(page)
+                    output.write(stream.read())
+
+                    for image in current_images:
+                        processed_count += 1
+                        if progress_callback:
+                            progress_callback(processed_count, total_files, "正在生成PDF...")
+                        # 释放当前页图片占用的内存
+                        if isinstance(image, EncodedImage):
+                            image.close()
+
+                if not processed_count:
+                    raise Exception("没有可处理的图片")
+                output.write(stream.close())
+
+            # mkstemp 创建的文件权限为 0600，改为按 umask 创建普通文件时的权限
+            os.chmod(temp_path, 0o666 & ~current_umask())
+            os.replace(temp_path, output_file)
+            logging.info(f"共处理了 {processed_count} 个文件")
+
+            self.optimize_stats = self._stream_stats(stream, optimizer)
+            metrics.PAGES.inc(stream.page_count)
+            metrics.OUTPUT_BYTES.inc(stream.bytes_written)
+            logging.info(f"PDF文件已保存到: {output_file}, 共 {stream.page_count} 页")
+
         except Exception as e:
             logging.error(f"合并文件时出错: {str(e)}", exc_info=True)
             raise
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @staticmethod
+    def _placement_bottoms(page):
+        """返回页面内容流中每个图片或表单XObject绘制区域的下边界（单位：点）"""
+        def multiply(m, n):
+            return (m[0] * n[0] + m[1] * n[2], m[0] * n[1] + m[1] * n[3],
+                    m[2] * n[0] + m[3] * n[2], m[2] * n[1] + m[3] * n[3],
+                    m[4] * n[0] + m[5] * n[2] + n[4], m[4] * n[1] + m[5] * n[3] + n[5])
+
+        contents = page.get_contents()
+        if contents is None:
+            return []
+        resources = page.get('/Resources')
+        xobjects = resources.get_object().get('/XObject', {}) if resources is not None else {}
+        ctm = (1, 0, 0, 1, 0, 0)
+        stack = []
+        bottoms = []
+        for operands, operator in ContentStream(contents, page.pdf).operations:
+            if operator == b'q':
+                stack.append(ctm)
+            elif operator == b'Q' and stack:
+                ctm = stack.pop()
+            elif operator == b'cm':
+                ctm = multiply(tuple(float(v) for v in operands), ctm)
+            elif operator == b'Do' and operands[0] in xobjects:
+                xobject = xobjects[operands[0]].get_object()
+                if xobject.get('/Subtype') == '/Form':
+                    x0, y0, x1, y1 = (float(v) for v in xobject['/BBox'])
+                    matrix = multiply(tuple(float(v) for v in xobject.get('/Matrix', (1, 0, 0, 1, 0, 0))), ctm)
+                else:
+                    x0, y0, x1, y1 = 0, 0, 1, 1
+                    matrix = ctm
+                bottoms.append(min(matrix[1] * x + matrix[3] * y + matrix[5] for x in (x0, x1) for y in (y0, y1)))
+        return bottoms
+
+    def _free_slot_top(self, page):
+        """已有PDF最后一页只放了一张发票时返回下方空位的上边界，否则返回None
+
+        本程序生成的页面中每张发票对应一个图片或表单XObject，据此判断页面上已放置的发票数
+        """
+        width, height = float(page.mediabox.width), float(page.mediabox.height)
+        if abs(width - A4[0]) > 1 or abs(height - A4[1]) > 1 or page.get('/Rotate', 0) % 360:
+            return None
+        try:
+            bottoms = self._placement_bottoms(page)
+        except Exception as e:
+            logging.warning(f"无法解析最后一页的内容，追加的发票从新页面开始: {str(e)}")
+            return None
+        if len(bottoms) != 1:
+            return None
+        top = bottoms[0] - IMAGE_SPACING
+        return top if top - PAGE_MARGIN >= 1 else None
+
+    @staticmethod
+    def _fill_free_slot(update, page, overlay):
+        """把 overlay 页面（只在空位中放置了一张发票）以表单XObject的形式叠加到已有页面上"""
+        stream = DecodedStreamObject()
+        stream.set_data(InvoiceMerger._page_content_data(overlay))
+        form = stream.flate_encode()
+        form.update({
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Form'),
+            NameObject('/BBox'): ArrayObject([FloatObject(v) for v in overlay.mediabox]),
+        })
+        if '/Resources' in overlay:
+            form[NameObject('/Resources')] = update.import_object(overlay.raw_get('/Resources'))
+        form_ref = update.add_object(form)
+
+        # 复制页面字典和资源字典，原有的内容流和资源对象不变
+        new_page = DictionaryObject({NameObject(key): page.raw_get(key) for key in page})
+        resources = page.get('/Resources')
+        resources = resources.get_object() if resources is not None else DictionaryObject()
+        new_resources = DictionaryObject({NameObject(key): resources.raw_get(key) for key in resources})
+        xobjects = resources.get('/XObject')
+        xobjects = xobjects.get_object() if xobjects is not None else DictionaryObject()
+        new_xobjects = DictionaryObject({NameObject(key): xobjects.raw_get(key) for key in xobjects})
+        index = 0
+        while f'/Appended{index}' in new_xobjects:
+            index += 1
+        name = NameObject(f'/Appended{index}')
+        new_xobjects[name] = form_ref
+        new_resources[NameObject('/XObject')] = new_xobjects
+        new_page[NameObject('/Resources')] = new_resources
+
+        # 原内容流前后加 q/Q，使叠加的内容不受原内容中图形状态的影响
+        save = DecodedStreamObject()
+        save.set_data(b'q')
+        ops = DecodedStreamObject()
+        ops.set_data(f'Q q {name} Do Q'.encode('ascii'))
+        streams = ArrayObject([update.add_object(save)])
+        contents = page.raw_get('/Contents') if '/Contents' in page else None
+        if contents is not None:
+            if isinstance(contents.get_object(), ArrayObject):
+                streams.extend(contents.get_object())
+            else:
+                streams.append(contents)
+        streams.append(update.add_object(ops))
+        new_page[NameObject('/Contents')] = streams
+        update.replace_object(page.indirect_reference, new_page)
+
+    def append_files(self, input_files, pdf_path, progress_callback=None):
+        """把发票追加到已有的合并结果 pdf_path，已有的页面不重新处理
+
+        最后一页只放了一张发票时先填入下方的空位，其余发票放在新页面上。
+        新页面和修改后的最后一页以增量更新的方式写在原文件末尾，耗时只与追加的发票数有关
+        """
+        with IncrementalUpdate(pdf_path) as update:
+            pages = update.reader.pages
+            page_count = len(pages)
+            last_page = pages[page_count - 1] if page_count else None
+            slot_top = self._free_slot_top(last_page) if last_page is not None else None
+
+            fd, temp_path = tempfile.mkstemp(prefix='append_', suffix='.pdf', dir=self.temp_dir)
+            os.close(fd)
+            try:
+                self.merge_files(input_files, temp_path, progress_callback, first_slot_top=slot_top)
+                with open(temp_path, 'rb') as f:
+                    new_pages = list(PdfReader(f).pages)
+                    if slot_top is not None:
+                        self._fill_free_slot(update, last_page, new_pages.pop(0))
+
+                    # 新页面挂到页面树的根节点下
+                    pages_ref = update.reader.trailer['/Root'].raw_get('/Pages')
+                    root = pages_ref.get_object()
+                    new_root = DictionaryObject({NameObject(key): root.raw_get(key) for key in root})
+                    kids = ArrayObject(root['/Kids'])
+                    kids.extend(update.import_page(page, pages_ref) for page in new_pages)
+                    new_root[NameObject('/Kids')] = kids
+                    new_root[NameObject('/Count')] = NumberObject(int(root['/Count']) + len(new_pages))
+                    update.replace_object(pages_ref, new_root)
+                    update.write()
+            finally:
+                os.remove(temp_path)
+        logging.info(f"已追加到 {pdf_path}: {'填入最后一页的空位，' if slot_top is not None else ''}"
+                     f"新增 {len(new_pages)} 页")
+        return len(new_pages)
 
 def main():
     parser = argparse.ArgumentParser(description='合并发票文件为PDF')
-    parser.add_argument('input_files', nargs='+', help='输入文件列表（支持PDF和图片格式）')
+    parser.add_argument('input_files', nargs='+', help='输入文件列表（支持PDF、图片格式和包含发票的ZIP压缩包）')
     parser.add_argument('-o', '--output', required=True, help='输出PDF文件路径')
+    parser.add_argument('--pdf-mode', choices=PDF_MODES, default='vector',
+                        help='PDF处理模式：vector 直接嵌入矢量页面（默认），raster 转换为图片')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='并行处理文件的进程数（默认 1，即顺序处理）')
+    parser.add_argument('--cache-dir', help='PDF渲染缓存目录（默认为 UPLOAD_FOLDER 下的 raster_cache）')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_MAX_BYTES // (1024 * 1024),
+                        help='PDF渲染缓存容量上限（MB），0 表示禁用缓存')
+    parser.add_argument('--dpi', type=int, default=DEFAULT_RASTER_DPI,
+                        help=f'位图模式下发票在输出页面上的分辨率（默认 {DEFAULT_RASTER_DPI}，不超过输出质量配置的分辨率）')
+    parser.add_argument('--no-optimize', dest='optimize', action='store_false',
+                        help='不对输出PDF做去重和资源清理等后处理')
+    parser.add_argument('--profile', choices=sorted(OUTPUT_PROFILES), default=DEFAULT_OUTPUT_PROFILE,
+                        help=f'输出质量配置：screen 屏幕浏览，print 打印，archive 无损归档（默认 {DEFAULT_OUTPUT_PROFILE}）')
+    parser.add_argument('--max-page-mpix', type=float, default=DEFAULT_MAX_PAGE_PIXELS / 1e6,
+                        help='单张发票渲染或解码的像素上限（百万像素），超出时自动降低分辨率')
+    parser.add_argument('--max-job-mpix', type=float, default=DEFAULT_MAX_JOB_PIXELS / 1e6,
+                        help='一个任务中同时解码的所有发票的像素上限（百万像素），限制并行提交的文件数')
+    parser.add_argument('--append', action='store_true',
+                        help='输出文件已存在时把发票追加到其末尾（填入最后一页的空位），不重新处理已有页面')
     
     args = parser.parse_args()
     
@@ -289,9 +1122,25 @@ def main():
         print(f"\r进度：{current}/{total} - {message}", end="")
     
     try:
-        merger = InvoiceMerger()
-        merger.merge_files(args.input_files, args.output, progress_callback)
-        print(f"\n合并完成！输出文件：{args.output}")
+        input_files = expand_inputs(args.input_files)
+        merger = InvoiceMerger(pdf_mode=args.pdf_mode, raster_dpi=args.dpi, workers=args.workers,
+                               cache_dir=args.cache_dir, cache_max_bytes=args.cache_size * 1024 * 1024,
+                               profile=args.profile, optimize=args.optimize,
+                               max_page_pixels=int(args.max_page_mpix * 1e6),
+                               max_job_pixels=int(args.max_job_mpix * 1e6))
+        if args.append and os.path.exists(args.output):
+            merger.append_files(input_files, args.output, progress_callback)
+            print(f"\n追加完成！输出文件：{args.output}")
+        else:
+            merger.merge_files(input_files, args.output, progress_callback)
+            print(f"\n合并完成！输出文件：{args.output}")
+        if merger.optimize_stats:
+            print(f"优化：节省 {merger.optimize_stats['bytes_saved'] / 1024:.1f}KB，"
+                  f"合并重复图片 {merger.optimize_stats['xobjects_deduplicated']} 个")
+        if merger.raster_cache:
+            stats = merger.raster_cache.stats()
+            print(f"缓存：命中 {stats['hits']} 次，未命中 {stats['misses']} 次，"
+                  f"共 {stats['entries']} 项 {stats['size_bytes'] / 1024 / 1024:.1f}MB")
     except Exception as e:
         print(f"错误：{str(e)}")
         sys.exit(1)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""合并流程和HTTP接口的运行指标，以 Prometheus 文本格式导出
+
+设置环境变量 PROMETHEUS_MULTIPROC_DIR 后使用 prometheus_client 的多进程模式：
+每个 gunicorn 工作进程（以及并行渲染的子进程）把指标写入该目录下的独立文件，
+/metrics 汇总所有进程的数据。该变量必须在导入本模块之前设置（见 gunicorn.conf.py）。
+"""
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+)
+from prometheus_client import multiprocess
+
+# 合并阶段耗时的分桶（秒），大批量合并可能持续数分钟
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram(
+    'invoice_merge_stage_seconds', '合并各阶段耗时', ['stage'], buckets=STAGE_BUCKETS
+)
+STAGE_ERRORS = Counter(
+    'invoice_merge_stage_errors_total', '合并各阶段出错次数', ['stage']
+)
+INPUT_BYTES = Counter('invoice_merge_input_bytes_total', '参与合并的输入文件字节数')
+OUTPUT_BYTES = Counter('invoice_merge_output_bytes_total', '生成的PDF文件字节数')
+PAGES = Counter('invoice_merge_pages_total', '生成的PDF页数')
+INVOICES = Counter('invoice_merge_invoices_total', '合并的发票数', ['kind'])
+BUDGET_DOWNGRADES = Counter('invoice_pixel_budget_downgrades_total', '因超过像素预算降低分辨率的发票数', ['kind'])
+RASTER_CACHE = Counter('invoice_raster_cache_lookups_total', 'PDF渲染缓存查询次数', ['result'])
+JOBS = Counter('invoice_merge_jobs_total', '结束的后台合并任务数', ['status'])
+ADMISSION_REJECTED = Counter('invoice_admission_rejected_total', '因预算不足被拒绝（429）的合并请求数')
+HTTP_REQUEST_SECONDS = Histogram(
+    'invoice_http_request_seconds', 'HTTP请求处理耗时', ['method', 'endpoint', 'status'],
+    buckets=STAGE_BUCKETS
+)
+
+
+@contextmanager
+def timed(stage):
+    """统计代码块耗时，出错时同时增加该阶段的出错计数"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def multiprocess_enabled():
+    return bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+
+
+def render():
+    """返回 (指标文本, Content-Type)，多进程模式下汇总所有进程的指标"""
+    if multiprocess_enabled():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """工作进程退出后清理其实时指标文件，供 gunicorn 的 child_exit 钩子调用"""
+    if multiprocess_enabled():
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+import io
+import os
+import re
+import logging
+from PyPDF2 import PdfReader
+from PyPDF2.generic import (
+    ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
+)
+
+# 文件末尾的 startxref 位置
+STARTXREF = re.compile(rb'startxref\s+(\d+)\s*%%EOF', re.S)
+
+# 查找 startxref 时读取的文件末尾字节数
+TAIL_BYTES = 2048
+
+
+def find_startxref(f):
+    """返回文件最后一个 startxref 指向的交叉引用表位置"""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(0, size - TAIL_BYTES))
+    matches = STARTXREF.findall(f.read())
+    if not matches:
+        raise ValueError("找不到 startxref，文件不是完整的PDF")
+    return int(matches[-1])
+
+
+class IncrementalUpdate:
+    """以增量更新的方式修改已有的PDF文件
+
+    原文件的内容保持不变，新增和修改的对象写在文件末尾，接着写只包含这些对象的交叉引用表，
+    以及 /Prev 指向原交叉引用表的 trailer。写入的数据量只与新增的内容有关，与原文件大小无关。
+    原文件只读取交叉引用表和实际用到的对象，不会整体读入内存。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self.startxref = find_startxref(self._file)
+            self._file.seek(self.startxref)
+            if not self._file.read(4) == b'xref':
+                raise ValueError("原文件使用交叉引用流，不支持增量追加")
+            self.reader = PdfReader(self._file)
+            if self.reader.is_encrypted:
+                raise ValueError("原文件已加密，不支持增量追加")
+        except Exception:
+            self._file.close()
+            raise
+        self._file.seek(0, os.SEEK_END)
+        self.base_offset = self._file.tell()
+        self.next_id = int(self.reader.trailer['/Size'])
+        self._objects = {}  # 对象编号 -> (代数, 对象)
+        self._imported = {}  # (来源文件, 对象编号) -> 新的对象编号
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_object(self, obj):
+        """添加新对象，返回指向它的间接引用"""
+        idnum = self.next_id
+        self.next_id += 1
+        self._objects[idnum] = (0, obj)
+        return IndirectObject(idnum, 0, self.reader)
+
+    def replace_object(self, ref, obj):
+        """用 obj 替换原文件中的对象 ref（对象编号不变）"""
+        self._objects[ref.idnum] = (ref.generation, obj)
+
+    def import_object(self, obj, exclude=()):
+        """复制其他PDF中的对象及其引用的所有对象，返回复制后的对象
+
+        间接引用按来源文件和对象编号只复制一次；exclude 中的键（例如页面的 /Parent）不复制
+        """
+        if isinstance(obj, IndirectObject):
+            key = (id(obj.pdf), obj.idnum)
+            if key not in self._imported:
+                ref = self.add_object(None)
+                self._imported[key] = ref.idnum
+                self._objects[ref.idnum] = (0, self.import_object(obj.get_object()))
+            return IndirectObject(self._imported[key], 0, self.reader)
+        if isinstance(obj, DictionaryObject):
+            copy = obj.__class__() if isinstance(obj, StreamObject) else DictionaryObject()
+            if isinstance(obj, StreamObject):
+                copy._data = obj._data
+            for key, value in obj.items():
+                if key not in exclude:
+                    copy[NameObject(key)] = self.import_object(value)
+            return copy
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self.import_object(item) for item in obj)
+        return obj
+
+    def import_page(self, page, parent):
+        """复制其他PDF中的页面，挂到页面树节点 parent 下，返回新页面的引用"""
+        ref = self.add_object(None)
+        source = page.indirect_reference
+        if source is not None:
+            self._imported[(id(source.pdf), source.idnum)] = ref.idnum
+        copy = self.import_object(page, exclude=('/Parent',))
+        copy[NameObject('/Parent')] = parent
+        self._objects[ref.idnum] = (0, copy)
+        return ref
+
+    def write(self):
+        """把增量更新追加到原文件末尾，写入失败时截断到原来的长度"""
+        buffer = io.BytesIO()
+        self._file.seek(self.base_offset - 1)
+        if self._file.read(1) not in (b'\n', b'\r'):
+            buffer.write(b'\n')
+
+        offsets = {}
+        for idnum in sorted(self._objects):
+            generation, obj = self._objects[idnum]
+            offsets[idnum] = self.base_offset + buffer.tell()
+            buffer.write(f'{idnum} {generation} obj\n'.encode('ascii'))
+            obj.write_to_stream(buffer, None)
+            buffer.write(b'\nendobj\n')
+
+        # 交叉引用表按连续的对象编号分段
+        xref_offset = self.base_offset + buffer.tell()
+        buffer.write(b'xref\n')
+        ids = sorted(offsets)
+        start = 0
+        while start < len(ids):
+            end = start
+            while end + 1 < len(ids) and ids[end + 1] == ids[end] + 1:
+                end += 1
+            buffer.write(f'{ids[start]} {end - start + 1}\n'.encode('ascii'))
+            for idnum in ids[start:end + 1]:
+                buffer.write(f'{offsets[idnum]:010d} {self._objects[idnum][0]:05d} n\r\n'.encode('ascii'))
+            start = end + 1
+
+        trailer = DictionaryObject()
+        for key in ('/Root', '/Info', '/ID'):
+            if key in self.reader.trailer:
+                trailer[NameObject(key)] = self.reader.trailer.raw_get(key)
+        trailer[NameObject('/Size')] = NumberObject(self.next_id)
+        trailer[NameObject('/Prev')] = NumberObject(self.startxref)
+        buffer.write(b'trailer\n')
+        trailer.write_to_stream(buffer, None)
+        buffer.write(f'\nstartxref\n{xref_offset}\n%%EOF\n'.encode('ascii'))
+
+        with open(self.path, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() != self.base_offset:
+                raise RuntimeError("原文件在追加期间被修改")
+            try:
+                f.write(buffer.getvalue())
+                f.flush()
+                os.fsync(f.fileno())
+            except Exception:
+                f.truncate(self.base_offset)
+                raise
+        logging.info(f"增量更新 {self.path}: {len(self._objects)} 个对象，{buffer.tell()} 字节")
+        return buffer.tell()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import os
+import re
+import hashlib
+import shutil
+import logging
+import tempfile
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import (
+    ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject, NameObject, StreamObject
+)
+
+# 按内容流中实际引用的名称裁剪的资源类别
+PRUNABLE_RESOURCES = ('/XObject', '/Font', '/ExtGState', '/Pattern', '/Shading', '/ColorSpace', '/Properties')
+
+# 内容流中的名称记号，例如 /Im0 Do 中的 /Im0
+NAME_TOKEN = re.compile(rb'/([^\s/\[\]()<>{}%]*)')
+NAME_ESCAPE = re.compile(rb'#([0-9A-Fa-f]{2})')
+
+
+def _content_names(data):
+    """返回内容流中出现的所有名称（已还原 #xx 转义）"""
+    return {
+        NAME_ESCAPE.sub(lambda m: bytes([int(m.group(1), 16)]), token)
+        for token in NAME_TOKEN.findall(data)
+    }
+
+
+def _page_content(page):
+    """读取页面的全部内容流，无法解码时返回None"""
+    contents = page.get('/Contents')
+    if contents is None:
+        return b''
+    contents = contents.get_object()
+    streams = contents if isinstance(contents, ArrayObject) else [contents]
+    try:
+        return b'\n'.join(stream.get_object().get_data() for stream in streams)
+    except Exception as e:
+        logging.warning(f"无法解码页面内容流，跳过资源裁剪: {str(e)}")
+        return None
+
+
+class PdfOptimizer:
+    """合并结果的后处理
+
+    - 删除页面和表单XObject中内容流未引用的资源
+    - 内容相同的图片和表单XObject只保留一份（例如重复出现的印章、同一发票上传两次）
+    - 只复制仍被引用的对象，重新编号后写出紧凑的交叉引用表，并压缩未压缩的页面内容流
+    """
+
+    def __init__(self):
+        self._digests = {}
+        self._canonical = {}
+        self._visited = set()
+        self.resources_removed = 0
+        self.xobjects_deduplicated = 0
+
+    def _digest(self, obj):
+        """计算对象内容的哈希，间接引用按所指对象的内容计算"""
+        if isinstance(obj, IndirectObject):
+            key = obj.idnum
+            if key not in self._digests:
+                self._digests[key] = f'ref-{key}'  # 防止循环引用
+                self._digests[key] = self._digest(obj.get_object())
+            return self._digests[key]
+
+        digest = hashlib.sha256(type(obj).__name__.encode())
+        if isinstance(obj, StreamObject):
+            digest.update(obj._data)
+        if isinstance(obj, DictionaryObject):
+            for key in sorted(obj):
+                if key != '/Length':
+                    digest.update(key.encode('utf-8', 'replace'))
+                    digest.update(self._digest(obj[key]).encode())
+        elif isinstance(obj, ArrayObject):
+            for item in obj:
+                digest.update(self._digest(item).encode())
+        else:
+            digest.update(repr(obj).encode('utf-8', 'replace'))
+        return digest.hexdigest()
+
+    def _optimize_resources(self, holder, content):
+        """裁剪 holder（页面或表单XObject）的资源并合并重复的XObject
+
+        资源字典可能被多个页面共享，因此总是替换为新的字典而不是原地修改
+        """
+        resources = holder.get('/Resources')
+        if resources is None:
+            return
+        resources = resources.get_object()
+        names = _content_names(content) if content is not None else None
+
+        optimized = DictionaryObject()
+        for category, entries in resources.items():
+            entries = entries.get_object()
+            if category not in PRUNABLE_RESOURCES or not isinstance(entries, DictionaryObject):
+                optimized[category] = resources[category]
+                continue
+            kept = DictionaryObject()
+            for name, value in entries.items():
+                try:
+                    used = names is None or name[1:].encode('utf-8') in names
+                except UnicodeEncodeError:
+                    used = True
+                if not used:
+                    self.resources_removed += 1
+                    continue
+                if category == '/XObject' and isinstance(value, IndirectObject):
+                    value = self._canonical_xobject(value)
+                kept[name] = value
+            optimized[category] = kept
+        holder[NameObject('/Resources')] = optimized
+
+    def _canonical_xobject(self, ref):
+        """返回与 ref 内容相同的第一个XObject的引用"""
+        xobject = ref.get_object()
+        if xobject.get('/Subtype') == '/Form' and ref.idnum not in self._visited:
+            # 表单的资源只和自身内容流有关，先处理内部资源再计算哈希
+            self._visited.add(ref.idnum)
+            try:
+                content = xobject.get_data()
+            except Exception as e:
+                logging.warning(f"无法解码表单XObject，跳过资源裁剪: {str(e)}")
+                content = None
+            self._optimize_resources(xobject, content)
+            self._digests.pop(ref.idnum, None)
+
+        digest = self._digest(ref)
+        canonical = self._canonical.setdefault(digest, ref)
+        if canonical.idnum != ref.idnum:
+            self.xobjects_deduplicated += 1
+        return canonical
+
+    def optimize_page(self, page):
+        """原地优化单独生成的一页（逐页输出时使用）
+
+        只在页面内合并重复的XObject，页面之间内容相同的数据流由 PdfStreamWriter 在写出时合并；
+        每页来自独立的文档，对象编号互不相关，因此每页重新开始记录
+        """
+        self._digests = {}
+        self._canonical = {}
+        self._visited = set()
+        content = _page_content(page)
+        self._optimize_resources(page, content)
+        if content is not None:
+            # 页面的多个内容流合并为一个Flate压缩的内容流
+            stream = DecodedStreamObject()
+            stream.set_data(content)
+            page[NameObject('/Contents')] = stream.flate_encode()
+        return page
+
+    def optimize(self, input_file, output_file):
+        """优化 input_file 并写入 output_file"""
+        reader = PdfReader(input_file)
+        writer = PdfWriter()
+        for page in reader.pages:
+            content = _page_content(page)
+            self._optimize_resources(page, content)
+            if content is None:
+                writer.add_page(page)
+                continue
+            # 页面的多个内容流合并为一个Flate压缩的内容流，原内容流不再复制
+            new_page = writer.add_page(page, excluded_keys=('/Contents',))
+            stream = DecodedStreamObject()
+            stream.set_data(content)
+            new_page[NameObject('/Contents')] = writer._add_object(stream.flate_encode())
+        with open(output_file, 'wb') as f:
+            writer.write(f)
+
+
+def optimize_pdf(path):
+    """原地优化PDF文件，返回优化统计：优化前后大小、节省的字节数、合并的XObject数和删除的资源数"""
+    size_before = os.path.getsize(path)
+    optimizer = PdfOptimizer()
+    fd, temp_path = tempfile.mkstemp(prefix='optimize_', suffix='.pdf', dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        optimizer.optimize(path, temp_path)
+        size_after = os.path.getsize(temp_path)
+        if size_after < size_before:
+            # mkstemp 创建的文件权限为 0600，替换前沿用原文件的权限
+            shutil.copymode(path, temp_path)
+            os.replace(temp_path, path)
+        else:
+            # 优化后没有变小时保留原文件
+            size_after = size_before
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    stats = {
+        'bytes_before': size_before,
+        'bytes_after': size_after,
+        'bytes_saved': size_before - size_after,
+        'xobjects_deduplicated': optimizer.xobjects_deduplicated,
+        'resources_removed': optimizer.resources_removed,
+    }
+    logging.info(f"PDF优化完成: {size_before} -> {size_after} 字节，节省 {stats['bytes_saved']} 字节，"
+                 f"合并重复XObject {stats['xobjects_deduplicated']} 个，删除未使用资源 {stats['resources_removed']} 个")
+    return stats
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import io
+import hashlib
+from PyPDF2.generic import (
+    ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
+)
+
+PDF_HEADER = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+
+
+class PdfStreamWriter:
+    """逐页生成PDF数据，供边生成边发送使用
+
+    每添加一页就把该页及其引用的对象序列化到缓冲区，调用 read 取走后即可发送，不再保留；
+    页面树、文档目录、交叉引用表和 trailer 在 close 时最后写出。
+    内容完全相同的数据流（例如多页中重复的图片或字体）只写一次。
+    """
+
+    def __init__(self):
+        self._buffer = io.BytesIO()
+        self._buffer.write(PDF_HEADER)
+        self._position = 0  # 已被 read 取走的字节数
+        self._offsets = {}  # 对象编号 -> 在输出中的位置
+        self._next_id = 1
+        self._streams = {}  # 数据流内容摘要 -> 对象编号
+        self._imported = None
+        self._pages_ref = self._reserve()
+        self._kids = ArrayObject()
+        self.closed = False
+        self.streams_deduplicated = 0  # 因内容重复而没有再次写出的数据流个数和字节数
+        self.bytes_deduplicated = 0
+
+    @property
+    def page_count(self):
+        return len(self._kids)
+
+    @property
+    def bytes_written(self):
+        return self._position + self._buffer.tell()
+
+    def _reserve(self):
+        ref = IndirectObject(self._next_id, 0, self)
+        self._next_id += 1
+        return ref
+
+    def _write_object(self, ref, obj):
+        self._offsets[ref.idnum] = self.bytes_written
+        self._buffer.write(f'{ref.idnum} 0 obj\n'.encode('ascii'))
+        obj.write_to_stream(self._buffer, None)
+        self._buffer.write(b'\nendobj\n')
+
+    def _write_stream(self, stream):
+        """写出数据流并返回其引用，与已写出的数据流内容相同时直接返回已有的引用"""
+        data = io.BytesIO()
+        stream.write_to_stream(data, None)
+        digest = hashlib.sha1(data.getvalue()).digest()
+        if digest in self._streams:
+            self.streams_deduplicated += 1
+            self.bytes_deduplicated += data.tell()
+            return self._streams[digest]
+        ref = self._reserve()
+        self._write_object(ref, stream)
+        self._streams[digest] = ref
+        return ref
+
+    def _copy(self, obj):
+        """复制对象，其中的间接引用逐个写出后替换为新的对象编号"""
+        if isinstance(obj, IndirectObject):
+            key = obj.idnum
+            if key not in self._imported:
+                target = self._copy(obj.get_object())
+                if isinstance(target, StreamObject):
+                    self._imported[key] = self._write_stream(target)
+                else:
+                    ref = self._reserve()
+                    self._imported[key] = ref
+                    self._write_object(ref, target)
+            return self._imported[key]
+        if isinstance(obj, DictionaryObject):
+            copy = obj.__class__() if isinstance(obj, StreamObject) else DictionaryObject()
+            if isinstance(obj, StreamObject):
+                copy._data = obj._data
+            for key, value in obj.items():
+                if key != '/Parent':
+                    copy[NameObject(key)] = self._copy_value(value)
+            return copy
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._copy_value(item) for item in obj)
+        return obj
+
+    def _copy_value(self, obj):
+        """复制字典或数组中的值；直接嵌入的数据流（PDF要求数据流为间接对象）写为新的间接对象"""
+        if isinstance(obj, StreamObject):
+            return self._write_stream(self._copy(obj))
+        return self._copy(obj)
+
+    def add_page(self, page):
+        """复制页面及其引用的所有对象并写入缓冲区
+
+        页面来自单独生成的单页文档，每页的对象编号各自独立，页面之间不共享间接对象
+        """
+        if self.closed:
+            raise ValueError("PDF已写完，不能再添加页面")
+        self._imported = {}
+        try:
+            copy = self._copy(page.get_object())
+        finally:
+            self._imported = None
+        copy[NameObject('/Parent')] = self._pages_ref
+        ref = self._reserve()
+        self._write_object(ref, copy)
+        self._kids.append(ref)
+
+    def read(self):
+        """取走缓冲区中已生成的数据"""
+        data = self._buffer.getvalue()
+        self._position += len(data)
+        self._buffer = io.BytesIO()
+        return data
+
+    def close(self):
+        """写出页面树、文档目录、交叉引用表和 trailer，返回剩余的数据"""
+        if not self._kids:
+            raise ValueError("没有可输出的页面")
+        self._write_object(self._pages_ref, DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): self._kids,
+            NameObject('/Count'): NumberObject(len(self._kids)),
+        }))
+        root = self._reserve()
+        self._write_object(root, DictionaryObject({
+            NameObject('/Type'): NameObject('/Catalog'),
+            NameObject('/Pages'): self._pages_ref,
+        }))
+
+        xref_offset = self.bytes_written
+        self._buffer.write(f'xref\n0 {self._next_id}\n'.encode('ascii'))
+        self._buffer.write(b'0000000000 65535 f\r\n')
+        for idnum in range(1, self._next_id):
+            self._buffer.write(f'{self._offsets[idnum]:010d} 00000 n\r\n'.encode('ascii'))
+        trailer = DictionaryObject({
+            NameObject('/Size'): NumberObject(self._next_id),
+            NameObject('/Root'): root,
+        })
+        self._buffer.write(b'trailer\n')
+        trailer.write_to_stream(self._buffer, None)
+        self._buffer.write(f'\nstartxref\n{xref_offset}\n%%EOF\n'.encode('ascii'))
+        self.closed = True
+        return self.read()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+# 默认缓存容量上限：512MB
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# 写入失败后残留的临时文件超过该时间（秒）后清理
+STALE_TEMP_SECONDS = 3600
+
+
+class RasterCache:
+    """PDF渲染结果的磁盘缓存
+
+    以源文件内容的SHA-256和渲染参数（DPI、页码、颜色模式）作为键，
+    超过容量上限时按最近使用时间淘汰。写入使用临时文件加原子替换，
+    命中/未命中计数保存在缓存目录中，可以在多个 gunicorn 进程间共享。
+    """
+
+    STATS_FILE = 'stats.json'
+    LOCK_FILE = '.lock'
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _stream_digest(f):
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    @classmethod
+    def file_digest(cls, file_path):
+        """计算文件内容的SHA-256，file_path 可以是路径或提供 open() 的文件流对象"""
+        if hasattr(file_path, 'open'):
+            return cls._stream_digest(file_path.open())
+        with open(file_path, 'rb') as f:
+            return cls._stream_digest(f)
+
+    def make_key(self, file_path, dpi=None, page=1, mode='RGB', size=None):
+        """生成缓存键：内容哈希加渲染参数，按最长边像素数 size 渲染时不使用 dpi"""
+        scale = f"dpi{dpi}" if size is None else f"size{size}"
+        return f"{self.file_digest(file_path)}_{scale}_p{page}_{mode}"
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    @contextmanager
+    def _locked(self):
+        """跨进程互斥锁，保护计数和淘汰操作"""
+        with open(os.path.join(self.cache_dir, self.LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_counters(self):
+        try:
+            with open(os.path.join(self.cache_dir, self.STATS_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'hits': 0, 'misses': 0}
+
+    def _increment(self, name):
+        """原子地增加命中/未命中计数"""
+        try:
+            with self._locked():
+                counters = self._read_counters()
+                counters[name] = counters.get(name, 0) + 1
+                fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(counters, f)
+                os.replace(temp_path, os.path.join(self.cache_dir, self.STATS_FILE))
+        except OSError as e:
+            logging.warning(f"更新缓存计数时出错: {str(e)}")
+
+    def get(self, key):
+        """查找缓存，命中时返回图片路径并刷新其使用时间，否则返回None"""
+        path = self._entry_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self._increment('misses')
+            return None
+        self._increment('hits')
+        logging.info(f"位图缓存命中: {key}")
+        return path
+
+    def put(self, key, image):
+        """将渲染结果写入缓存并返回图片路径"""
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # 使用最快的压缩级别，缓存写入不应明显拖慢渲染
+                image.save(f, 'PNG', compress_level=1)
+            path = self._entry_path(key)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        logging.info(f"位图已写入缓存: {path}")
+        self.evict()
+        return path
+
+    def _entries(self):
+        """列出缓存文件，返回 (修改时间, 大小, 路径) 列表"""
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith('.png'):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            elif entry.name.endswith('.tmp') and now - stat.st_mtime > STALE_TEMP_SECONDS:
+                self._remove(entry.path)
+        return entries
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """按最近使用时间淘汰缓存，直到总大小不超过上限"""
+        with self._locked():
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+                logging.info(f"淘汰位图缓存: {path}")
+
+    def stats(self):
+        """返回缓存命中/未命中计数及占用情况"""
+        entries = self._entries()
+        counters = self._read_counters()
+        return {
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'entries': len(entries),
+            'size_bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self.max_bytes,
+        }
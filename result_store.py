@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import os
+import re
+import time
+import logging
+
+# 合并结果默认保留时间（秒）和总容量上限
+DEFAULT_RESULT_TTL = 3600
+DEFAULT_RESULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# 任务ID只允许字母、数字和连字符，避免路径穿越
+TASK_ID_PATTERN = re.compile(r'^[A-Za-z0-9-]+$')
+
+
+class ResultStore:
+    """合并结果存储
+
+    每个任务写入独立的输出文件，文件按任务ID命名，并发任务之间互不覆盖。
+    超过保留时间的结果会被删除，总大小超过上限时优先删除最早的结果。
+    """
+
+    def __init__(self, root, ttl=DEFAULT_RESULT_TTL, max_bytes=DEFAULT_RESULT_MAX_BYTES):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def path_for(self, task_id):
+        """任务的输出文件路径"""
+        if not TASK_ID_PATTERN.match(task_id):
+            raise ValueError(f"无效的任务ID: {task_id}")
+        return os.path.join(self.root, f"{task_id}.pdf")
+
+    def get(self, task_id):
+        """获取任务的输出文件，不存在或已过期时返回None"""
+        try:
+            path = self.path_for(task_id)
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                self.remove(task_id)
+                return None
+        except (ValueError, OSError):
+            return None
+        return path
+
+    def remove(self, task_id):
+        """删除任务的输出文件"""
+        try:
+            os.remove(self.path_for(task_id))
+            logging.info(f"已删除合并结果: {task_id}")
+        except (ValueError, FileNotFoundError):
+            pass
+
+    def cleanup(self):
+        """删除过期的结果，并在总大小超过上限时删除最早的结果"""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.root):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                self._remove_path(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove_path(path)
+            total -= size
+
+    @staticmethod
+    def _remove_path(path):
+        try:
+            os.remove(path)
+            logging.info(f"已清理合并结果: {path}")
+        except FileNotFoundError:
+            pass
@@ -10,6 +10,24 @@ document.addEventListener('DOMContentLoaded', function() {
     const progressMessage = document.getElementById('progressMessage');
 
     let progressCheckInterval = null;
+    let progressSource = null;
+
+    // 服务器繁忙（429）时的最多自动重试次数
+    const MAX_BUSY_RETRIES = 5;
+    // 进度推送连续失败多少次后改为轮询
+    const MAX_STREAM_FAILURES = 3;
+
+    // 分块上传：同时发送的分块数，以及单个分块在网络中断时的最多重试次数
+    const PARALLEL_CHUNKS = 4;
+    const MAX_CHUNK_RETRIES = 8;
+    // 本地保存未完成的上传会话，重新提交相同的文件时只发送缺少的分块
+    const UPLOAD_SESSION_KEY = 'invoiceUploadSession';
+
+    // 上传前缩小过的图片，重新提交相同的文件时直接使用，保证续传的内容与之前一致
+    const preparedFiles = new WeakMap();
+    let layoutPromise = null;
+    let resizeWorker = null;
+    let resizeRequests = 0;
 
     function showMessage(message, type) {
         messageArea.textContent = message;
@@ -21,7 +39,7 @@ document.addEventListener('DOMContentLoaded', function() {
         showMessage(message, 'danger');
         downloadArea.classList.add('d-none');
         progressArea.classList.add('d-none');
-        clearInterval(progressCheckInterval);
+        stopProgress();
     }
 
     function showSuccess(message) {
@@ -37,32 +55,306 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
+    function stopProgress() {
+        clearInterval(progressCheckInterval);
+        if (progressSource) {
+            progressSource.close();
+            progressSource = null;
+        }
+    }
+
+    // 处理一次进度更新，任务结束时返回 true
+    function handleStatus(data) {
+        if (data.status === 'unknown') {
+            showError('无法获取处理进度');
+            return true;
+        }
+
+        updateProgress(data.progress, data.message);
+
+        if (data.status === 'completed') {
+            stopProgress();
+            showSuccess('文件处理完成！');
+            downloadArea.classList.remove('d-none');
+            return true;
+        } else if (data.status === 'error' || data.status === 'cancelled') {
+            showError(data.message);
+            return true;
+        }
+        return false;
+    }
+
     function checkProgress(taskId) {
         fetch(`/progress/${taskId}`)
             .then(response => response.json())
-            .then(data => {
-                if (data.status === 'unknown') {
-                    clearInterval(progressCheckInterval);
-                    showError('无法获取处理进度');
+            .then(handleStatus)
+            .catch(error => {
+                console.error('Error:', error);
+                showError('检查进度时出错');
+            });
+    }
+
+    function startPolling(taskId) {
+        stopProgress();
+        progressCheckInterval = setInterval(() => checkProgress(taskId), 500);
+    }
+
+    // 优先使用服务器推送获取进度，不支持或连续多次连接失败时回退到轮询
+    //
+    // 服务器每隔一段时间主动关闭推送连接，浏览器按 retry 间隔携带 Last-Event-ID 自动重连；
+    // 连接成功或收到数据后重新计数，只有连续 MAX_STREAM_FAILURES 次未能建立连接才改为轮询。
+    // 推送连接已满时服务器返回503，浏览器不再重连（readyState 为 CLOSED），直接改为轮询
+    function watchProgress(taskId) {
+        if (!window.EventSource) {
+            startPolling(taskId);
+            return;
+        }
+        let failures = 0;
+        const source = new EventSource(`/progress/${taskId}/stream`);
+        progressSource = source;
+        source.onopen = () => {
+            failures = 0;
+        };
+        source.onmessage = event => {
+            failures = 0;
+            if (handleStatus(JSON.parse(event.data))) {
+                stopProgress();
+            }
+        };
+        source.onerror = () => {
+            failures++;
+            if (source.readyState === EventSource.CLOSED || failures >= MAX_STREAM_FAILURES) {
+                console.warn('进度推送多次连接失败，改为轮询');
+                startPolling(taskId);
+            }
+        };
+    }
+
+    function sleep(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+
+    // 按 Retry-After 倒计时等待，加入少量随机延迟，避免大量客户端同时重试
+    async function waitForRetry(seconds, attempt) {
+        const total = seconds + Math.random() * Math.min(seconds, 5);
+        for (let remaining = Math.ceil(total); remaining > 0; remaining--) {
+            showMessage(`服务器繁忙，${remaining} 秒后自动重试（第 ${attempt}/${MAX_BUSY_RETRIES} 次）`, 'warning');
+            await sleep(1000);
+        }
+        messageArea.classList.add('d-none');
+    }
+
+    // 需要直接展示给用户的错误
+    function uploadError(message) {
+        const error = new Error(message);
+        error.userFacing = true;
+        return error;
+    }
+
+    function waitForOnline() {
+        showMessage('网络连接已断开，恢复后自动继续上传', 'warning');
+        return new Promise(resolve => window.addEventListener('online', resolve, { once: true }));
+    }
+
+    // 以文件名、大小和修改时间标识一批文件
+    function uploadFingerprint(files, profile) {
+        return JSON.stringify([profile, ...Array.from(files, file => [file.name, file.size, file.lastModified])]);
+    }
+
+    // 相同的文件有未完成的上传会话时继续使用，否则创建新的会话
+    async function openUploadSession(files, profile) {
+        const fingerprint = uploadFingerprint(files, profile);
+        const saved = JSON.parse(localStorage.getItem(UPLOAD_SESSION_KEY) || 'null');
+        if (saved && saved.fingerprint === fingerprint) {
+            const response = await fetch(`/uploads/${saved.uploadId}`);
+            if (response.ok) {
+                return await response.json();
+            }
+        }
+        const response = await fetch('/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                files: Array.from(files, file => ({ name: file.name, size: file.size })),
+                profile: profile
+            })
+        });
+        const result = await response.json();
+        if (!response.ok) {
+            throw uploadError(result.error || '创建上传会话失败');
+        }
+        localStorage.setItem(UPLOAD_SESSION_KEY, JSON.stringify({ fingerprint: fingerprint, uploadId: result.upload_id }));
+        return result;
+    }
+
+    // 发送一个分块，网络中断或服务器错误时按指数退避重试，离线时等待网络恢复后继续
+    async function putChunk(uploadId, file, index, chunk, chunkSize) {
+        const body = file.slice(chunk * chunkSize, (chunk + 1) * chunkSize);
+        for (let attempt = 1; ; attempt++) {
+            try {
+                const response = await fetch(`/uploads/${uploadId}/files/${index}/chunks/${chunk}`, {
+                    method: 'PUT',
+                    body: body
+                });
+                if (response.ok) {
                     return;
                 }
+                if (response.status < 500 && response.status !== 429) {
+                    const result = await response.json().catch(() => ({}));
+                    throw uploadError(result.error || `上传文件 ${file.name} 失败`);
+                }
+            } catch (error) {
+                if (error.userFacing) {
+                    throw error;
+                }
+                console.warn(`分块 ${index}/${chunk} 发送失败，准备重试`, error);
+            }
+            if (attempt >= MAX_CHUNK_RETRIES) {
+                throw uploadError('网络连接不稳定，上传已暂停。请重新提交，已上传的部分不会重复发送');
+            }
+            if (!navigator.onLine) {
+                await waitForOnline();
+                messageArea.classList.add('d-none');
+            }
+            await sleep(Math.min(30000, 500 * 2 ** attempt) * (0.5 + Math.random()));
+        }
+    }
 
-                updateProgress(data.progress, data.message);
+    // 服务器的页面布局和各输出质量配置下图片的最大有效尺寸
+    function getLayout() {
+        if (!layoutPromise) {
+            layoutPromise = fetch('/layout').then(response => {
+                if (!response.ok) {
+                    throw new Error(`获取页面布局失败（${response.status}）`);
+                }
+                return response.json();
+            }).catch(error => {
+                layoutPromise = null;
+                throw error;
+            });
+        }
+        return layoutPromise;
+    }
 
-                if (data.status === 'completed') {
-                    clearInterval(progressCheckInterval);
-                    showSuccess('文件处理完成！');
-                    downloadArea.classList.remove('d-none');
-                } else if (data.status === 'error') {
-                    clearInterval(progressCheckInterval);
-                    showError(data.message);
+    // 在 Web Worker 中缩小一张图片，无需缩小或处理失败时返回原文件
+    function resizeInWorker(file, limits) {
+        if (!resizeWorker) {
+            resizeWorker = new Worker('/static/js/resize-worker.js');
+        }
+        const id = ++resizeRequests;
+        return new Promise(resolve => {
+            const onMessage = event => {
+                if (event.data.id !== id) {
+                    return;
                 }
-            })
-            .catch(error => {
-                console.error('Error:', error);
-                clearInterval(progressCheckInterval);
-                showError('检查进度时出错');
+                resizeWorker.removeEventListener('message', onMessage);
+                if (event.data.error) {
+                    console.warn(`图片 ${file.name} 预处理失败，上传原文件`, event.data.error);
+                }
+                if (!event.data.blob) {
+                    resolve(file);
+                    return;
+                }
+                resolve(new File([event.data.blob], file.name, {
+                    type: event.data.blob.type,
+                    lastModified: file.lastModified
+                }));
+            };
+            resizeWorker.addEventListener('message', onMessage);
+            resizeWorker.postMessage({
+                id: id,
+                file: file,
+                maxWidth: limits.max_width_px,
+                maxHeight: limits.max_height_px,
+                quality: limits.jpeg_quality
             });
+        });
+    }
+
+    // 上传前把超过输出分辨率的 JPEG/PNG 图片缩小到服务器实际使用的尺寸，
+    // 浏览器不支持 Web Worker 或 OffscreenCanvas 时上传原文件
+    async function prepareFiles(files, profile) {
+        if (!window.Worker || !window.OffscreenCanvas) {
+            return Array.from(files);
+        }
+        let limits;
+        try {
+            limits = (await getLayout()).profiles[profile];
+        } catch (error) {
+            console.warn('无法获取页面布局，上传原文件', error);
+            return Array.from(files);
+        }
+        const prepared = [];
+        for (const [index, file] of Array.from(files).entries()) {
+            const cached = preparedFiles.get(file);
+            if (cached && cached.profile === profile) {
+                prepared.push(cached.file);
+                continue;
+            }
+            let result = file;
+            if (limits && (file.type === 'image/jpeg' || file.type === 'image/png')) {
+                updateProgress(0, `正在压缩图片 ${index + 1}/${files.length}...`);
+                result = await resizeInWorker(file, limits);
+            }
+            preparedFiles.set(file, { profile: profile, file: result });
+            prepared.push(result);
+        }
+        return prepared;
+    }
+
+    // 分块上传所有文件，同时发送多个分块，跳过服务器已收到的分块，返回上传会话ID
+    async function uploadFiles(files, profile) {
+        const session = await openUploadSession(files, profile);
+        const chunkSize = session.chunk_size;
+        const total = session.files.reduce((sum, file) => sum + file.size, 0);
+        let sent = session.files.reduce((sum, file) => sum + file.received_bytes, 0);
+
+        const pending = [];
+        if (!session.complete) {
+            for (const file of session.files) {
+                const received = new Set(file.received);
+                for (let chunk = 0; chunk < file.chunks; chunk++) {
+                    if (!received.has(chunk)) {
+                        pending.push([file.index, chunk]);
+                    }
+                }
+            }
+        }
+
+        // 上传占总进度的40%，与服务器端的任务进度衔接
+        const report = () => updateProgress(
+            Math.floor(sent / total * 40),
+            `正在上传 ${(sent / 1048576).toFixed(1)}MB / ${(total / 1048576).toFixed(1)}MB`
+        );
+        report();
+
+        async function worker() {
+            while (pending.length) {
+                const [index, chunk] = pending.shift();
+                const file = files[index];
+                await putChunk(session.upload_id, file, index, chunk, chunkSize);
+                sent += Math.min(chunkSize, file.size - chunk * chunkSize);
+                report();
+            }
+        }
+        await Promise.all(Array.from({ length: PARALLEL_CHUNKS }, worker));
+        return session.upload_id;
+    }
+
+    // 提交请求，服务器返回429时按 Retry-After 等待后重新提交
+    async function postWithBusyRetry(url, body) {
+        for (let attempt = 1; ; attempt++) {
+            const response = await fetch(url, {
+                method: 'POST',
+                body: body
+            });
+            if (response.status !== 429 || attempt > MAX_BUSY_RETRIES) {
+                return response;
+            }
+            const retryAfter = parseInt(response.headers.get('Retry-After'), 10);
+            updateProgress(0, '等待服务器空闲...');
+            await waitForRetry(Number.isNaN(retryAfter) ? 5 : retryAfter, attempt);
+        }
     }
 
     form.addEventListener('submit', async function(e) {
@@ -74,19 +366,7 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
 
-        // 检查文件大小
-        for (let file of files) {
-            if (file.size > 16 * 1024 * 1024) {
-                showError(`文件 ${file.name} 太大，请确保每个文件不超过16MB`);
-                return;
-            }
-        }
-
-        // 准备表单数据
-        const formData = new FormData();
-        for (let file of files) {
-            formData.append('files[]', file);
-        }
+        const profile = document.getElementById('profile').value;
 
         // 开始上传
         submitBtn.disabled = true;
@@ -97,24 +377,28 @@ document.addEventListener('DOMContentLoaded', function() {
         updateProgress(0, '准备处理文件...');
 
         try {
-            const response = await fetch('/upload', {
-                method: 'POST',
-                body: formData
-            });
+            // 先在浏览器中缩小大图片，再分块上传，连接中断后重新提交时只发送缺少的分块
+            const prepared = await prepareFiles(files, profile);
+            const uploadId = await uploadFiles(prepared, profile);
+            updateProgress(40, '上传完成，等待处理...');
+            const response = await postWithBusyRetry(`/uploads/${uploadId}/complete`);
 
             const result = await response.json();
 
+            if (response.ok || response.status === 404) {
+                localStorage.removeItem(UPLOAD_SESSION_KEY);
+            }
             if (response.ok) {
                 // 开始检查进度
-                progressCheckInterval = setInterval(() => checkProgress(result.task_id), 500);
+                watchProgress(result.task_id);
                 downloadLink.href = result.download_url;
             } else {
-                showError(result.error || '处理文件时出错');
+                showError(response.status === 429 ? '服务器繁忙，请稍后再试' : (result.error || '处理文件时出错'));
                 submitBtn.disabled = false;
                 spinner.classList.add('d-none');
             }
         } catch (error) {
-            showError('上传文件时发生错误');
+            showError(error.userFacing ? error.message : '上传文件时发生错误');
             console.error('Error:', error);
             submitBtn.disabled = false;
             spinner.classList.add('d-none');
@@ -0,0 +1,103 @@
+// 上传前在后台线程中缩小发票图片，避免阻塞页面
+//
+// 收到 {id, file, maxWidth, maxHeight, quality}，图片超过 maxWidth x maxHeight 时等比缩小后重新编码：
+// JPEG 按 quality 编码为 JPEG，PNG 仍编码为 PNG（保留透明通道，由服务器决定最终编码）。
+// 返回 {id, blob, width, height}，无需或无法处理时 blob 为 null，页面上传原文件。
+
+// 读取 JPEG 的 EXIF 方向，读取失败或没有方向信息时返回 1
+function jpegOrientation(buffer) {
+    const view = new DataView(buffer);
+    if (view.byteLength < 4 || view.getUint16(0) !== 0xFFD8) {
+        return 1;
+    }
+    let offset = 2;
+    while (offset + 4 <= view.byteLength) {
+        const marker = view.getUint16(offset);
+        const length = view.getUint16(offset + 2);
+        // APP1 段中以 "Exif\0\0" 开头的为 EXIF 信息
+        if (marker === 0xFFE1 && offset + 10 <= view.byteLength && view.getUint32(offset + 4) === 0x45786966) {
+            const tiff = offset + 10;
+            const little = view.getUint16(tiff) === 0x4949;
+            const entries = tiff + view.getUint32(tiff + 4, little);
+            const count = view.getUint16(entries, little);
+            for (let i = 0; i < count; i++) {
+                const entry = entries + 2 + i * 12;
+                if (view.getUint16(entry, little) === 0x0112) {
+                    return view.getUint16(entry + 8, little);
+                }
+            }
+            return 1;
+        }
+        if ((marker & 0xFF00) !== 0xFF00 || marker === 0xFFDA) {
+            break;
+        }
+        offset += 2 + length;
+    }
+    return 1;
+}
+
+// 每次最多缩小一半，大比例缩小时比一次绘制更清晰
+async function resize(bitmap, width, height) {
+    let source = bitmap;
+    let currentWidth = bitmap.width;
+    let currentHeight = bitmap.height;
+    while (currentWidth > width || currentHeight > height) {
+        const nextWidth = Math.max(width, Math.ceil(currentWidth / 2));
+        const nextHeight = Math.max(height, Math.ceil(currentHeight / 2));
+        const canvas = new OffscreenCanvas(nextWidth, nextHeight);
+        const context = canvas.getContext('2d');
+        context.imageSmoothingQuality = 'high';
+        context.drawImage(source, 0, 0, nextWidth, nextHeight);
+        source = canvas;
+        currentWidth = nextWidth;
+        currentHeight = nextHeight;
+    }
+    return source;
+}
+
+async function process(message) {
+    const { file, maxWidth, maxHeight, quality } = message;
+    const isJpeg = file.type === 'image/jpeg';
+    if (!isJpeg && file.type !== 'image/png') {
+        return null;
+    }
+    // 无损归档配置不重新压缩 JPEG
+    if (isJpeg && quality === null) {
+        return null;
+    }
+    // 服务器按原始像素方向排版，带旋转信息的照片上传原文件，保证与服务器处理结果一致
+    if (isJpeg && jpegOrientation(await file.slice(0, 128 * 1024).arrayBuffer()) !== 1) {
+        return null;
+    }
+
+    const bitmap = await createImageBitmap(file, { imageOrientation: 'none' });
+    try {
+        const scale = Math.min(maxWidth / bitmap.width, maxHeight / bitmap.height);
+        if (scale >= 1) {
+            return null;
+        }
+        // 向下取整，保证服务器不会再次缩小和重新压缩
+        const width = Math.max(1, Math.floor(bitmap.width * scale));
+        const height = Math.max(1, Math.floor(bitmap.height * scale));
+        const canvas = await resize(bitmap, width, height);
+        const blob = isJpeg
+            ? await canvas.convertToBlob({ type: 'image/jpeg', quality: quality / 100 })
+            : await canvas.convertToBlob({ type: 'image/png' });
+        if (blob.size >= file.size) {
+            return null;
+        }
+        return { blob, width, height };
+    } finally {
+        bitmap.close();
+    }
+}
+
+self.onmessage = async event => {
+    const { id } = event.data;
+    try {
+        const result = await process(event.data);
+        self.postMessage(Object.assign({ id, blob: null }, result));
+    } catch (error) {
+        self.postMessage({ id, blob: null, error: String(error) });
+    }
+};
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+# 任务状态默认保留时间（秒），从最后一次更新开始计算
+DEFAULT_STATUS_TTL = 3600
+
+
+class MemoryStatusStore:
+    """进程内的任务状态存储，只适用于单进程部署"""
+
+    def __init__(self, ttl=DEFAULT_STATUS_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def set(self, task_id, status):
+        """写入任务状态，覆盖已有内容"""
+        with self._lock:
+            self._purge_locked()
+            self._entries[task_id] = (dict(status), time.time() + self.ttl)
+
+    def get(self, task_id):
+        """获取任务状态，不存在或已过期时返回None"""
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is None or entry[1] <= time.time():
+                return None
+            return dict(entry[0])
+
+    def update(self, task_id, **fields):
+        """合并更新任务状态并刷新过期时间"""
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is None or entry[1] <= time.time():
+                return False
+            entry[0].update(fields)
+            self._entries[task_id] = (entry[0], time.time() + self.ttl)
+            return True
+
+    def delete(self, task_id):
+        with self._lock:
+            self._entries.pop(task_id, None)
+
+    def _purge_locked(self):
+        now = time.time()
+        for task_id in [k for k, (_, expires_at) in self._entries.items() if expires_at <= now]:
+            del self._entries[task_id]
+
+    def purge_expired(self):
+        """删除所有已过期的任务状态"""
+        with self._lock:
+            self._purge_locked()
+
+
+class SQLiteStatusStore:
+    """基于 SQLite（WAL 模式）的任务状态存储
+
+    多个 gunicorn 工作进程共享同一个数据库文件，任一进程都可以查询任务进度。
+    每个线程使用独立的连接，更新通过一条 json_patch 语句原子完成。
+    注意：字段值为 None 时按 JSON Merge Patch 规则会删除该字段。
+    """
+
+    def __init__(self, db_path, ttl=DEFAULT_STATUS_TTL):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS job_status ('
+                'task_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS job_status_expires ON job_status (expires_at)')
+
+    def _connect(self):
+        """获取当前线程的数据库连接，fork 后的子进程会重新建立连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def set(self, task_id, status):
+        """写入任务状态，覆盖已有内容"""
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO job_status (task_id, data, expires_at) VALUES (?, ?, ?)',
+                (task_id, json.dumps(status), time.time() + self.ttl)
+            )
+
+    def get(self, task_id):
+        """获取任务状态，不存在或已过期时返回None"""
+        row = self._connect().execute(
+            'SELECT data FROM job_status WHERE task_id = ? AND expires_at > ?',
+            (task_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, task_id, **fields):
+        """合并更新任务状态并刷新过期时间"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'UPDATE job_status SET data = json_patch(data, ?), expires_at = ? '
+                'WHERE task_id = ? AND expires_at > ?',
+                (json.dumps(fields), time.time() + self.ttl, task_id, time.time())
+            )
+            return cursor.rowcount > 0
+
+    def delete(self, task_id):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM job_status WHERE task_id = ?', (task_id,))
+
+    def purge_expired(self):
+        """删除所有已过期的任务状态"""
+        with self._connect() as conn:
+            cursor = conn.execute('DELETE FROM job_status WHERE expires_at <= ?', (time.time(),))
+        if cursor.rowcount:
+            logging.info(f"已清理 {cursor.rowcount} 条过期任务状态")
+
+
+def create_status_store(backend, db_path=None, ttl=DEFAULT_STATUS_TTL):
+    """按名称创建任务状态存储：sqlite 或 memory"""
+    if backend == 'sqlite':
+        return SQLiteStatusStore(db_path, ttl)
+    if backend == 'memory':
+        return MemoryStatusStore(ttl)
+    raise ValueError(f"不支持的任务状态存储: {backend}")
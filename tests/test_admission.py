@@ -0,0 +1,49 @@
+import io
+import pytest
+from PIL import Image
+from reportlab.pdfgen import canvas
+from admission import AdmissionController, AdmissionRejected, estimate_cost, FILE_OVERHEAD_MPIX
+from invoice_input import InvoiceInput
+
+
+def test_estimate_cost(tmp_path):
+    """测试按图片像素数和PDF第一页在指定分辨率下的像素数估算开销，多页PDF只计第一页"""
+    buffer = io.BytesIO()
+    Image.new('RGB', (2000, 1000)).save(buffer, 'PNG')
+    pdf = tmp_path / 'invoice.pdf'
+    c = canvas.Canvas(str(pdf), pagesize=(720, 360))
+    c.showPage()
+    c.showPage()
+    c.save()
+
+    assert estimate_cost([InvoiceInput('scan.png', buffer)], dpi=100) == pytest.approx(FILE_OVERHEAD_MPIX + 2.0)
+    assert estimate_cost([str(pdf)], dpi=100) == pytest.approx(FILE_OVERHEAD_MPIX + 0.5)
+    assert estimate_cost([InvoiceInput('broken.pdf', io.BytesIO(b'xx'))], dpi=100) == FILE_OVERHEAD_MPIX
+
+
+def test_global_and_client_budgets():
+    """测试总预算和单个客户端预算用完后拒绝并给出重试时间，归还后可以再次接受"""
+    controller = AdmissionController(max_cost=100, client_max_cost=60)
+    first = controller.admit('a', 50)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit('a', 20)
+    assert rejected.value.retry_after >= 1
+    second = controller.admit('b', 50)
+    with pytest.raises(AdmissionRejected):
+        controller.admit('c', 10)
+
+    controller.release(first)
+    controller.release(first)
+    assert controller.in_flight == 50
+    controller.release(second)
+    assert controller.admit('a', 60).cost == 60
+
+
+def test_oversized_job_runs_alone():
+    """测试超过预算的单个任务在空闲时仍被接受"""
+    controller = AdmissionController(max_cost=10, client_max_cost=10)
+    ticket = controller.admit('a', 500)
+    with pytest.raises(AdmissionRejected):
+        controller.admit('b', 1)
+    controller.release(ticket)
+    assert controller.in_flight == 0
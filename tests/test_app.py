@@ -1,3 +1,4 @@
+import io
 import os
 import tempfile
 import pytest
@@ -39,3 +40,387 @@ def test_upload_empty(client):
     })
     assert rv.status_code == 400
     assert b'error' in rv.data
+
+def test_cache_stats(client):
+    """测试渲染缓存统计接口"""
+    rv = client.get('/cache/stats')
+    assert rv.status_code == 200
+    assert rv.get_json()['hits'] == 0
+
+def test_upload_returns_task_immediately(client):
+    """测试上传后立即返回任务ID，合并在后台完成"""
+    import time
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (100, 100), color='white').save(buffer, 'PNG')
+    buffer.seek(0)
+    rv = client.post('/upload', data={'files[]': (buffer, 'invoice.png')},
+                     content_type='multipart/form-data')
+    assert rv.status_code == 202
+    task_id = rv.get_json()['task_id']
+    for _ in range(50):
+        status = client.get(f'/jobs/{task_id}').get_json()
+        if status['status'] in ('completed', 'error'):
+            break
+        time.sleep(0.1)
+    assert status['status'] == 'completed'
+    rv = client.get(f'/jobs/{task_id}/result')
+    assert rv.status_code == 200
+    assert rv.data.startswith(b'%PDF')
+    rv.close()
+    # 下载后结果被删除
+    assert client.get(f'/jobs/{task_id}/result').status_code == 410
+
+def test_upload_with_cpu_pool_keeps_jpeg(client, monkeypatch):
+    """测试启用进程池（网页默认配置）时上传的JPEG照片仍原样嵌入，不被重新压缩"""
+    import time
+    import app as app_module
+    from PIL import Image
+    from cpu_pool import CpuPool
+    pool = CpuPool(size=2, queue_depth=1)
+    monkeypatch.setattr(app_module, 'cpu_pool', pool)
+    photos = []
+    for i in range(3):
+        buffer = io.BytesIO()
+        Image.effect_noise((800, 600), 40).convert('RGB').save(buffer, 'JPEG', quality=80)
+        photos.append(buffer.getvalue())
+    try:
+        rv = client.post('/upload', data={'files[]': [(io.BytesIO(data), f'photo{i}.jpg')
+                                                      for i, data in enumerate(photos)]},
+                         content_type='multipart/form-data')
+        assert rv.status_code == 202
+        task_id = rv.get_json()['task_id']
+        for _ in range(100):
+            status = client.get(f'/jobs/{task_id}').get_json()
+            if status['status'] in ('completed', 'error'):
+                break
+            time.sleep(0.1)
+        assert status['status'] == 'completed'
+        rv = client.get(f'/jobs/{task_id}/result')
+        assert all(data in rv.data for data in photos)
+        rv.close()
+    finally:
+        pool.shutdown()
+
+def test_merge_concurrent_outputs(client):
+    """测试同步合并接口为每个请求生成独立的结果文件并在下载后清理"""
+    from PIL import Image
+    outputs = []
+    for color in ('white', 'black'):
+        buffer = io.BytesIO()
+        Image.new('RGB', (100, 100), color=color).save(buffer, 'PNG')
+        buffer.seek(0)
+        rv = client.post('/merge', data={'files[]': (buffer, f'{color}.png')},
+                         content_type='multipart/form-data')
+        assert rv.status_code == 200
+        outputs.append(rv.data)
+        rv.close()
+    assert outputs[0] != outputs[1]
+    assert os.listdir(os.path.join(app.config['UPLOAD_FOLDER'], 'results')) == []
+
+def test_merge_streaming(client):
+    """测试逐页发送合并结果：分块响应，不写结果文件，发送完成后归还预算"""
+    import app as app_module
+    from PIL import Image
+    from PyPDF2 import PdfReader
+    data = {'stream': '1', 'files[]': []}
+    for i, color in enumerate(('white', 'black', 'red')):
+        buffer = io.BytesIO()
+        Image.new('RGB', (100, 100), color=color).save(buffer, 'PNG')
+        buffer.seek(0)
+        data['files[]'].append((buffer, f'{i}.png'))
+    rv = client.post('/merge', data=data, content_type='multipart/form-data')
+    assert rv.status_code == 200
+    assert rv.is_streamed
+    assert rv.content_length is None
+    body = rv.data
+    rv.close()
+    assert len(PdfReader(io.BytesIO(body)).pages) == 2
+    results = os.path.join(app.config['UPLOAD_FOLDER'], 'results')
+    assert not os.path.exists(results) or not os.listdir(results)
+    assert app_module.admission.in_flight == 0
+
+def test_merge_zip_upload(client):
+    """测试上传ZIP压缩包时合并其中的发票，超出成员数上限时返回400"""
+    import zipfile
+    from PIL import Image
+    from PyPDF2 import PdfReader
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        for i in range(3):
+            buffer = io.BytesIO()
+            Image.new('RGB', (100, 100), color='white').save(buffer, 'PNG')
+            zf.writestr(f'{i}.png', buffer.getvalue())
+    data = archive.getvalue()
+    rv = client.post('/merge', data={'files[]': (io.BytesIO(data), 'invoices.zip')},
+                     content_type='multipart/form-data')
+    assert rv.status_code == 200
+    assert len(PdfReader(io.BytesIO(rv.data)).pages) == 2
+    rv.close()
+
+    app.config['ARCHIVE_MAX_MEMBERS'] = 2
+    try:
+        rv = client.post('/upload', data={'files[]': (io.BytesIO(data), 'invoices.zip')},
+                         content_type='multipart/form-data')
+    finally:
+        app.config['ARCHIVE_MAX_MEMBERS'] = 500
+    assert rv.status_code == 400
+    assert '超过 2 个' in rv.get_json()['error']
+
+def test_chunked_upload_resume(client):
+    """测试分块上传：乱序和重复上传分块，查询已收到的分块后补发，完成后生成合并任务"""
+    import time
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.effect_noise((200, 200), 50).convert('RGB').save(buffer, 'PNG')
+    data = buffer.getvalue()
+    app.config['UPLOAD_CHUNK_BYTES'] = 4096
+    try:
+        rv = client.post('/uploads', json={'files': [{'name': 'scan.png', 'size': len(data)}]})
+    finally:
+        app.config['UPLOAD_CHUNK_BYTES'] = 4 * 1024 * 1024
+    assert rv.status_code == 201
+    session = rv.get_json()
+    chunk_size, chunks = session['chunk_size'], session['files'][0]['chunks']
+    assert chunks > 2
+    url = f"/uploads/{session['upload_id']}"
+
+    def put(n, body=None):
+        body = data[n * chunk_size:(n + 1) * chunk_size] if body is None else body
+        return client.put(f'{url}/files/0/chunks/{n}', data=body)
+
+    # 连接中断前只发送了部分分块，其中一个分块发送了两次
+    for n in (2, 0, 2):
+        assert put(n).status_code == 200
+    assert put(1, b'short').status_code == 400
+    assert client.post(f'{url}/complete').status_code == 409
+
+    # 恢复后只补发缺少的分块
+    received = client.get(url).get_json()['files'][0]['received']
+    assert received == [0, 2]
+    for n in range(chunks):
+        if n not in received:
+            assert put(n).status_code == 200
+    assert client.get(url).get_json()['complete']
+
+    rv = client.post(f'{url}/complete')
+    assert rv.status_code == 202
+    task_id = rv.get_json()['task_id']
+    assert client.post(f'{url}/complete').get_json()['task_id'] == task_id
+    for _ in range(50):
+        status = client.get(f'/jobs/{task_id}').get_json()
+        if status['status'] in ('completed', 'error'):
+            break
+        time.sleep(0.1)
+    assert status['status'] == 'completed'
+    rv = client.get(f'/jobs/{task_id}/result')
+    assert rv.data.startswith(b'%PDF')
+    rv.close()
+    # 任务结束后删除上传会话
+    for _ in range(20):
+        if client.get(url).status_code == 404:
+            break
+        time.sleep(0.05)
+    assert client.get(url).status_code == 404
+
+def test_complete_upload_when_job_finishes_first(client, monkeypatch):
+    """测试任务在提交返回之前就已结束并删除会话时，完成上传仍然返回202"""
+    import app as app_module
+    from flask import jsonify
+    data = b'%PDF-1.4 not really'
+    rv = client.post('/uploads', json={'files': [{'name': 'a.pdf', 'size': len(data)}]})
+    url = f"/uploads/{rv.get_json()['upload_id']}"
+    assert client.put(f'{url}/files/0/chunks/0', data=data).status_code == 200
+
+    def finished_job(inputs, profile, task_id=None, on_done=None):
+        for invoice in inputs:
+            invoice.close()
+        on_done()
+        return jsonify({'task_id': task_id}), 202
+
+    monkeypatch.setattr(app_module, 'start_merge_job', finished_job)
+    rv = client.post(f'{url}/complete')
+    assert rv.status_code == 202
+    assert client.get(url).status_code == 404
+
+def test_complete_upload_retry_after_rejection(client, monkeypatch):
+    """测试提交失败后撤销任务记录，客户端可以再次完成上传"""
+    import app as app_module
+    from flask import jsonify
+    data = b'%PDF-1.4 not really'
+    rv = client.post('/uploads', json={'files': [{'name': 'a.pdf', 'size': len(data)}]})
+    url = f"/uploads/{rv.get_json()['upload_id']}"
+    assert client.put(f'{url}/files/0/chunks/0', data=data).status_code == 200
+
+    calls = []
+
+    def submit(inputs, profile, task_id=None, on_done=None):
+        for invoice in inputs:
+            invoice.close()
+        calls.append(task_id)
+        if len(calls) == 1:
+            return jsonify({'error': '服务器繁忙'}), 429
+        return jsonify({'task_id': task_id}), 202
+
+    monkeypatch.setattr(app_module, 'start_merge_job', submit)
+    assert client.post(f'{url}/complete').status_code == 429
+    rv = client.post(f'{url}/complete')
+    assert rv.status_code == 202
+    assert client.post(f'{url}/complete').get_json()['task_id'] == rv.get_json()['task_id']
+
+def test_layout(client):
+    """测试页面布局接口返回各输出质量配置下图片的最大像素尺寸"""
+    from merge_invoices import OUTPUT_PROFILES, slot_pixel_size
+    rv = client.get('/layout')
+    assert rv.status_code == 200
+    layout = rv.get_json()
+    assert set(layout['profiles']) == set(OUTPUT_PROFILES)
+    for name, profile in layout['profiles'].items():
+        assert (profile['max_width_px'], profile['max_height_px']) == slot_pixel_size(name)
+        assert profile['jpeg_quality'] == OUTPUT_PROFILES[name]['jpeg_quality']
+    assert layout['profiles']['print']['max_width_px'] > layout['profiles']['screen']['max_width_px']
+
+def test_merge_invalid_profile(client):
+    """测试不支持的输出质量配置"""
+    rv = client.post('/merge', data={'files[]': (io.BytesIO(b'%PDF'), 'a.pdf'), 'profile': 'poster'},
+                     content_type='multipart/form-data')
+    assert rv.status_code == 400
+    assert '不支持的输出质量配置' in rv.get_json()['error']
+
+def test_upload_busy_returns_retry_after(client, monkeypatch):
+    """测试预算用完时返回429和 Retry-After，任务结束后归还预算"""
+    import app as app_module
+    from admission import AdmissionController
+    from PIL import Image
+    controller = AdmissionController(max_cost=1, client_max_cost=1)
+    monkeypatch.setattr(app_module, 'admission', controller)
+    busy = controller.admit('other', 1)
+
+    def upload():
+        buffer = io.BytesIO()
+        Image.new('RGB', (100, 100), color='white').save(buffer, 'PNG')
+        buffer.seek(0)
+        return client.post('/upload', data={'files[]': (buffer, 'invoice.png')},
+                           content_type='multipart/form-data')
+
+    rv = upload()
+    assert rv.status_code == 429
+    assert int(rv.headers['Retry-After']) >= 1
+    assert rv.get_json()['retry_after'] == int(rv.headers['Retry-After'])
+
+    controller.release(busy)
+    rv = upload()
+    assert rv.status_code == 202
+    task_id = rv.get_json()['task_id']
+    import time
+    for _ in range(100):
+        if client.get(f'/jobs/{task_id}').get_json()['status'] == 'completed':
+            break
+        time.sleep(0.05)
+    time.sleep(0.05)
+    assert controller.in_flight == 0
+
+def test_admission_uses_forwarded_client(client, monkeypatch):
+    """测试默认不信任 X-Forwarded-For，配置了反向代理层数后按其中的客户端地址申请预算"""
+    import app as app_module
+    from PIL import Image
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    clients = []
+    admit = app_module.admission.admit
+    monkeypatch.setattr(app_module.admission, 'admit', lambda client, cost: clients.append(client) or admit(client, cost))
+
+    def merge():
+        buffer = io.BytesIO()
+        Image.new('RGB', (100, 100), color='white').save(buffer, 'PNG')
+        buffer.seek(0)
+        rv = client.post('/merge', data={'files[]': (buffer, 'invoice.png')}, content_type='multipart/form-data',
+                         headers={'X-Forwarded-For': '203.0.113.7'}, environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        assert rv.status_code == 200
+        rv.close()
+
+    assert app_module.app.config['PROXY_FIX_HOPS'] == 0
+    merge()
+    # 与 PROXY_FIX_HOPS=1 时的配置相同
+    monkeypatch.setattr(app_module.app, 'wsgi_app', ProxyFix(app_module.app.wsgi_app, x_for=1, x_proto=1))
+    merge()
+    assert clients == ['10.0.0.2', '203.0.113.7']
+
+def test_metrics_endpoint(client):
+    """测试合并后 /metrics 以 Prometheus 文本格式导出阶段耗时和请求统计"""
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (100, 100), color='white').save(buffer, 'PNG')
+    buffer.seek(0)
+    client.post('/merge', data={'files[]': (buffer, 'white.png')}, content_type='multipart/form-data').close()
+    rv = client.get('/metrics')
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/plain'
+    body = rv.get_data(as_text=True)
+    assert 'invoice_merge_stage_seconds_count{stage="upload_save"}' in body
+    assert 'invoice_merge_stage_seconds_count{stage="pdf_write"}' in body
+    assert 'invoice_merge_pages_total' in body
+    assert 'invoice_http_request_seconds_count{endpoint="/merge",method="POST",status="200"}' in body
+
+def test_job_not_found(client):
+    """测试查询和取消不存在的任务"""
+    assert client.get('/jobs/missing').status_code == 404
+    assert client.post('/jobs/missing/cancel').status_code == 404
+
+def test_progress_stream(client):
+    """测试以 Server-Sent Events 推送已结束任务的状态"""
+    from app import job_manager
+    job_manager.create('stream-task', status='completed', progress=100)
+    rv = client.get('/progress/stream-task/stream')
+    assert rv.mimetype == 'text/event-stream'
+    body = rv.get_data(as_text=True)
+    assert '"status": "completed"' in body
+
+def test_progress_stream_resume(client, monkeypatch):
+    """测试推送连接按最长时间关闭，携带 Last-Event-ID 重连时不重复发送未变化的状态"""
+    import app as app_module
+    from app import job_manager
+    monkeypatch.setattr(app_module, 'SSE_MAX_DURATION', 0.2)
+    job_manager.create('resume-task', status='merging', progress=40)
+    body = client.get('/progress/resume-task/stream').get_data(as_text=True)
+    assert body.startswith('retry: ')
+    event_id = body.split('id: ', 1)[1].split('\n', 1)[0]
+    body = client.get('/progress/resume-task/stream', headers={'Last-Event-ID': event_id}).get_data(as_text=True)
+    assert 'data:' not in body
+    job_manager.update('resume-task', status='completed', progress=100)
+    body = client.get('/progress/resume-task/stream', headers={'Last-Event-ID': event_id}).get_data(as_text=True)
+    assert '"status": "completed"' in body
+
+def test_progress_stream_limit(client, monkeypatch):
+    """测试同时保持的推送连接数达到上限时返回503和 Retry-After，连接关闭后归还名额"""
+    import threading
+    import app as app_module
+    from app import job_manager
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(app_module, 'sse_slots', slots)
+    job_manager.create('limit-task', status='completed', progress=100)
+    # 另一个连接占用了唯一的名额
+    slots.acquire()
+    rv = client.get('/progress/limit-task/stream')
+    assert rv.status_code == 503
+    assert int(rv.headers['Retry-After']) >= 1
+    slots.release()
+    rv = client.get('/progress/limit-task/stream')
+    assert rv.status_code == 200
+    assert '"status": "completed"' in rv.get_data(as_text=True)
+    rv.close()
+    assert slots.acquire(blocking=False)
+
+def test_progress_stream_unknown(client):
+    """测试推送不存在任务的状态"""
+    rv = client.get('/progress/missing/stream')
+    assert '"status": "unknown"' in rv.get_data(as_text=True)
+
+def test_small_upload_kept_in_memory(client):
+    """测试小文件上传保存在内存中，不写入临时文件"""
+    from flask import request
+    with app.test_request_context('/upload', method='POST',
+                                  data={'files[]': (io.BytesIO(b'%PDF-1.4'), 'invoice.pdf')},
+                                  content_type='multipart/form-data'):
+        stream = request.files['files[]'].stream
+        assert isinstance(stream, tempfile.SpooledTemporaryFile)
+        assert not stream._rolled
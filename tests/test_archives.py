@@ -0,0 +1,59 @@
+import io
+import pickle
+import zipfile
+import pytest
+from PIL import Image
+from PyPDF2 import PdfReader
+from archives import ArchiveError, ArchiveMember, expand_archive, expand_inputs
+from invoice_input import InvoiceInput
+from merge_invoices import InvoiceMerger
+
+
+def make_zip(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    buffer.seek(0)
+    return InvoiceInput('invoices.zip', buffer)
+
+
+def png_bytes(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (200, 120), color=color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def test_expand_archive_lazy_members(tmp_path):
+    """测试只列出压缩包中的发票，成员在读取时才解压，合并结果保持顺序"""
+    archive = make_zip([
+        ('发票/a.png', png_bytes('red')),
+        ('readme.txt', b'ignored'),
+        ('__MACOSX/._a.png', b'ignored'),
+        ('发票/b.png', png_bytes('blue')),
+    ])
+    inputs = expand_inputs([archive])
+    assert [member.filename for member in inputs] == ['a.png', 'b.png']
+    assert all(isinstance(member, ArchiveMember) and member._stream is None for member in inputs)
+
+    # 跨进程传递时只发送解压后的内容，本进程中的数据随即释放
+    copy = pickle.loads(pickle.dumps(inputs[0]))
+    assert type(copy) is InvoiceInput and copy.read() == png_bytes('red')
+    assert inputs[0]._stream is None
+
+    output = tmp_path / 'merged.pdf'
+    InvoiceMerger().merge_files(inputs, str(output))
+    assert len(PdfReader(str(output)).pages) == 1
+    for member in inputs:
+        member.close()
+
+
+def test_expand_archive_limits():
+    """测试成员数和解压后总大小超出上限时拒绝压缩包"""
+    members = [(f'{i}.pdf', b'0' * 1024 * 1024) for i in range(3)]
+    with pytest.raises(ArchiveError, match='超过 2 个'):
+        expand_archive(make_zip(members), max_members=2)
+    with pytest.raises(ArchiveError, match='解压后超过 2MB'):
+        expand_archive(make_zip(members), max_bytes=2 * 1024 * 1024)
+    with pytest.raises(ArchiveError, match='无法读取压缩包'):
+        expand_archive(InvoiceInput('broken.zip', io.BytesIO(b'not a zip')))
@@ -0,0 +1,59 @@
+import json
+import os
+from PIL import Image
+from PyPDF2 import PdfReader
+from batch import run_batch, plan_parts, walk_directory, REPORT_FILE, DEFAULT_MAX_PAGES
+from merge_invoices import InvoiceMerger
+
+
+def make_invoices(directory, count):
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f'invoice{i:02d}.png')
+        Image.new('RGB', (400, 300), color=(i * 20, 0, 0)).save(path)
+        paths.append(path)
+    return paths
+
+
+def test_run_batch_splits_and_resumes(tmp_path):
+    """测试按页数分割输出、记录失败文件，重新运行时不再重新处理已完成的发票"""
+    inputs = make_invoices(str(tmp_path / 'in'), 5)
+    broken = tmp_path / 'in' / 'broken.png'
+    broken.write_bytes(b'not an image')
+    inputs = walk_directory(str(tmp_path / 'in'))
+    assert len(inputs) == 6
+
+    merger = InvoiceMerger(cache_max_bytes=0, optimize=False)
+    output = str(tmp_path / 'out' / 'archive.pdf')
+    report = run_batch(inputs, output, merger, max_pages=2)
+    assert report['succeeded'] == 5 and report['failed'] == 1
+    assert report['failures'][0]['path'] == str(broken)
+    assert [part['pages'] for part in report['outputs']] == [2, 1]
+    assert len(PdfReader(report['outputs'][0]['output']).pages) == 2
+    with open(os.path.join(report['work_dir'], REPORT_FILE), encoding='utf-8') as f:
+        assert json.load(f)['succeeded'] == 5
+
+    loaded = []
+    load_file = merger.load_file
+    merger.load_file = lambda path: loaded.append(path) or load_file(path)
+    resumed = run_batch(inputs, output, merger, max_pages=2)
+    assert resumed['resumed'] == 5
+    assert loaded == [str(broken)]
+    assert resumed['outputs'] == report['outputs']
+
+
+def test_plan_parts_by_size():
+    """测试按估算大小分割，单张超过上限的发票单独成为一份"""
+    records = [{'bytes': size} for size in (100_000, 100_000, 500_000, 100_000)]
+    parts = plan_parts(records, max_bytes=250_000)
+    assert [len(part) for part in parts] == [2, 1, 1]
+
+
+def test_run_batch_bounded_by_default(tmp_path):
+    """测试默认按 DEFAULT_MAX_PAGES 页分割输出，只有一份时直接写入输出文件"""
+    import inspect
+    assert inspect.signature(run_batch).parameters['max_pages'].default == DEFAULT_MAX_PAGES
+    inputs = make_invoices(str(tmp_path / 'in'), 3)
+    report = run_batch(inputs, str(tmp_path / 'single.pdf'), InvoiceMerger(cache_max_bytes=0, optimize=False))
+    assert [part['output'] for part in report['outputs']] == [str(tmp_path / 'single.pdf')]
@@ -0,0 +1,37 @@
+import os
+import hashlib
+from benchmark import build_corpus, run_merge_files, run_merge_invoices, CORPUS_KINDS
+
+
+def digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_corpus_is_deterministic(tmp_path):
+    """测试相同种子生成的语料内容完全一致"""
+    first = build_corpus(str(tmp_path / 'a'), seed=1, count=1, scale=0.1)
+    second = build_corpus(str(tmp_path / 'b'), seed=1, count=1, scale=0.1)
+    assert set(first) == set(CORPUS_KINDS) | {'mixed'}
+    for kind in CORPUS_KINDS:
+        assert [digest(p) for p in first[kind]] == [digest(p) for p in second[kind]]
+    assert len(first['mixed']) == len(CORPUS_KINDS)
+
+
+def test_run_merge_files_reports_stages(tmp_path):
+    """测试分阶段计时结果"""
+    corpus = build_corpus(str(tmp_path / 'corpus'), seed=1, count=1, scale=0.1)
+    stages, output_bytes = run_merge_files(corpus['mixed'], {}, str(tmp_path))
+    assert output_bytes == os.path.getsize(tmp_path / 'merge_files.pdf')
+    assert {'load', 'encode', 'stamp', 'optimize', 'layout_write', 'total'} <= set(stages)
+    assert stages['total'] >= stages['load']
+
+
+def test_stages_do_not_overlap(tmp_path):
+    """测试编码嵌套在读取中时耗时只计入 encode，各阶段之和不超过总耗时"""
+    corpus = build_corpus(str(tmp_path / 'corpus'), seed=1, count=1, scale=0.1)
+    for run in (run_merge_files, run_merge_invoices):
+        stages, _ = run(corpus['mixed'], {}, str(tmp_path))
+        assert stages['encode'] > 0
+        measured = sum(seconds for stage, seconds in stages.items() if stage not in ('layout_write', 'total'))
+        assert measured <= stages['total']
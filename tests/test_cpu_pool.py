@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+import pytest
+from PIL import Image
+from reportlab.pdfgen import canvas
+from PyPDF2 import PdfReader
+from cpu_pool import CpuPool
+from merge_invoices import InvoiceMerger
+
+
+@pytest.fixture
+def pool():
+    pool = CpuPool(size=2, queue_depth=1)
+    yield pool
+    pool.shutdown()
+
+
+def test_pool_uses_fixed_processes(pool):
+    """测试所有工作在固定数量的子进程中执行"""
+    pids = {future.result() for future in [pool.submit(os.getpid) for _ in range(12)]}
+    assert os.getpid() not in pids
+    assert 1 <= len(pids) <= 2
+
+
+def test_pool_does_not_fork_threaded_parent(pool):
+    """测试子进程由 forkserver 启动，不直接从多线程的工作进程 fork"""
+    assert pool.submit(os.getppid).result() != os.getpid()
+
+
+def test_pool_blocks_when_queue_full(pool):
+    """测试执行中和排队中的工作达到上限后 submit 阻塞，直到有工作完成"""
+    futures = [pool.submit(time.sleep, 0.3) for _ in range(3)]
+    submitted = threading.Event()
+
+    def submit_more():
+        futures.append(pool.submit(time.sleep, 0))
+        submitted.set()
+
+    thread = threading.Thread(target=submit_more)
+    thread.start()
+    assert not submitted.wait(0.1)
+    assert submitted.wait(5)
+    thread.join()
+    for future in futures:
+        future.result()
+
+
+def test_merge_files_with_shared_pool(pool, tmp_path):
+    """测试使用共享进程池合并时输出顺序不变，合并结束后进程池仍可使用"""
+    pdfs = []
+    for i in range(4):
+        path = tmp_path / f'invoice{i}.pdf'
+        c = canvas.Canvas(str(path), pagesize=(680, 397))
+        c.drawString(50, 100, f'INVOICE-{i}')
+        c.save()
+        pdfs.append(str(path))
+    for run in range(2):
+        output = tmp_path / f'merged{run}.pdf'
+        InvoiceMerger(executor=pool).merge_files(pdfs, str(output))
+        text = ''.join(page.extract_text() for page in PdfReader(str(output)).pages)
+        positions = [text.index(f'INVOICE-{i}') for i in range(4)]
+        assert positions == sorted(positions)
+
+
+def test_pooled_output_matches_serial(pool, tmp_path, monkeypatch):
+    """测试进程池中合并的输出与串行合并逐字节相同（JPEG原样嵌入和解码时缩小不因跨进程传递而失效）"""
+    from reportlab import rl_config
+    monkeypatch.setattr(rl_config, 'invariant', 1)
+    photos = []
+    for i, size in enumerate([(1200, 800), (4000, 3000), (800, 1200), (3000, 4000)]):
+        path = tmp_path / f'photo{i}.jpg'
+        Image.effect_noise(size, 40).convert('RGB').save(path, quality=85)
+        photos.append(str(path))
+    outputs = []
+    for name, merger in [('serial', InvoiceMerger()), ('workers', InvoiceMerger(workers=2)),
+                         ('pool', InvoiceMerger(executor=pool))]:
+        output = tmp_path / f'{name}.pdf'
+        merger.merge_files(photos, str(output))
+        outputs.append(output.read_bytes())
+    assert outputs[0] == outputs[1] == outputs[2]
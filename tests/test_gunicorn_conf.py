@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_config_prepares_metrics_dir_before_preload(tmp_path):
+    """测试加载 gunicorn 配置后指标目录已存在，预先导入应用不会因缺少目录而失败"""
+    metrics_dir = tmp_path / 'metrics'
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(metrics_dir), UPLOAD_FOLDER=str(tmp_path / 'uploads'))
+    env.pop('INVOICE_METRICS_DIR_READY', None)
+    script = (
+        "import runpy; runpy.run_path('gunicorn.conf.py'); "
+        "import app, metrics; metrics.PAGES.inc(); print('ok')"
+    )
+    result = subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().endswith('ok')
+    assert any(name.endswith('.db') for name in os.listdir(metrics_dir))
+
+
+def test_admission_budget_split_across_workers(tmp_path):
+    """测试准入预算按 gunicorn 工作进程数平分，所有工作进程合计不超过配置的上限"""
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path / 'metrics'), UPLOAD_FOLDER=str(tmp_path / 'uploads'),
+               GUNICORN_WORKERS='4', ADMISSION_MAX_MPIX='2000', ADMISSION_CLIENT_MAX_MPIX='800')
+    env.pop('INVOICE_METRICS_DIR_READY', None)
+    script = (
+        "import runpy; runpy.run_path('gunicorn.conf.py'); "
+        "import app; print(app.admission.max_cost, app.admission.client_max_cost)"
+    )
+    result = subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split()[-2:] == ['500.0', '200.0']
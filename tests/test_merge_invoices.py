@@ -1,7 +1,7 @@
 import os
 import tempfile
 import pytest
-from merge_invoices import InvoiceMerger
+from merge_invoices import InvoiceMerger, EncodedImage
 from PIL import Image
 
 @pytest.fixture
@@ -33,3 +33,378 @@ def test_calculate_image_size(merger):
     original_ratio = 1000 / 2000
     new_ratio = width / height
     assert abs(original_ratio - new_ratio) < 0.01  # 允许小误差
+
+@pytest.fixture
+def test_pdf():
+    # 创建一个测试用的矢量PDF文件
+    from reportlab.pdfgen import canvas
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as f:
+        c = canvas.Canvas(f.name, pagesize=(680, 397))
+        c.drawString(50, 100, 'INVOICE')
+        c.save()
+        yield f.name
+    os.remove(f.name)
+
+def test_merge_files_vector_pdf(merger, test_pdf, test_image, tmp_path):
+    """测试矢量模式下PDF页面以表单XObject嵌入"""
+    from PyPDF2 import PdfReader
+    output = tmp_path / 'merged.pdf'
+    merger.merge_files([test_pdf, test_image], str(output))
+    reader = PdfReader(str(output))
+    assert len(reader.pages) == 1
+    xobjects = reader.pages[0]['/Resources']['/XObject']
+    forms = [x.get_object() for x in xobjects.values() if x.get_object()['/Subtype'] == '/Form']
+    assert len(forms) == 1
+    assert 'INVOICE' in reader.pages[0].extract_text()
+
+def test_merge_files_keeps_annotations(merger, tmp_path):
+    """测试矢量嵌入时PDF页面上的注释（例如文本框、签章）以外观流展平到输出中"""
+    from PyPDF2 import PdfReader, PdfWriter
+    from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, FloatObject, NameObject
+    source = PdfReader(_invoice_pdfs(tmp_path, ['INVOICE-A'])[0])
+    writer = PdfWriter()
+    page = writer.add_page(source.pages[0])
+    appearance = DecodedStreamObject()
+    appearance.set_data(b'BT /Helv 12 Tf 2 2 Td (STAMP-TEXT) Tj ET')
+    appearance.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Form'),
+        NameObject('/BBox'): ArrayObject([FloatObject(v) for v in (0, 0, 100, 20)]),
+        NameObject('/Resources'): DictionaryObject({NameObject('/Font'): DictionaryObject({
+            NameObject('/Helv'): DictionaryObject({
+                NameObject('/Type'): NameObject('/Font'),
+                NameObject('/Subtype'): NameObject('/Type1'),
+                NameObject('/BaseFont'): NameObject('/Helvetica'),
+            }),
+        })}),
+    })
+    annot = DictionaryObject({
+        NameObject('/Type'): NameObject('/Annot'),
+        NameObject('/Subtype'): NameObject('/FreeText'),
+        NameObject('/Rect'): ArrayObject([FloatObject(v) for v in (400, 300, 600, 340)]),
+        NameObject('/AP'): DictionaryObject({NameObject('/N'): writer._add_object(appearance)}),
+    })
+    page[NameObject('/Annots')] = ArrayObject([writer._add_object(annot)])
+    annotated = tmp_path / 'annotated.pdf'
+    with open(annotated, 'wb') as f:
+        writer.write(f)
+
+    output = tmp_path / 'merged.pdf'
+    merger.merge_files([str(annotated)], str(output))
+    form = next(iter(PdfReader(str(output)).pages[0]['/Resources']['/XObject'].values())).get_object()
+    nested = [x.get_object() for x in form['/Resources']['/XObject'].values()]
+    assert any(b'STAMP-TEXT' in x.get_data() for x in nested)
+    # 外观流的 /BBox（100x20）映射到注释的 /Rect（200x40）
+    assert b'2.0000 0.0000 0.0000 2.0000 400.0000 300.0000 cm /Annot0 Do' in form.get_data()
+
+def test_load_pdf_page_broken_file(merger, tmp_path):
+    """测试损坏的PDF文件回退到位图模式"""
+    broken = tmp_path / 'broken.pdf'
+    broken.write_bytes(b'not a pdf')
+    assert merger.load_pdf_page(str(broken)) is None
+
+def test_get_render_dpi(merger, monkeypatch):
+    """测试根据放置尺寸计算渲染DPI"""
+    import merge_invoices
+    monkeypatch.setattr(merge_invoices, 'pdfinfo_from_path',
+                        lambda path: {'Pages': 3, 'Page size': '595.276 x 841.89 pts (A4)', 'Page rot': '0'})
+    # A4页面缩放到 555x391 点的位置，约为原尺寸的 0.46 倍
+    dpi = merger.get_render_dpi('invoice.pdf', 555, 391)
+    assert dpi == round(merger.raster_dpi * 391 / 841.89)
+    assert dpi < 600
+
+def test_merge_files_parallel_keeps_order(tmp_path):
+    """测试并行处理时输出顺序与输入顺序一致"""
+    from PyPDF2 import PdfReader
+    from reportlab.pdfgen import canvas
+    pdfs = []
+    for i in range(4):
+        path = tmp_path / f'invoice{i}.pdf'
+        c = canvas.Canvas(str(path), pagesize=(680, 397))
+        c.drawString(50, 100, f'INVOICE-{i}')
+        c.save()
+        pdfs.append(str(path))
+    progress = []
+    output = tmp_path / 'merged.pdf'
+    InvoiceMerger(workers=2).merge_files(pdfs, str(output), lambda *args: progress.append(args))
+    reader = PdfReader(str(output))
+    text = ''.join(page.extract_text() for page in reader.pages)
+    assert [text.index(f'INVOICE-{i}') for i in range(4)] == sorted(text.index(f'INVOICE-{i}') for i in range(4))
+    assert len([p for p in progress if p[2].endswith('.pdf')]) == 4
+
+def test_merge_invoices_output_mode(test_image, tmp_path, monkeypatch):
+    """测试未指定输出路径时生成的文件按 umask 设置权限，而不是临时文件的 0600"""
+    from werkzeug.datastructures import FileStorage
+    monkeypatch.setenv('UPLOAD_FOLDER', str(tmp_path))
+    umask = os.umask(0o022)
+    try:
+        with open(test_image, 'rb') as f:
+            output = InvoiceMerger().merge_invoices([FileStorage(f, filename='invoice.png')])
+    finally:
+        os.umask(umask)
+    assert os.stat(output).st_mode & 0o777 == 0o644
+
+def test_merge_invoices_encodes_once(test_image, tmp_path, monkeypatch):
+    """测试 merge_invoices 在读取时按放置尺寸编码图片，绘制时不再重新编码"""
+    from werkzeug.datastructures import FileStorage
+    from PyPDF2 import PdfReader
+    merger = InvoiceMerger(optimize=False)
+    encoded = []
+    original = merger.encode_image
+    monkeypatch.setattr(merger, 'encode_image', lambda *args: encoded.append(args) or original(*args))
+    output = tmp_path / 'merged.pdf'
+    with open(test_image, 'rb') as first, open(test_image, 'rb') as second:
+        merger.merge_invoices([FileStorage(first, filename='a.png'), FileStorage(second, filename='b.png')],
+                              str(output))
+    assert len(encoded) == 2
+    assert len(PdfReader(str(output)).pages) == 1
+
+def test_iter_invoice_pairs(merger, test_image):
+    """测试逐对产出发票，文件不存在时跳过"""
+    pairs = list(merger.iter_invoice_pairs([test_image, 'missing.png', test_image, test_image]))
+    assert [len(pair) for pair in pairs] == [2, 1]
+    assert all(isinstance(image, EncodedImage) for pair in pairs for image in pair)
+
+def test_convert_pdf_to_image_uses_cache(test_pdf, tmp_path, monkeypatch):
+    """测试重复转换同一PDF时命中渲染缓存"""
+    import merge_invoices
+    calls = []
+
+    def fake_convert(path, **kwargs):
+        calls.append(kwargs)
+        return [Image.new('RGB', (20, 20), color='white')]
+
+    monkeypatch.setattr(merge_invoices, 'convert_from_path', fake_convert)
+    merger = InvoiceMerger(pdf_mode='raster', cache_dir=str(tmp_path / 'cache'))
+    first = merger.convert_pdf_to_image(test_pdf)
+    second = merger.convert_pdf_to_image(test_pdf)
+    assert isinstance(first, Image.Image) and isinstance(second, Image.Image)
+    assert first.size == second.size == (20, 20)
+    assert len(calls) == 1
+    assert calls[0]['first_page'] == calls[0]['last_page'] == 1
+    assert merger.raster_cache.stats()['hits'] == 1
+
+def test_convert_pdf_to_image_without_temp_file(test_pdf, tmp_path, monkeypatch):
+    """测试未启用缓存时渲染结果直接以图片对象返回，不写临时PNG文件"""
+    import merge_invoices
+    rendered = Image.new('RGB', (20, 20), color='white')
+    monkeypatch.setattr(merge_invoices, 'convert_from_path', lambda path, **kwargs: [rendered])
+    monkeypatch.setenv('UPLOAD_FOLDER', str(tmp_path))
+    merger = InvoiceMerger(pdf_mode='raster', cache_max_bytes=0)
+    assert merger.convert_pdf_to_image(test_pdf) is rendered
+    assert list(tmp_path.iterdir()) == []
+
+def test_merge_files_from_streams(test_pdf, tmp_path):
+    """测试直接从内存中的文件流合并，无需先保存到磁盘"""
+    import io
+    from PyPDF2 import PdfReader
+    from invoice_input import InvoiceInput
+    image = io.BytesIO()
+    Image.new('RGB', (100, 100), color='white').save(image, 'PNG')
+    with open(test_pdf, 'rb') as f:
+        pdf = io.BytesIO(f.read())
+    inputs = [InvoiceInput('发票.pdf', pdf), InvoiceInput('receipt.png', image)]
+    output = tmp_path / 'merged.pdf'
+    InvoiceMerger(workers=2).merge_files(inputs, str(output))
+    reader = PdfReader(str(output))
+    assert len(reader.pages) == 1
+    assert 'INVOICE' in reader.pages[0].extract_text()
+
+def test_image_reader_profiles(tmp_path):
+    """测试按输出质量配置缩小图片，照片使用JPEG编码，线条图使用无损编码"""
+    from PIL import ImageDraw
+    photo_path = tmp_path / 'photo.jpg'
+    Image.effect_noise((1200, 900), 60).convert('RGB').save(photo_path, quality=95)
+    line_art = Image.new('RGB', (1200, 900), color='white')
+    ImageDraw.Draw(line_art).text((10, 10), 'INVOICE ' * 20, fill='black')
+
+    merger = InvoiceMerger(profile='screen')
+    photo = merger.image_reader(Image.open(photo_path), 360, 270)
+    assert photo.jpeg_fh() is not None
+    assert photo.getSize() == (500, 375)
+    line = merger.image_reader(line_art, 360, 270)
+    assert line.jpeg_fh() is None
+    assert line.getSize() == (500, 375)
+
+    # 无需缩小的JPEG原图直接嵌入原始数据
+    archived = InvoiceMerger(profile='archive').image_reader(Image.open(photo_path), 360, 270)
+    assert archived.jpeg_fh().read() == photo_path.read_bytes()
+
+
+def test_slot_pixel_size_passthrough(tmp_path):
+    """测试按 slot_pixel_size 等比缩小的JPEG（浏览器端预处理的结果）经进程池合并时不会被再次缩小和重新压缩"""
+    import math
+    from cpu_pool import CpuPool
+    from merge_invoices import OUTPUT_PROFILES, slot_pixel_size
+    pool = CpuPool(size=2, queue_depth=1)
+    try:
+        for profile in OUTPUT_PROFILES:
+            max_width, max_height = slot_pixel_size(profile)
+            paths = []
+            for original in ((4000, 3000), (3000, 4000), (6000, 1000)):
+                scale = min(max_width / original[0], max_height / original[1])
+                size = (math.floor(original[0] * scale), math.floor(original[1] * scale))
+                path = tmp_path / f'{profile}_{size[0]}x{size[1]}.jpg'
+                Image.effect_noise(size, 40).convert('RGB').save(path, quality=80)
+                paths.append(path)
+            output = tmp_path / f'{profile}.pdf'
+            InvoiceMerger(profile=profile, executor=pool).merge_files([str(path) for path in paths], str(output))
+            data = output.read_bytes()
+            assert all(path.read_bytes() in data for path in paths)
+    finally:
+        pool.shutdown()
+
+def test_register_fonts_once_and_subset(test_image, tmp_path, monkeypatch):
+    """测试字体在进程内只解析一次，输出中只嵌入用到的字形子集"""
+    import reportlab
+    import merge_invoices
+    font_path = os.path.join(os.path.dirname(reportlab.__file__), 'fonts', 'Vera.ttf')
+    monkeypatch.setattr(merge_invoices, 'FONT_PATHS', [font_path])
+    monkeypatch.setattr(merge_invoices, '_fonts_registered', False)
+    monkeypatch.setattr(merge_invoices, '_label_font', None)
+    loaded = []
+    original = merge_invoices.TTFont
+
+    def counting_ttfont(*args, **kwargs):
+        loaded.append(args)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(merge_invoices, 'TTFont', counting_ttfont)
+    first = InvoiceMerger(optimize=False)
+    InvoiceMerger(optimize=False)
+    assert len(loaded) == 1
+    assert first.label_font == 'Vera'
+
+    output = tmp_path / 'labeled.pdf'
+    from werkzeug.datastructures import FileStorage
+    with open(test_image, 'rb') as f:
+        first.merge_invoices([FileStorage(f, filename='invoice.png')], str(output))
+    from PyPDF2 import PdfReader
+    fonts = PdfReader(str(output)).pages[0]['/Resources']['/Font']
+    subsets = [font.get_object() for font in fonts.values() if '/FontDescriptor' in font.get_object()]
+    descriptor = subsets[0]['/FontDescriptor']
+    embedded = descriptor['/FontFile2'].get_object().get_data()
+    assert len(embedded) < os.path.getsize(font_path) / 2
+
+
+def test_render_dpi_respects_pixel_budget(monkeypatch):
+    """测试超大页面按像素预算降低渲染DPI"""
+    import merge_invoices
+    # 5米长的小票，按最低DPI渲染也远超预算
+    monkeypatch.setattr(merge_invoices, 'pdfinfo_from_path',
+                        lambda path: {'Page size': '226.77 x 14173.2 pts', 'Page rot': '0'})
+    merger = InvoiceMerger(max_page_pixels=2_000_000)
+    dpi = merger.get_render_dpi('receipt.pdf')
+    assert dpi < merge_invoices.MIN_RENDER_DPI
+    assert (226.77 * dpi / 72) * (14173.2 * dpi / 72) <= 2_000_000
+
+    # 单张发票的预算与并行进程数无关，任务预算只限制同时提交的文件数
+    assert InvoiceMerger(workers=4, max_page_pixels=5_000_000).page_pixel_budget() == 5_000_000
+    merger = InvoiceMerger(workers=4, max_page_pixels=5_000_000, max_job_pixels=10_000_000)
+    assert merger.page_pixel_budget() == 5_000_000
+    assert merger.submit_window(4) == 2
+    assert InvoiceMerger(max_page_pixels=5_000_000, max_job_pixels=1_000_000).submit_window(4) == 1
+
+
+def test_render_unknown_page_size_limits_size(test_pdf, monkeypatch):
+    """测试无法获取页面尺寸时限定渲染结果的最长边"""
+    import merge_invoices
+    calls = []
+
+    def broken_pdfinfo(path):
+        raise RuntimeError('pdfinfo failed')
+
+    def fake_convert(path, **kwargs):
+        calls.append(kwargs)
+        return [Image.new('RGB', (20, 20))]
+
+    monkeypatch.setattr(merge_invoices, 'pdfinfo_from_path', broken_pdfinfo)
+    monkeypatch.setattr(merge_invoices, 'convert_from_path', fake_convert)
+    merger = InvoiceMerger(pdf_mode='raster', cache_max_bytes=0, max_page_pixels=1_000_000)
+    merger.convert_pdf_to_image(test_pdf)
+    assert 'dpi' not in calls[0]
+    assert calls[0]['size'] ** 2 <= 1_000_000
+
+
+def test_oversized_images_fit_pixel_budget(tmp_path):
+    """测试超过预算的JPEG在解码时缩小，无法在解码时缩小的图片不解码、直接拒绝"""
+    merger = InvoiceMerger(max_page_pixels=1_000_000)
+    jpeg = tmp_path / 'scan.jpg'
+    Image.new('RGB', (4000, 3000)).save(jpeg)
+    image = merger.process_image(str(jpeg))
+    image.load()
+    assert image.width * image.height <= 1_000_000
+
+    huge = tmp_path / 'huge.jpg'
+    Image.new('L', (9000, 8000)).save(huge)
+    with pytest.raises(ValueError):
+        merger.process_image(str(huge))
+
+    from PIL import ImageFile
+    decoded = []
+    original = ImageFile.ImageFile.load
+    for mode in ('RGB', 'P', '1'):
+        png = tmp_path / f'scan_{mode}.png'
+        Image.new(mode, (4000, 3000)).save(png)
+        with pytest.MonkeyPatch.context() as patch:
+            patch.setattr(ImageFile.ImageFile, 'load', lambda self: decoded.append(self) or original(self))
+            with pytest.raises(ValueError):
+                merger.process_image(str(png))
+        assert not decoded
+
+    small = tmp_path / 'small.png'
+    Image.new('RGB', (1000, 1000)).save(small)
+    output = tmp_path / 'merged.pdf'
+    merger.merge_files([str(tmp_path / 'scan_RGB.png'), str(small)], str(output))
+    from PyPDF2 import PdfReader
+    assert len(PdfReader(str(output)).pages) == 1
+
+
+def test_merge_files_skips_unreadable_file(merger, test_image, tmp_path):
+    """测试单个文件无法处理时只跳过该文件，其他发票照常合并"""
+    from PyPDF2 import PdfReader
+    broken = tmp_path / 'broken.png'
+    broken.write_bytes(b'not an image')
+    output = tmp_path / 'merged.pdf'
+    merger.merge_files([test_image, str(broken), test_image], str(output))
+    assert len(PdfReader(str(output)).pages) == 1
+
+def _invoice_pdfs(tmp_path, names):
+    from reportlab.pdfgen import canvas
+    pdfs = []
+    for name in names:
+        path = tmp_path / f'{name}.pdf'
+        c = canvas.Canvas(str(path), pagesize=(680, 397))
+        c.drawString(50, 100, name)
+        c.save()
+        pdfs.append(str(path))
+    return pdfs
+
+def test_append_fills_free_slot(merger, tmp_path):
+    """测试追加时先填入最后一页的空位，原文件内容作为前缀保持不变"""
+    from PyPDF2 import PdfReader
+    output = tmp_path / 'merged.pdf'
+    merger.merge_files(_invoice_pdfs(tmp_path, ['INVOICE-A', 'INVOICE-B', 'INVOICE-C']), str(output))
+    original = output.read_bytes()
+
+    merger.append_files(_invoice_pdfs(tmp_path, ['INVOICE-D']), str(output))
+    data = output.read_bytes()
+    assert data.startswith(original)
+    reader = PdfReader(str(output))
+    assert len(reader.pages) == 2
+    text = reader.pages[1].extract_text()
+    assert text.index('INVOICE-C') < text.index('INVOICE-D')
+
+def test_append_adds_pages(merger, test_image, tmp_path):
+    """测试最后一页已满时追加的发票放在新页面上，可以多次追加"""
+    from PyPDF2 import PdfReader
+    output = tmp_path / 'merged.pdf'
+    merger.merge_files(_invoice_pdfs(tmp_path, ['INVOICE-A', 'INVOICE-B']), str(output))
+    assert merger.append_files(_invoice_pdfs(tmp_path, ['INVOICE-C', 'INVOICE-D', 'INVOICE-E']), str(output)) == 2
+    assert merger.append_files([test_image], str(output)) == 0
+    reader = PdfReader(str(output))
+    assert len(reader.pages) == 3
+    assert [int(page['/Parent']['/Count']) for page in reader.pages] == [3, 3, 3]
+    assert 'INVOICE-E' in reader.pages[2].extract_text()
+    # 最后一页的两个位置都已占用，下一次追加从新页面开始
+    assert merger._free_slot_top(reader.pages[2]) is None
@@ -0,0 +1,89 @@
+import pytest
+from PIL import Image
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import NameObject
+from reportlab.pdfgen import canvas
+from merge_invoices import InvoiceMerger
+from pdf_optimizer import optimize_pdf
+
+
+@pytest.fixture
+def stamped_pdfs(tmp_path):
+    """两张不同的发票，使用同一个印章图片"""
+    stamp = tmp_path / 'stamp.png'
+    Image.effect_noise((200, 200), 50).convert('RGB').save(stamp)
+    paths = []
+    for i in range(2):
+        path = tmp_path / f'invoice{i}.pdf'
+        c = canvas.Canvas(str(path), pagesize=(680, 397))
+        c.drawImage(str(stamp), 10, 10, 100, 100)
+        c.drawString(300, 100, f'INVOICE-{i}')
+        c.save()
+        paths.append(str(path))
+    return paths
+
+
+def image_xobjects(path):
+    """统计PDF中所有不同的图片XObject"""
+    reader = PdfReader(path)
+    images = set()
+    for page in reader.pages:
+        for ref in page['/Resources']['/XObject'].values():
+            form = ref.get_object()
+            for image in form['/Resources']['/XObject'].values():
+                images.add(image.idnum)
+    return images
+
+
+def test_optimize_deduplicates_images(stamped_pdfs, tmp_path):
+    """测试相同的图片只保留一份，文字内容和文件权限不变"""
+    # 分别合并后再拼接，每页各有一份图片（合并时逐页写出已经会合并重复的图片）
+    writer = PdfWriter()
+    for i, path in enumerate(stamped_pdfs + stamped_pdfs[:1]):
+        single = tmp_path / f'single{i}.pdf'
+        InvoiceMerger(optimize=False).merge_files([path], str(single))
+        writer.add_page(PdfReader(str(single)).pages[0])
+    output = tmp_path / 'merged.pdf'
+    with open(output, 'wb') as f:
+        writer.write(f)
+    assert len(image_xobjects(str(output))) == 3
+    output.chmod(0o644)
+
+    stats = optimize_pdf(str(output))
+    assert len(image_xobjects(str(output))) == 1
+    assert stats['xobjects_deduplicated'] >= 2
+    assert stats['bytes_saved'] > 0
+    assert stats['bytes_after'] == output.stat().st_size
+    # 替换后沿用原文件的权限，而不是临时文件的 0600
+    assert output.stat().st_mode & 0o777 == 0o644
+    text = ''.join(page.extract_text() for page in PdfReader(str(output)).pages)
+    assert all(f'INVOICE-{i}' in text for i in range(2))
+
+
+def test_optimize_removes_unused_resources(stamped_pdfs, tmp_path):
+    """测试删除内容流中未引用的资源"""
+    reader = PdfReader(stamped_pdfs[0])
+    writer = PdfWriter()
+    page = writer.add_page(reader.pages[0])
+    xobjects = page['/Resources']['/XObject']
+    xobjects[NameObject('/Unused')] = list(xobjects.values())[0]
+    output = tmp_path / 'unused.pdf'
+    with open(output, 'wb') as f:
+        writer.write(f)
+
+    stats = optimize_pdf(str(output))
+    assert stats['resources_removed'] == 1
+    assert '/Unused' not in PdfReader(str(output)).pages[0]['/Resources']['/XObject']
+
+
+def test_merge_reports_bytes_saved(stamped_pdfs, tmp_path):
+    """测试合并后记录优化统计，关闭优化时不做后处理"""
+    merger = InvoiceMerger()
+    merger.merge_files(stamped_pdfs * 2, str(tmp_path / 'merged.pdf'))
+    assert merger.optimize_stats['bytes_saved'] > 0
+    # 逐页写出时不同页面上相同的印章图片只写一次
+    assert len(image_xobjects(str(tmp_path / 'merged.pdf'))) == 1
+
+    merger = InvoiceMerger(optimize=False)
+    merger.merge_files(stamped_pdfs, str(tmp_path / 'plain.pdf'))
+    assert merger.optimize_stats is None
@@ -0,0 +1,42 @@
+import os
+import pytest
+from PIL import Image
+from raster_cache import RasterCache
+
+@pytest.fixture
+def cache(tmp_path):
+    return RasterCache(str(tmp_path / 'cache'), max_bytes=10 * 1024 * 1024)
+
+@pytest.fixture
+def source_file(tmp_path):
+    path = tmp_path / 'invoice.pdf'
+    path.write_bytes(b'%PDF-1.4 test content')
+    return str(path)
+
+def test_cache_hit_and_miss(cache, source_file):
+    """测试缓存命中与未命中计数"""
+    key = cache.make_key(source_file, dpi=150)
+    assert cache.get(key) is None
+    path = cache.put(key, Image.new('RGB', (50, 50), color='white'))
+    assert cache.get(key) == path
+    assert Image.open(path).size == (50, 50)
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['entries'] == 1
+
+def test_cache_key_includes_render_params(cache, source_file):
+    """测试不同渲染参数生成不同的缓存键"""
+    assert cache.make_key(source_file, dpi=150) != cache.make_key(source_file, dpi=300)
+    assert cache.make_key(source_file, dpi=150) != cache.make_key(source_file, dpi=150, mode='L')
+
+def test_cache_lru_eviction(cache):
+    """测试超过容量上限时淘汰最久未使用的缓存"""
+    image = Image.new('RGB', (10, 10))
+    first = cache.put('first', image)
+    cache.max_bytes = int(os.path.getsize(first) * 1.5)
+    os.utime(first, (0, 0))
+    second = cache.put('second', image)
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+    assert cache.stats()['entries'] == 1
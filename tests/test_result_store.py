@@ -0,0 +1,34 @@
+import os
+import pytest
+from result_store import ResultStore
+
+@pytest.fixture
+def store(tmp_path):
+    return ResultStore(str(tmp_path / 'results'), ttl=60, max_bytes=1024)
+
+def test_unique_paths(store):
+    """测试每个任务使用独立的输出文件"""
+    assert store.path_for('task-a') != store.path_for('task-b')
+    with pytest.raises(ValueError):
+        store.path_for('../jobs.db')
+
+def test_get_and_expiry(store):
+    """测试获取结果以及过期结果被删除"""
+    path = store.path_for('task')
+    with open(path, 'wb') as f:
+        f.write(b'%PDF')
+    assert store.get('task') == path
+    os.utime(path, (0, 0))
+    assert store.get('task') is None
+    assert not os.path.exists(path)
+
+def test_cleanup_by_size(store):
+    """测试总大小超过上限时删除最早的结果"""
+    for index, task_id in enumerate(['old', 'new']):
+        with open(store.path_for(task_id), 'wb') as f:
+            f.write(b'x' * 800)
+        mtime = os.path.getmtime(store.path_for(task_id)) - 10 + index
+        os.utime(store.path_for(task_id), (mtime, mtime))
+    store.cleanup()
+    assert store.get('old') is None
+    assert store.get('new') is not None
@@ -0,0 +1,34 @@
+import time
+import pytest
+from status_store import MemoryStatusStore, SQLiteStatusStore
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryStatusStore(ttl=60)
+    return SQLiteStatusStore(str(tmp_path / 'jobs.db'), ttl=60)
+
+def test_set_get_update(store):
+    """测试写入、读取和合并更新任务状态"""
+    store.set('task', {'status': 'queued', 'progress': 0})
+    assert store.update('task', status='processing', progress=50)
+    assert store.get('task') == {'status': 'processing', 'progress': 50}
+    assert store.get('missing') is None
+    assert not store.update('missing', progress=1)
+
+def test_ttl_eviction(store):
+    """测试过期的任务状态不可见并被清理"""
+    store.ttl = 0.01
+    store.set('task', {'status': 'queued'})
+    time.sleep(0.02)
+    assert store.get('task') is None
+    store.purge_expired()
+    assert not store.update('task', status='processing')
+
+def test_sqlite_shared_between_instances(tmp_path):
+    """测试多个实例（模拟多个工作进程）共享同一数据库"""
+    path = str(tmp_path / 'jobs.db')
+    SQLiteStatusStore(path).set('task', {'status': 'queued'})
+    other = SQLiteStatusStore(path)
+    other.update('task', status='completed')
+    assert SQLiteStatusStore(path).get('task')['status'] == 'completed'
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+import os
+import json
+import math
+import time
+import uuid
+import fcntl
+import shutil
+import logging
+import tempfile
+from contextlib import contextmanager
+from result_store import TASK_ID_PATTERN
+
+# 上传会话默认保留时间（秒，从最后一次上传分块起算）、分块大小和单个会话的总大小上限
+DEFAULT_UPLOAD_TTL = 6 * 3600
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_SESSION_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_SESSION_MAX_FILES = 1000
+
+# 写入分块时每次读取的字节数
+COPY_BUFFER_SIZE = 256 * 1024
+
+
+class UploadError(ValueError):
+    """上传会话或分块无效"""
+
+
+class UploadSessionStore:
+    """分块上传会话存储
+
+    每个会话一个目录，保存会话信息和已收到的分块，所有工作进程共享，分块可以发送到任意工作进程。
+    分块先写入临时文件再改名，重复上传同一分块会覆盖之前的内容，中断后只需重新发送缺少的分块。
+    所有分块到齐后按文件拼接，交给合并任务。
+    """
+
+    def __init__(self, root, ttl=DEFAULT_UPLOAD_TTL, chunk_size=DEFAULT_CHUNK_SIZE,
+                 max_bytes=DEFAULT_SESSION_MAX_BYTES, max_files=DEFAULT_SESSION_MAX_FILES):
+        self.root = root
+        self.ttl = ttl
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        os.makedirs(self.root, exist_ok=True)
+
+    def _session_dir(self, upload_id):
+        if not TASK_ID_PATTERN.match(upload_id):
+            raise UploadError(f"无效的上传会话ID: {upload_id}")
+        return os.path.join(self.root, upload_id)
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self._session_dir(upload_id), 'session.json')
+
+    def _chunk_path(self, upload_id, index, chunk):
+        return os.path.join(self._session_dir(upload_id), f'{index}.{chunk}.part')
+
+    def _data_path(self, upload_id, index):
+        return os.path.join(self._session_dir(upload_id), f'{index}.data')
+
+    def _write_meta(self, upload_id, session):
+        path = self._meta_path(upload_id)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(session, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+    def create(self, files, **extra):
+        """创建上传会话，files 为 [{'name': 文件名, 'size': 字节数}]，返回会话信息"""
+        if not files:
+            raise UploadError('没有选择文件')
+        if len(files) > self.max_files:
+            raise UploadError(f'文件数超过上限 {self.max_files}')
+        total = 0
+        for file in files:
+            if not file.get('name') or not isinstance(file.get('size'), int) or file['size'] <= 0:
+                raise UploadError(f"无效的文件信息: {file}")
+            total += file['size']
+        if total > self.max_bytes:
+            raise UploadError(f'上传的文件总大小超过 {self.max_bytes // (1024 * 1024)}MB')
+
+        upload_id = str(uuid.uuid4())
+        os.makedirs(self._session_dir(upload_id))
+        session = dict(extra, files=[
+            {'name': os.path.basename(file['name']), 'size': file['size'],
+             'chunks': math.ceil(file['size'] / self.chunk_size)}
+            for file in files
+        ], chunk_size=self.chunk_size, created=time.time(), task_id=None)
+        self._write_meta(upload_id, session)
+        logging.info(f"已创建上传会话 {upload_id}: {len(files)} 个文件，共 {total} 字节")
+        return self.describe(upload_id, session)
+
+    def load(self, upload_id):
+        """读取会话信息，会话不存在或已过期时返回None"""
+        try:
+            path = self._meta_path(upload_id)
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                self.remove(upload_id)
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (UploadError, OSError, ValueError):
+            return None
+
+    def describe(self, upload_id, session):
+        """会话状态：每个文件已收到的分块序号（分块 n 的起始位置为 n * chunk_size）和字节数"""
+        received = {}
+        for name in os.listdir(self._session_dir(upload_id)):
+            if name.endswith('.part'):
+                index, chunk = name[:-len('.part')].split('.')
+                received.setdefault(int(index), []).append(int(chunk))
+            elif name.endswith('.data'):
+                # 已拼接完成的文件
+                index = int(name[:-len('.data')])
+                received[index] = list(range(session['files'][index]['chunks']))
+        files = []
+        for index, file in enumerate(session['files']):
+            chunks = sorted(received.get(index, []))
+            files.append(dict(file, index=index, received=chunks,
+                              received_bytes=sum(self.expected_size(session, index, n) for n in chunks)))
+        return {
+            'upload_id': upload_id,
+            'chunk_size': session['chunk_size'],
+            'files': files,
+            'complete': bool(session.get('task_id')) or all(len(file['received']) == file['chunks'] for file in files),
+            'task_id': session.get('task_id'),
+        }
+
+    @staticmethod
+    def expected_size(session, index, chunk):
+        """第 index 个文件的第 chunk 个分块应有的字节数，序号无效时抛出 UploadError"""
+        files = session['files']
+        if not 0 <= index < len(files) or not 0 <= chunk < files[index]['chunks']:
+            raise UploadError(f"无效的分块: 文件 {index}，分块 {chunk}")
+        size = session['chunk_size']
+        return min(size, files[index]['size'] - chunk * size)
+
+    def write_chunk(self, upload_id, session, index, chunk, stream):
+        """从 stream 读取并保存一个分块，长度与预期不符时抛出 UploadError"""
+        if session.get('task_id'):
+            raise UploadError('上传已完成，不能再上传分块')
+        expected = self.expected_size(session, index, chunk)
+        path = self._chunk_path(upload_id, index, chunk)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            written = 0
+            with os.fdopen(fd, 'wb') as f:
+                while written <= expected:
+                    data = stream.read(min(COPY_BUFFER_SIZE, expected + 1 - written))
+                    if not data:
+                        break
+                    f.write(data)
+                    written += len(data)
+            if written != expected:
+                raise UploadError(f"分块长度不正确: 应为 {expected} 字节，收到 {written} 字节")
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        # 以会话信息文件的修改时间作为最后活动时间
+        os.utime(self._meta_path(upload_id))
+        return expected
+
+    def assemble(self, upload_id, session):
+        """把分块按文件拼接，返回 [(文件名, 路径)]；有分块缺失时抛出 UploadError
+
+        已拼接的文件不再重复处理，任务提交失败（例如服务器繁忙）后可以再次完成上传
+        """
+        status = self.describe(upload_id, session)
+        missing = [file['name'] for file in status['files'] if len(file['received']) != file['chunks']]
+        if missing:
+            raise UploadError(f"以下文件尚未上传完成: {', '.join(missing[:5])}")
+        assembled = []
+        for index, file in enumerate(session['files']):
+            path = self._data_path(upload_id, index)
+            if not os.path.exists(path):
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+                with os.fdopen(fd, 'wb') as output:
+                    for chunk in range(file['chunks']):
+                        with open(self._chunk_path(upload_id, index, chunk), 'rb') as f:
+                            shutil.copyfileobj(f, output, COPY_BUFFER_SIZE)
+                os.replace(temp_path, path)
+                for chunk in range(file['chunks']):
+                    os.remove(self._chunk_path(upload_id, index, chunk))
+            assembled.append((file['name'], path))
+        return assembled
+
+    def mark_submitted(self, upload_id, session, task_id):
+        """记录会话对应的合并任务，重复完成同一会话时返回该任务；task_id 为None时撤销记录
+
+        任务结束后会话即被删除，此时不再需要记录，直接忽略
+        """
+        session['task_id'] = task_id
+        try:
+            self._write_meta(upload_id, session)
+        except FileNotFoundError:
+            logging.info(f"上传会话已删除，不再记录任务: {upload_id}")
+
+    @contextmanager
+    def locked(self, upload_id):
+        """在所有工作进程之间互斥地操作会话（例如完成上传）"""
+        with open(os.path.join(self._session_dir(upload_id), 'session.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def remove(self, upload_id):
+        """删除会话及其所有数据"""
+        try:
+            shutil.rmtree(self._session_dir(upload_id))
+            logging.info(f"已删除上传会话: {upload_id}")
+        except (UploadError, FileNotFoundError):
+            pass
+
+    def cleanup(self):
+        """删除过期的会话"""
+        now = time.time()
+        for entry in os.scandir(self.root):
+            try:
+                expired = now - os.path.getmtime(os.path.join(entry.path, 'session.json')) > self.ttl
+            except FileNotFoundError:
+                # 创建中的会话还没有会话信息文件，按目录时间判断
+                expired = now - entry.stat().st_mtime > self.ttl
+            if expired:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                logging.info(f"已清理上传会话: {entry.name}")